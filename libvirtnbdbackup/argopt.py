@@ -141,6 +141,30 @@ def addDebugArgs(opt: _ArgumentGroup) -> None:
     )
 
 
+def addMetricsArgs(opt: _ArgumentGroup) -> None:
+    """Metrics exporter arguments"""
+    opt.add_argument(
+        "--metrics-port",
+        default=0,
+        required=False,
+        type=int,
+        help=(
+            "Serve throughput metrics in OpenMetrics format "
+            "via HTTP on the given port. (default: %(default)s)"
+        ),
+    )
+    opt.add_argument(
+        "--metrics-file",
+        default="",
+        required=False,
+        type=str,
+        help=(
+            "Write throughput metrics to file, "
+            "usable with the node exporter textfile collector. (default: none)"
+        ),
+    )
+
+
 def addLogArgs(opt, prog):
     """Logging related arguments"""
     try:
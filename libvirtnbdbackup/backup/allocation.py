@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import json
+import heapq
+import struct
+import logging
+from typing import Optional, Tuple
+from argparse import Namespace
+from nbd import CONTEXT_BASE_ALLOCATION
+from libvirtnbdbackup import output
+from libvirtnbdbackup import common as lib
+from libvirtnbdbackup.objects import DomainDisk, ExtentList
+from libvirtnbdbackup.output.exceptions import OutputException
+
+log = logging.getLogger("allocation")
+
+MAGIC = b"virtnbdbackup-allocation-1\n"
+RECORD = struct.Struct(">QQ")
+
+
+def _fileName(args: Namespace, disk: DomainDisk) -> str:
+    """Allocation map is stored next to the checkpoints"""
+    return os.path.join(args.checkpointdir, f"{disk.target}.allocation")
+
+
+def write(fileName: str, checkpointName: str, size: int, extents: ExtentList) -> None:
+    """Write allocated regions of the disk as of the checkpoint"""
+    header = {"checkpointName": checkpointName, "virtualSize": size}
+    with output.openfile(fileName, "wb") as fh:
+        fh.write(MAGIC)
+        fh.write(json.dumps(header).encode() + b"\n")
+        for offset, length in zip(extents.offsets, extents.lengths):
+            fh.write(RECORD.pack(offset, length))
+
+
+def read(fileName: str) -> Tuple[str, int, ExtentList]:
+    """Read allocation map, returns checkpoint name, virtual
+    disk size and allocated regions"""
+    extents = ExtentList(CONTEXT_BASE_ALLOCATION)
+    with output.openfile(fileName, "rb") as fh:
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise OutputException(f"Invalid allocation map: [{fileName}]")
+        header = json.loads(fh.readline().decode())
+        data = fh.read()
+    for offset, length in RECORD.iter_unpack(
+        data[: len(data) // RECORD.size * RECORD.size]
+    ):
+        extents.append(offset, length, True)
+
+    return header["checkpointName"], header["virtualSize"], extents
+
+
+def get(args: Namespace, disk: DomainDisk) -> Optional[Tuple[str, ExtentList]]:
+    """Return checkpoint name and allocated regions of the
+    allocation map saved for the disk, if any"""
+    fileName = _fileName(args, disk)
+    if not os.path.exists(fileName):
+        return None
+    try:
+        checkpointName, _, extents = read(fileName)
+    except (OutputException, OSError, ValueError, KeyError) as e:
+        log.warning("Failed to read allocation map: [%s]", e)
+        return None
+
+    return checkpointName, extents
+
+
+def patch(cached: ExtentList, dirty: ExtentList, allocation: ExtentList) -> ExtentList:
+    """Replace the allocation status of the dirty regions within
+    the cached allocation map"""
+    kept = ExtentList(CONTEXT_BASE_ALLOCATION)
+    index: int = 0
+    for offset, length in zip(cached.offsets, cached.lengths):
+        end = offset + length
+        while (
+            index < len(dirty) and dirty.offsets[index] + dirty.lengths[index] <= offset
+        ):
+            index += 1
+        start = offset
+        current = index
+        while current < len(dirty) and dirty.offsets[current] < end:
+            if dirty.offsets[current] > start:
+                kept.append(start, dirty.offsets[current] - start, True)
+            start = max(start, dirty.offsets[current] + dirty.lengths[current])
+            current += 1
+        if start < end:
+            kept.append(start, end - start, True)
+
+    result = ExtentList(CONTEXT_BASE_ALLOCATION)
+    for offset, length in heapq.merge(
+        zip(kept.offsets, kept.lengths),
+        zip(allocation.offsets, allocation.lengths),
+    ):
+        if len(result) and result.offsets[-1] + result.lengths[-1] == offset:
+            result.lengths[-1] += length
+            continue
+        result.append(offset, length, True)
+
+    return result
+
+
+def _patchParent(
+    args: Namespace, fileName: str, extentHandler, size: int
+) -> Optional[ExtentList]:
+    """Patch the allocation map saved for the parent checkpoint
+    with the allocation status of the dirty regions"""
+    try:
+        checkpointName, virtualSize, cached = read(fileName)
+    except (OutputException, OSError, ValueError, KeyError) as e:
+        log.debug("Unable to read allocation map: [%s]", e)
+        return None
+    if checkpointName != args.cpt.parent or virtualSize != size:
+        log.debug(
+            "Allocation map of checkpoint [%s] does not match parent [%s].",
+            checkpointName,
+            args.cpt.parent,
+        )
+        return None
+
+    return patch(cached, extentHandler.dirty, extentHandler.allocation)
+
+
+def update(args: Namespace, disk: DomainDisk, extentHandler, size: int) -> None:
+    """Save the allocation map of the disk as of the current
+    checkpoint. If only the dirty regions have been queried, the
+    map saved for the parent checkpoint is patched. If no
+    allocation map can be saved, an existing one is removed, as
+    checkpoint names are reused after the next full backup."""
+    if args.level not in ("full", "inc") or args.offline is True:
+        return
+
+    fileName = _fileName(args, disk)
+    allocation = extentHandler.allocation
+    if allocation is not None and extentHandler.dirty is not None:
+        allocation = _patchParent(args, fileName, extentHandler, size)
+    if allocation is None:
+        try:
+            os.remove(fileName)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            log.warning("Failed to remove outdated allocation map: [%s]", e)
+        return
+
+    try:
+        write(fileName, args.cpt.name, size, allocation)
+    except OutputException as e:
+        log.warning("Failed to save allocation map: [%s]", e)
+        return
+
+    lib.safeInfo(
+        "Saved allocation map for checkpoint [%s]: [%s] allocated.",
+        args.cpt.name,
+        lib.humanize(allocation.dataSize),
+    )
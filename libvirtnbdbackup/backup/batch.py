@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import os
+import copy
+import signal
+import logging
+from datetime import datetime
+from functools import partial
+from argparse import Namespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from libvirtnbdbackup import __version__
+from libvirtnbdbackup import nbdcli
+from libvirtnbdbackup import virt
+from libvirtnbdbackup import metrics
+from libvirtnbdbackup import sighandle
+from libvirtnbdbackup import common as lib
+from libvirtnbdbackup.logcount import logCount
+from libvirtnbdbackup.backup import ratelimit
+from libvirtnbdbackup.output.target.directory import Directory
+from libvirtnbdbackup.output.exceptions import OutputException
+from libvirtnbdbackup.virt.exceptions import connectionFailed
+
+# amount of ports reserved for each domain during batch backup
+PORT_RANGE = 100
+
+
+def isBatch(domain: str) -> bool:
+    """Check if multiple domains or patterns have been passed"""
+    return any(c in domain for c in ",*?[")
+
+
+def workerPools(args: Namespace) -> Tuple[ThreadPoolExecutor, Any]:
+    """Setup compression pool and read scheduler"""
+    compressPool = ThreadPoolExecutor(
+        max_workers=args.compress_threads, thread_name_prefix="compress"
+    )
+    scheduler = None
+    if args.read_workers > 0:
+        logging.info("Shared read workers: [%s]", args.read_workers)
+        scheduler = nbdcli.Scheduler(args.read_workers)
+
+    return compressPool, scheduler
+
+
+def domainArgs(args: Namespace, name: str, index: int) -> Namespace:
+    """Setup options for domain: each domain is saved to its own
+    sub directory and uses its own NBD socket and ports"""
+    dargs = copy.copy(args)
+    dargs.domain = name
+    dargs.output = os.path.join(args.output, name)
+    dargs.socketfile = f"{args.socketfile}.{name}"
+    dargs.nbd_port = args.nbd_port + index * PORT_RANGE
+    dargs.diskInfo = []
+    dargs.guestInfo = {}
+    if args.checkpointdir:
+        dargs.checkpointdir = os.path.join(args.checkpointdir, name)
+
+    return dargs
+
+
+def _domain(backupDomain: Callable, args: Namespace, shared: Namespace) -> int:
+    """Backup domain with log messages written to the log file
+    within the domains target directory, returns exit code"""
+    lib.setThreadName(args.domain)
+    lib.setLogDomain(args.domain)
+    try:
+        Directory().create(args.output)
+    except OutputException as e:
+        logging.error("Can't create target directory: [%s]", e)
+        return 1
+
+    now = datetime.now().strftime("%m%d%Y%H%M%S")
+    logFile = os.path.join(args.output, f"backup.{args.level}.{now}.log")
+    fileLog = lib.getLogFile(logFile)
+    if fileLog is None:
+        return 1
+    fileLog.setFormatter(logging.Formatter(lib.logFormat, datefmt=lib.logDateFormat))
+    counter = logCount()
+    rootLog = logging.getLogger()
+    for handler in (fileLog, counter):
+        handler.addFilter(lib.DomainFilter(args.domain))
+        rootLog.addHandler(handler)
+
+    try:
+        backupDomain(args, counter, shared, logFile)
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    except Exception as e:  # pylint: disable=broad-except
+        logging.critical("Unknown Exception during backup: %s", e)
+        logging.exception(e)
+        return 1
+    finally:
+        for handler in (fileLog, counter):
+            rootLog.removeHandler(handler)
+        fileLog.close()
+
+
+def _prepare(args: Namespace) -> bool:
+    """Setup bandwidth limits and metrics exporter shared by all
+    domain backups"""
+    if args.stdout is True:
+        logging.error("Backup of multiple domains to stdout is not supported.")
+        return False
+
+    try:
+        args.rateLimiter = ratelimit.get(args)
+    except (OSError, ValueError) as e:
+        logging.error("Unable to read bandwidth limits: [%s]", e)
+        return False
+
+    if not metrics.start(args):
+        return False
+
+    return True
+
+
+def _connect(args: Namespace) -> Optional[Tuple[Any, List[str]]]:
+    """Connect libvirt daemon and ssh session, returns the client
+    and names of the domains to backup"""
+    try:
+        virtClient = virt.client(args)
+        virtClient.connect()
+    except connectionFailed as e:
+        logging.error("Can't connect libvirt daemon: [%s]", e)
+        return None
+
+    names = virtClient.getDomainNames(args.domain.split(","))
+    if not names:
+        logging.error("No domains found matching: [%s]", args.domain)
+        return None
+    logging.info("Domains to backup: [%s]", ", ".join(names))
+
+    if virtClient.remoteHost != "":
+        args.sshClient = lib.sshSession(args, virtClient.remoteHost)
+        if not args.sshClient:
+            logging.error("Remote backup detected but ssh session setup failed")
+            return None
+
+    return virtClient, names
+
+
+def _report(names: List[str], results: Dict[str, int]) -> int:
+    """Log result of each domain backup, returns highest exit code"""
+    for name in names:
+        if results[name] == 0:
+            logging.info("Backup of domain [%s] finished successfully.", name)
+        else:
+            logging.error(
+                "Backup of domain [%s] failed, exit code: [%s]", name, results[name]
+            )
+
+    return max(results.values())
+
+
+def run(args: Namespace, backupDomain: Callable) -> int:
+    """Backup multiple domains using a shared libvirt connection,
+    ssh session and worker pools. Up to batch_workers domains are
+    saved concurrently, disks of all domains are saved by one
+    pool of worker threads. Returns the highest exit code of
+    all domain backups."""
+    try:
+        Directory().create(args.output)
+    except OutputException as e:
+        logging.error("Can't open output directory: [%s]", e)
+        return 1
+
+    now = datetime.now().strftime("%m%d%Y%H%M%S")
+    fileLog = lib.getLogFile(os.path.join(args.output, f"backup.batch.{now}.log"))
+    if fileLog is None:
+        return 1
+    lib.configLogger(args, fileLog, logCount())
+    lib.printVersion(__version__)
+
+    if not _prepare(args):
+        return 1
+
+    connection = _connect(args)
+    if connection is None:
+        return 1
+    virtClient, names = connection
+
+    diskWorkers = args.worker or os.cpu_count() or 1
+    logging.info(
+        "Concurrent domains: [%s], concurrent disks: [%s]",
+        args.batch_workers,
+        diskWorkers,
+    )
+    shared = Namespace(
+        virtClient=virtClient,
+        diskPool=ThreadPoolExecutor(max_workers=diskWorkers),
+        running={},
+    )
+    args.compressPool, args.scheduler = workerPools(args)
+    signal.signal(signal.SIGINT, partial(sighandle.Batch.catch, shared, logging))
+    signal.signal(signal.SIGUSR1, partial(sighandle.Backup.reload, args, logging))
+
+    results: Dict[str, int] = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.batch_workers) as executor:
+            futures = {
+                executor.submit(
+                    _domain, backupDomain, domainArgs(args, name, i), shared
+                ): name
+                for i, name in enumerate(names)
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+    finally:
+        shared.diskPool.shutdown(wait=True)
+        args.compressPool.shutdown(wait=True)
+        if args.scheduler is not None:
+            args.scheduler.shutdown()
+        virtClient.close()
+        if args.sshClient:
+            args.sshClient.disconnect()
+
+    return _report(names, results)
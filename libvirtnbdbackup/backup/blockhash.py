@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import json
+import hashlib
+import logging
+from typing import List, Tuple, Optional
+from argparse import Namespace
+from libvirtnbdbackup import output
+from libvirtnbdbackup import common as lib
+from libvirtnbdbackup.objects import DomainDisk
+from libvirtnbdbackup.backup import target
+from libvirtnbdbackup.output.exceptions import OutputException
+
+log = logging.getLogger("blockhash")
+
+MAGIC = b"virtnbdbackup-hashes-1\n"
+BLOCK_SIZE = 1024 * 1024
+DIGEST_SIZE = 16
+# digest of blocks with unknown content
+UNKNOWN = bytes(DIGEST_SIZE)
+
+
+class BlockHashes:
+    """Hashes of all aligned blocks of a disk, as of the latest
+    backup in the chain.
+
+    Digests are kept in a packed array, the digest of block n is
+    stored at offset n * DIGEST_SIZE. Blocks are hashed after being
+    read, if the hash matches the one recorded by the previous
+    backup, the block was rewritten with identical content and does
+    not need to be saved again. Blocks only partially read have
+    unknown content afterwards, their hash is dropped.
+    """
+
+    def __init__(self, size: int, hashes: Optional[bytes] = None) -> None:
+        self.size = size
+        self.hashes = bytearray(-(-size // BLOCK_SIZE) * DIGEST_SIZE)
+        if hashes is not None:
+            length = min(len(hashes), len(self.hashes))
+            self.hashes[:length] = hashes[:length]
+        self.unchanged: int = 0
+
+    def update(self, offset: int, data) -> List[Tuple[int, int]]:
+        """Hash blocks of the data read from offset, returns list
+        of unchanged (start, end) ranges relative to data"""
+        unchanged: List[Tuple[int, int]] = []
+        end = offset + len(data)
+        for index in range(offset // BLOCK_SIZE, (end - 1) // BLOCK_SIZE + 1):
+            start = index * BLOCK_SIZE
+            pos = index * DIGEST_SIZE
+            if start < offset or start + BLOCK_SIZE > end:
+                self.hashes[pos : pos + DIGEST_SIZE] = UNKNOWN
+                continue
+            digest = hashlib.blake2b(
+                data[start - offset : start - offset + BLOCK_SIZE],
+                digest_size=DIGEST_SIZE,
+            ).digest()
+            if self.hashes[pos : pos + DIGEST_SIZE] == digest:
+                unchanged.append((start - offset, start - offset + BLOCK_SIZE))
+                self.unchanged += BLOCK_SIZE
+            else:
+                self.hashes[pos : pos + DIGEST_SIZE] = digest
+
+        return unchanged
+
+    def save(self, fileName: str, checkpointName: str) -> None:
+        """Write hash manifest: header followed by the digest array"""
+        header = {
+            "checkpointName": checkpointName,
+            "blockSize": BLOCK_SIZE,
+            "virtualSize": self.size,
+            "hash": f"blake2b-{DIGEST_SIZE * 8}",
+        }
+        with output.openfile(fileName, "wb") as fh:
+            fh.write(MAGIC)
+            fh.write(json.dumps(header).encode() + b"\n")
+            fh.write(self.hashes)
+
+    @staticmethod
+    def load(fileName: str) -> Tuple[str, int, bytes]:
+        """Read hash manifest, returns checkpoint name, virtual
+        disk size and digest array"""
+        with output.openfile(fileName, "rb") as fh:
+            if fh.read(len(MAGIC)) != MAGIC:
+                raise OutputException(f"Invalid hash manifest: [{fileName}]")
+            header = json.loads(fh.readline().decode())
+            if header["blockSize"] != BLOCK_SIZE:
+                raise OutputException(f"Unsupported block size: [{fileName}]")
+            hashes = fh.read()
+
+        return header["checkpointName"], header["virtualSize"], hashes
+
+
+def load(args: Namespace, disk: DomainDisk, size: int) -> BlockHashes:
+    """Load hashes saved by the backup of the parent checkpoint,
+    if none exist, all blocks are saved."""
+    if args.level != "inc":
+        return BlockHashes(size)
+
+    for fileName in reversed(lib.getLatest(args.output, f"{disk.target}.*.hashes")):
+        try:
+            checkpointName, virtualSize, hashes = BlockHashes.load(fileName)
+        except (OutputException, ValueError, KeyError) as e:
+            log.warning("Failed to read hash manifest: [%s]", e)
+            continue
+        if checkpointName != args.cpt.parent:
+            continue
+        if virtualSize != size:
+            lib.safeInfo(
+                "Disk size changed since checkpoint [%s], saving all dirty blocks.",
+                checkpointName,
+            )
+            break
+        lib.safeInfo("Loaded block hashes from [%s]", fileName)
+        return BlockHashes(size, hashes)
+    else:
+        lib.safeInfo(
+            "No block hashes for checkpoint [%s] found, saving all dirty blocks.",
+            args.cpt.parent,
+        )
+    return BlockHashes(size)
+
+
+def save(args: Namespace, disk: DomainDisk, blockHashes: BlockHashes) -> None:
+    """Save hashes next to the data file, used by the next
+    incremental backup"""
+    targetFile, _ = target.Set(args, disk, "hashes")
+    try:
+        blockHashes.save(targetFile, args.cpt.name)
+    except OutputException as e:
+        log.warning("Failed to save block hashes: [%s]", e)
+        return
+
+    if blockHashes.unchanged > 0:
+        lib.safeInfo(
+            "Skipped [%s] of rewritten but unchanged data.",
+            lib.humanize(blockHashes.unchanged),
+        )
@@ -22,6 +22,7 @@ from libvirt import virDomain
 from libvirtnbdbackup import virt
 from libvirtnbdbackup import common as lib
 from libvirtnbdbackup import exceptions
+from libvirtnbdbackup.sparsestream import codec
 
 log = logging.getLogger()
 
@@ -31,6 +32,24 @@ def arguments(args: Namespace) -> None:
     if args.compress is not False and args.type == "raw":
         raise exceptions.BackupException("Compression not supported with raw output.")
 
+    if args.compress is not False and args.compression_method not in codec.available():
+        raise exceptions.BackupException(
+            f"Compression method [{args.compression_method}] not available, "
+            "required python module not installed."
+        )
+
+    if args.repository is not None and (
+        args.stdout is True or args.type == "raw" or args.raw is True
+    ):
+        raise exceptions.BackupException(
+            "Repository output only supported for stream format to directory."
+        )
+
+    if args.skip_unchanged is True and args.stdout is True:
+        raise exceptions.BackupException(
+            "Skipping unchanged blocks not supported while writing to stdout."
+        )
+
     if args.stdout is True and args.type == "raw":
         raise exceptions.BackupException("Output type raw not supported to stdout.")
 
@@ -0,0 +1,79 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+from collections import deque
+from concurrent.futures import Executor, Future
+from typing import Tuple, Deque, Any, Optional
+
+log = logging.getLogger("compress")
+
+
+class Compressor:
+    """Compression stage between NBD reader and stream writer.
+
+    Blocks returned by the reader are passed to a thread pool
+    for compression, so reading, compressing and writing data
+    overlap. Up to window blocks are compressed concurrently,
+    the compressed frames are returned in the original order.
+    """
+
+    def __init__(self, reader, codec: Any, pool: Executor, window: int) -> None:
+        self._reader = reader
+        self._codec = codec
+        self._pool = pool
+        self._window = max(window, 1)
+        self._pending: Deque[Tuple[int, int, Future]] = deque()
+        self._eof: bool = False
+
+    def _fill(self) -> None:
+        """Read the next blocks and submit them for compression"""
+        while not self._eof and len(self._pending) < self._window:
+            item = self._reader.read()
+            if item is None:
+                self._eof = True
+                return
+            length, offset, data = item
+            future = self._pool.submit(self._compress, data)
+            self._pending.append((length, offset, future))
+
+    def _compress(self, data: memoryview) -> bytes:
+        """Compress block and return buffer to the reader"""
+        try:
+            return self._codec.compress(data)
+        finally:
+            self._reader.release(data)
+
+    def read(self) -> Optional[Tuple[int, int, bytes]]:
+        """Return length, offset and compressed frame of the next
+        block in sequence, None if all blocks have been read"""
+        self._fill()
+        if not self._pending:
+            return None
+        length, offset, future = self._pending.popleft()
+
+        return length, offset, future.result()
+
+    def release(self, data: bytes) -> None:
+        """Compressed frames are not pooled"""
+
+    def close(self) -> None:
+        """Cancel pending compression jobs and close reader"""
+        for _, _, future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._reader.close()
@@ -15,27 +15,37 @@ GNU General Public License for more details.
 You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
+import time
 import logging
+from functools import partial
 from argparse import Namespace
-from typing import List, Any, Tuple
+from typing import List, Any, Tuple, Generator, Union
 from libvirtnbdbackup import nbdcli
 from libvirtnbdbackup import virt
 from libvirtnbdbackup.virt.client import DomainDisk
-from libvirtnbdbackup.objects import processInfo
+from libvirtnbdbackup.objects import processInfo, ExtentList
 from libvirtnbdbackup.sparsestream import streamer
 from libvirtnbdbackup.sparsestream import types
+from libvirtnbdbackup.sparsestream import codec
 from libvirtnbdbackup import exceptions
 from libvirtnbdbackup import chunk
 from libvirtnbdbackup import block
+from libvirtnbdbackup import metrics
 from libvirtnbdbackup.backup import partialfile
 from libvirtnbdbackup.backup import server
 from libvirtnbdbackup.backup import target
-from libvirtnbdbackup.backup.metadata import backupChecksum
+from libvirtnbdbackup.backup import compress
+from libvirtnbdbackup.backup import segments
+from libvirtnbdbackup.backup import blockhash
+from libvirtnbdbackup.backup import allocation
+from libvirtnbdbackup.backup import profiler
+from libvirtnbdbackup.backup.metadata import backupChecksum, diskClusterSize
 from libvirtnbdbackup import extenthandler
 from libvirtnbdbackup.qemu import util as qemu
 from libvirtnbdbackup.qemu.exceptions import ProcessError
 from libvirtnbdbackup import common as lib
 from libvirtnbdbackup.output import stream
+from libvirtnbdbackup.output import vector
 
 
 def _setStreamType(args: Namespace, disk: DomainDisk) -> str:
@@ -47,7 +57,7 @@ def _setStreamType(args: Namespace, disk: DomainDisk) -> str:
     return streamType
 
 
-def _getExtentHandler(args: Namespace, nbdClient):
+def _getExtentHandler(args: Namespace, nbdClient, baseClient=None):
     """Query dirty blocks either via qemu client or self
     implemented extend handler"""
     if args.qemu:
@@ -59,13 +69,196 @@ def _getExtentHandler(args: Namespace, nbdClient):
         )
     else:
         extentHandler = extenthandler.ExtentHandler(
-            nbdClient, nbdClient.cType, args.no_sparse_detection
+            nbdClient, nbdClient.cType, args.no_sparse_detection, baseClient
         )
 
     return extentHandler
 
 
-def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-locals, too-many-statements
+def _getExtents(
+    args: Namespace, disk: DomainDisk, extentHandler, diskSize: int
+) -> Union[ExtentList, extenthandler.ExtentStream]:
+    """Query extents. If extents are streamed, saving data starts
+    as soon as the first extents have been received, the amount
+    of data is estimated based on the checkpoint size, if known."""
+    if args.stream_extents is False:
+        extents = extentHandler.queryBlockStatus()
+        if args.coalesce_gap > 0:
+            extents = extenthandler.coalesce(extents, args.coalesce_gap)
+        return extents
+
+    estimate = args.estimatedSizes.get(disk.target, 0)
+    if estimate > 0:
+        lib.safeInfo(
+            "Estimated data size based on checkpoint: [%s]", lib.humanize(estimate)
+        )
+    return extenthandler.ExtentStream(
+        extentHandler.streamBlockStatus(diskSize),
+        diskSize,
+        estimate,
+        args.coalesce_gap,
+    )
+
+
+def _updateEstimate(extents, progressBar, stats) -> None:
+    """Update progress bar and metrics if the amount of data
+    is estimated"""
+    total = extents.dataSize
+    if total != progressBar.total:
+        progressBar.total = total
+        progressBar.refresh()
+        stats.estimate(total)
+
+
+def _dataBlocks(
+    extents: Union[ExtentList, extenthandler.ExtentStream],
+    maxRequestSize: int,
+    align: int = 0,
+    sizer=None,
+) -> Generator:
+    """Return the sequence of read requests required to save all
+    data extents, in the order they are written to the stream.
+    With adaptive request sizing, extents are split using the
+    request size currently chosen by the sizer."""
+    for extent in extents:
+        if extent.data is False:
+            continue
+        if sizer is not None:
+            yield from sizer.step(extent.offset, extent.length)
+        elif align:
+            yield from block.alignedStep(
+                extent.offset, extent.length, maxRequestSize, align
+            )
+        else:
+            yield from block.step(extent.offset, extent.length, maxRequestSize)
+
+
+def _detectZeroes(args: Namespace, streamType: str) -> bool:
+    """Zeroed ranges within data extents can only be saved as zero
+    frames during full or copy backup: during restore of incremental
+    backups, zero frames are skipped."""
+    return (
+        streamType == "stream"
+        and args.level in ("full", "copy")
+        and args.no_zero_detection is False
+    )
+
+
+def _skipUnchanged(args: Namespace, streamType: str) -> bool:
+    """Block hashes are saved during full and incremental backup,
+    incremental backups leave out blocks that have been rewritten
+    with the same content."""
+    return (
+        streamType == "stream"
+        and args.level in ("full", "inc")
+        and args.skip_unchanged is True
+    )
+
+
+def _getSizer(args: Namespace, disk: DomainDisk, connection, align: int):
+    """Setup adaptive request sizing if enabled. Requests are
+    aligned to the cluster size of the qcow image."""
+    if args.adaptive_request_size is False:
+        return None
+    clusterSize = 65536
+    if disk.format.startswith("qcow"):
+        clusterSize = diskClusterSize(args, disk)
+    sizer = nbdcli.RequestSizer(
+        connection.minRequestSize,
+        connection.maxRequestSize,
+        max(align, clusterSize),
+    )
+    lib.safeInfo(
+        "Adaptive request size between [%s] and [%s]",
+        lib.humanize(sizer.minSize),
+        lib.humanize(sizer.maxSize),
+    )
+
+    return sizer
+
+
+def _getReader(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+    args: Namespace,
+    disk: DomainDisk,
+    connection,
+    extents: Union[ExtentList, extenthandler.ExtentStream],
+    align: int,
+    sizer,
+    stats,
+    remoteIP: str,
+    port: int,
+    virtClient: virt.client,
+) -> Tuple[Any, List[Any]]:
+    """Setup reader for the data extents. If multiple connections are
+    requested and the NBD server allows multiple connections to the
+    same export, reads are striped across all connections. Read
+    buffers are reused from a pool shared by all connections.
+
+    If shared read workers are used, the blocks are passed to the
+    scheduler, which reads the blocks of all disks."""
+    blocks = _dataBlocks(extents, connection.maxRequestSize, align, sizer)
+    # blocks in flight or waiting to be written
+    window = 2 * args.queue_depth * args.nbd_connections
+    poolSize = window + 1
+    if args.compress is not False:
+        poolSize += args.compress_threads
+    pool = nbdcli.BufferPool(poolSize)
+    throttle = args.rateLimiter.disk(args.domain, disk.target)
+    if args.scheduler is not None:
+        maxConnections = 1
+        if connection.nbd.can_multi_conn():
+            maxConnections = args.nbd_connections
+        job = args.scheduler.add(
+            connection,
+            blocks,
+            extents.dataSize,
+            window,
+            args.queue_depth,
+            maxConnections,
+            partial(server.connect, args, disk, "", remoteIP, port, virtClient),
+            pool,
+            sizer,
+            throttle,
+            stats,
+        )
+        return job, []
+
+    if args.nbd_connections < 2:
+        return (
+            nbdcli.Reader(
+                connection, blocks, args.queue_depth, pool, sizer, throttle, stats
+            ),
+            [],
+        )
+
+    if not connection.nbd.can_multi_conn():
+        lib.safeInfo("NBD server does not support multiple connections, using one.")
+        return (
+            nbdcli.Reader(
+                connection, blocks, args.queue_depth, pool, sizer, throttle, stats
+            ),
+            [],
+        )
+
+    lib.safeInfo("Using [%s] connections to NBD server.", args.nbd_connections)
+    connections = [
+        server.connect(args, disk, "", remoteIP, port, virtClient)
+        for _ in range(args.nbd_connections - 1)
+    ]
+    reader = nbdcli.StripedReader(
+        [connection] + connections,
+        blocks,
+        args.queue_depth,
+        pool,
+        sizer,
+        throttle,
+        stats,
+    )
+
+    return reader, connections
+
+
+def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-locals, too-many-statements, too-many-nested-blocks
     args: Namespace,
     disk: DomainDisk,
     count: int,
@@ -73,7 +266,11 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
     virtClient: virt.client,
 ) -> Tuple[int, bool]:
     """Backup domain disk data."""
-    dStream = streamer.SparseStream(types)
+    dStream = streamer.SparseStream(
+        types,
+        args.stream_version,
+        args.compression_method if args.compress is not False else "",
+    )
     sTypes = types.SparseStreamTypes()
     lib.setThreadName(disk.target)
     streamType = _setStreamType(args, disk)
@@ -95,27 +292,67 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
     if disk.discardOption is not None:
         lib.safeInfo("Virtual disk discard option: [%s]", disk.discardOption)
 
-    connection = server.connect(args, disk, metaContext, remoteIP, port, virtClient)
+    separateAllocation = server.separateAllocation(args)
+    connection = server.connect(
+        args, disk, metaContext, remoteIP, port, virtClient, not separateAllocation
+    )
+
+    profile = None
+    if args.profile is True:
+        profile = profiler.Profile(disk.target)
 
-    extentHandler = _getExtentHandler(args, connection)
-    extents = extentHandler.queryBlockStatus()
+    # extents are queried using a separate connection while
+    # data is read from the main connection
+    extentConnection = connection
+    if args.stream_extents is True and args.qemu is False:
+        extentConnection = server.connect(
+            args,
+            disk,
+            metaContext,
+            remoteIP,
+            port,
+            virtClient,
+            not separateAllocation,
+        )
+    baseConnection = None
+    if separateAllocation:
+        baseConnection = server.connect(args, disk, "", remoteIP, port, virtClient)
+    extentHandler = _getExtentHandler(args, extentConnection, baseConnection)
     diskSize = connection.nbd.get_size()
+    started = time.perf_counter()
+    extents = _getExtents(args, disk, extentHandler, diskSize)
+    if args.stream_extents is False:
+        if profile is not None:
+            profile.add("extents", time.perf_counter() - started, diskSize)
+        if baseConnection is not None:
+            baseConnection.disconnect()
 
     if extents is None:
         logging.error("No extents returned by NBD server.")
         return 0, False
 
-    thinBackupSize = sum(extent.length for extent in extents if extent.data is True)
-    lib.safeInfo("Got %s extents to backup.", len(extents))
-    logging.debug("%s", lib.dumpExtentJson(extents))
+    thinBackupSize = extents.dataSize
     lib.safeInfo("%s bytes [%s] virtual disk size", diskSize, lib.humanize(diskSize))
-    lib.safeInfo(
-        "%s bytes [%s] of data extents to backup",
-        thinBackupSize,
-        lib.humanize(thinBackupSize),
-    )
+    if args.stream_extents is True:
+        lib.safeInfo(
+            "Receiving extents, estimated [%s] of data extents to backup",
+            lib.humanize(thinBackupSize),
+        )
+    else:
+        lib.safeInfo("Got %s extents to backup.", len(extents))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s", lib.dumpExtentJson(extents))
+        lib.safeInfo(
+            "%s bytes [%s] of data extents to backup",
+            thinBackupSize,
+            lib.humanize(thinBackupSize),
+        )
 
-    if args.level in ("inc", "diff") and thinBackupSize == 0:
+    if (
+        args.level in ("inc", "diff")
+        and thinBackupSize == 0
+        and args.stream_extents is False
+    ):
         lib.safeInfo("No dirty blocks found")
         args.noprogress = True
 
@@ -128,80 +365,165 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
     # opened output channel
     if not args.stdout:
         fileStream = stream.get(args)
-    writer = target.get(args, fileStream, targetFile, targetFilePartial)
+    targetWriter = target.get(args, fileStream, targetFile, targetFilePartial)
+    writer = targetWriter if profile is None else profile.writer(targetWriter)
+    if streamType == "stream":
+        writer = dStream.writer(vector.Writer(writer))
 
     if streamType == "raw":
         lib.safeInfo("Creating full provisioned raw backup image")
         writer.truncate(diskSize)
     else:
         lib.safeInfo("Creating thin provisioned stream backup image")
+        # if extents are streamed, the amount of data is not
+        # known yet, save the upper limit
         header = dStream.dumpMetadata(
             args,
             diskSize,
-            thinBackupSize,
+            diskSize if args.stream_extents is True else thinBackupSize,
             disk,
+            _detectZeroes(args, streamType),
+            _skipUnchanged(args, streamType),
+            args.stream_extents,
         )
         dStream.writeFrame(writer, sTypes.META, 0, len(header))
         writer.write(header)
-        writer.write(sTypes.TERM)
+        dStream.writeTerm(writer)
 
     progressBar = lib.progressBar(
         thinBackupSize, f"saving disk {disk.target}", args, count=count
     )
+    blockHashes = None
+    align = 0
+    if _skipUnchanged(args, streamType):
+        blockHashes = blockhash.load(args, disk, diskSize)
+        align = blockhash.BLOCK_SIZE
+    sizer = _getSizer(args, disk, connection, align)
+    diskStats = metrics.diskStats("backup", disk.target, thinBackupSize, args.domain)
+    stats = diskStats if profile is None else profile.stats(diskStats)
+    reader, connections = _getReader(
+        args,
+        disk,
+        connection,
+        extents,
+        align,
+        sizer,
+        stats,
+        remoteIP,
+        port,
+        virtClient,
+    )
+    streamCodec = None
+    if args.compress is not False:
+        streamCodec = codec.get(
+            args.compression_method, args.compress, args.zstd_threads
+        )
+        if profile is not None:
+            streamCodec = profile.codec(streamCodec)
+    segmentReader = None
+    if _detectZeroes(args, streamType) or blockHashes is not None:
+        reader = segmentReader = segments.SegmentReader(
+            reader,
+            _detectZeroes(args, streamType),
+            blockHashes,
+            streamCodec,
+            args.compressPool,
+            args.compress_threads,
+        )
+    elif streamCodec is not None:
+        reader = compress.Compressor(
+            reader,
+            streamCodec,
+            args.compressPool,
+            args.compress_threads,
+        )
     compressedSizes: List[Any] = []
     backupSize: int = 0
-    for save in extents:
-        if save.data is True:
-            if streamType == "stream":
-                dStream.writeFrame(writer, sTypes.DATA, save.offset, save.length)
-                logging.debug(
-                    "Read data from: start %s, length: %s", save.offset, save.length
-                )
-
-            cSizes = None
-
-            if save.length >= connection.maxRequestSize:
-                logging.debug(
-                    "Chunked data read from: start %s, length: %s",
-                    save.offset,
-                    save.length,
-                )
-                size, cSizes = chunk.write(
-                    writer, save, connection, streamType, args.compress, progressBar
-                )
-            else:
-                size = block.write(
-                    writer,
-                    save,
-                    connection,
-                    streamType,
-                    args.compress,
-                )
-                if streamType == "raw":
-                    size = writer.seek(save.offset)
-
+    # requests still in flight are finished before the
+    # connections are closed
+    try:
+        for save in extents:
+            if args.stream_extents is True:
+                _updateEstimate(extents, progressBar, stats)
+            if save.data is True and segmentReader is not None:
+                for isData, offset, length, data in segmentReader.segments(
+                    save.offset, save.length
+                ):
+                    if isData is False:
+                        dStream.writeFrame(writer, sTypes.ZERO, offset, length)
+                        continue
+                    dStream.writeFrame(writer, sTypes.DATA, offset, length)
+                    size = writer.write(data)
+                    dStream.writeTerm(writer)
+                    stats.written(size)
+                    if args.compress:
+                        stats.compressed(size)
+                        compressedSizes.append(size)
+                        backupSize += size
+                    else:
+                        assert size == length
+                        backupSize += length
                 progressBar.update(save.length)
+                stats.extent(save.length)
+            elif save.data is True:
+                if streamType == "stream":
+                    dStream.writeFrame(writer, sTypes.DATA, save.offset, save.length)
+                    logging.debug(
+                        "Read data from: start %s, length: %s", save.offset, save.length
+                    )
 
-            if streamType == "stream":
-                writer.write(sTypes.TERM)
-                if args.compress:
-                    logging.debug("Compressed size: %s", size)
-                    backupSize += size
-                    if cSizes:
-                        blockList = {}
-                        blockList[size] = cSizes
-                        compressedSizes.append(blockList)
-                    else:
-                        compressedSizes.append(size)
+                cSizes = None
+
+                if sizer is not None:
+                    chunked = save.length > sizer.minSize
                 else:
-                    assert size == save.length
+                    chunked = save.length >= connection.maxRequestSize
+                if chunked:
+                    logging.debug(
+                        "Chunked data read from: start %s, length: %s",
+                        save.offset,
+                        save.length,
+                    )
+                    size, cSizes = chunk.write(
+                        writer, save, reader, streamType, args.compress, progressBar
+                    )
+                else:
+                    size = block.write(writer, save, reader, streamType)
+                    if streamType == "raw":
+                        size = writer.seek(save.offset)
+
+                    progressBar.update(save.length)
+
+                stats.extent(save.length)
+                if streamType == "raw":
+                    stats.written(save.length)
+                if streamType == "stream":
+                    dStream.writeTerm(writer)
+                    stats.written(size)
+                    if args.compress:
+                        logging.debug("Compressed size: %s", size)
+                        stats.compressed(size)
+                        backupSize += size
+                        if cSizes:
+                            blockList = {}
+                            blockList[size] = cSizes
+                            compressedSizes.append(blockList)
+                        else:
+                            compressedSizes.append(size)
+                    else:
+                        assert size == save.length
+                        backupSize += save.length
+            else:
+                stats.extent()
+                if streamType == "raw":
+                    writer.seek(save.offset)
                     backupSize += save.length
-        else:
-            if streamType == "raw":
-                writer.seek(save.offset)
-                backupSize += save.length
-            elif streamType == "stream" and args.level not in ("inc", "diff"):
-                dStream.writeFrame(writer, sTypes.ZERO, save.offset, save.length)
+                elif streamType == "stream" and args.level not in ("inc", "diff"):
+                    dStream.writeFrame(writer, sTypes.ZERO, save.offset, save.length)
+    except BaseException:
+        reader.close()
+        raise
+
     if streamType == "stream":
         dStream.writeFrame(writer, sTypes.STOP, 0, 0)
         if args.compress:
@@ -209,6 +531,24 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
 
     progressBar.close()
     writer.close()
+    reader.close()
+    if isinstance(extents, extenthandler.ExtentStream):
+        extents.close()
+        if profile is not None:
+            profile.add("extents", extents.elapsed, diskSize)
+        if extentConnection is not connection:
+            extentConnection.disconnect()
+        if baseConnection is not None:
+            baseConnection.disconnect()
+    if sizer is not None:
+        lib.safeInfo("Final request size: [%s]", lib.humanize(sizer.size))
+    if segmentReader is not None and segmentReader.zeroSize > 0:
+        lib.safeInfo(
+            "Saved [%s] of zeroed data within data extents as zero frames.",
+            lib.humanize(segmentReader.zeroSize),
+        )
+    for con in connections:
+        con.disconnect()
     connection.disconnect()
 
     if args.offline is True and virtClient.remoteHost == "":
@@ -218,6 +558,10 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
     if args.offline is True:
         lib.remove(args, nbdProc.pidFile)
 
+    if profile is not None:
+        profile.checksum(getattr(fileStream, "hasher", None))
+        profile.report("" if args.stdout else targetFile)
+
     if not args.stdout:
         if args.noprogress is True:
             lib.safeInfo(
@@ -226,5 +570,8 @@ def backup(  # pylint: disable=too-many-arguments,too-many-branches, too-many-lo
         partialfile.rename(targetFilePartial, targetFile)
     if streamType != "raw":
         backupChecksum(fileStream, targetFile)
+    if blockHashes is not None:
+        blockhash.save(args, disk, blockHashes)
+    allocation.update(args, disk, extentHandler, diskSize)
 
     return backupSize, True
@@ -23,6 +23,7 @@ from typing import List, Union
 import libvirt
 
 from libvirtnbdbackup import output
+from libvirtnbdbackup import checksum
 from libvirtnbdbackup.virt.client import DomainDisk
 from libvirtnbdbackup import common as lib
 from libvirtnbdbackup.qemu import util as qemu
@@ -39,14 +40,21 @@ log = logging.getLogger()
 
 
 def backupChecksum(fileStream, targetFile):
-    """Save the calculated adler32 checksum, it can be verified
-    by virtnbdbrestore's verify function.'"""
-    checksum = fileStream.checksum()
-    safeInfo("Checksum for file: [%s]:[%s]", targetFile, checksum)
+    """Save the file and block digests calculated during backup,
+    they can be verified by virtnbdbrestore's verify function.'"""
+    result = fileStream.checksum()
+    if result is None:
+        return
+    safeInfo(
+        "Checksum for file: [%s]:[%s:%s]",
+        targetFile,
+        result["algorithm"],
+        result["digest"],
+    )
     chksumfile = f"{targetFile}.chksum"
     safeInfo("Saving checksum to: [%s]", chksumfile)
     with output.openfile(chksumfile, "w") as cf:
-        cf.write(f"{checksum}")
+        cf.write(checksum.dumps(result))
 
 
 def backupConfig(args: Namespace, vmConfig: str) -> Union[str, None]:
@@ -85,6 +93,27 @@ def backupDiskInfo(args: Namespace, disk: DomainDisk):
         log.warning("Failed to save qcow image config: [%s]", e)
 
 
+def diskClusterSize(args: Namespace, disk: DomainDisk) -> int:
+    """Return cluster size of the qcow image from the image info
+    saved during previous backups, default if none exists."""
+    clusterSize = 65536
+    configFile = lib.getLatest(args.output, f"{disk.target}*.qcow.json*", -1)
+    if not configFile:
+        return clusterSize
+    try:
+        with output.openfile(configFile[0], "rb") as fh:
+            clusterSize = int(json.loads(fh.read().decode())["cluster-size"])
+    except (
+        OutputException,
+        json.decoder.JSONDecodeError,
+        KeyError,
+        ValueError,
+    ) as errmsg:
+        log.warning("Unable to read cluster size from image info: [%s]", errmsg)
+
+    return clusterSize
+
+
 def backupBootConfig(args: Namespace) -> None:
     """Save domain uefi/nvram/kernel and loader if configured."""
     for setting, val in args.info.items():
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from argparse import Namespace
+from typing import Any, Dict, List, Optional, Sequence, TypeVar, Union, cast
+from libvirtnbdbackup import output
+from libvirtnbdbackup.common import safeInfo, humanize
+
+# pipeline stages in processing order
+STAGES = ("extents", "read", "compress", "checksum", "write")
+
+# measured objects are wrapped by proxies passing all other
+# attribute access, so they keep the type of the wrapped object
+T = TypeVar("T")
+
+
+class Profile:
+    """Collect time, bytes and calls for each stage of the backup
+    of a single disk.
+
+    Stages running in separate threads are measured by wrapping
+    the objects passed to them, so the time of concurrent stages
+    is summed across all threads and may exceed the total time.
+    """
+
+    def __init__(self, disk: str) -> None:
+        self.disk = disk
+        self._started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._stages: Dict[str, List[Union[float, int]]] = {
+            stage: [0.0, 0, 0] for stage in STAGES
+        }
+
+    def add(self, stage: str, elapsed: float, length: int = 0, calls: int = 1) -> None:
+        """Account time spent in stage"""
+        with self._lock:
+            entry = self._stages[stage]
+            entry[0] += elapsed
+            entry[1] += length
+            entry[2] += calls
+
+    def stats(self, stats: T) -> T:
+        """Measure NBD read requests reported to the metrics"""
+        return cast(T, _Stats(self, stats))
+
+    def codec(self, codec: Any) -> "_Codec":
+        """Measure compression"""
+        return _Codec(self, codec)
+
+    def writer(self, writer: T) -> T:
+        """Measure writes to the output target"""
+        return cast(T, _Writer(self, writer))
+
+    def checksum(self, hasher: Any) -> None:
+        """Account time spent computing checksums"""
+        if hasher is not None:
+            self.add("checksum", hasher.elapsed, hasher.length, hasher.calls)
+
+    def result(self) -> Dict[str, Any]:
+        """Return breakdown of all stages"""
+        stages = {}
+        for stage, (elapsed, length, calls) in self._stages.items():
+            rate = 0.0
+            if elapsed > 0:
+                rate = length / elapsed / 1000 / 1000
+            stages[stage] = {
+                "seconds": round(elapsed, 6),
+                "bytes": length,
+                "calls": calls,
+                "MBps": round(rate, 2),
+            }
+        return {
+            "disk": self.disk,
+            "seconds": round(time.perf_counter() - self._started, 6),
+            "stages": stages,
+        }
+
+    def report(self, targetFile: str = "") -> None:
+        """Log breakdown and save it along with the target file"""
+        result = self.result()
+        safeInfo(
+            "Profile for disk [%s], total time: [%.3f] seconds",
+            self.disk,
+            result["seconds"],
+        )
+        for stage, entry in result["stages"].items():
+            safeInfo(
+                " %-8s: %10.3f s %10s %10s calls %10.2f MB/s",
+                stage,
+                entry["seconds"],
+                humanize(entry["bytes"]),
+                entry["calls"],
+                entry["MBps"],
+            )
+        if not targetFile:
+            return
+        profileFile = f"{targetFile}.profile.json"
+        safeInfo("Saving profile to: [%s]", profileFile)
+        with output.openfile(profileFile, "w") as fh:
+            fh.write(json.dumps(result, indent=1))
+
+
+class _Proxy:
+    """Pass attribute access to the wrapped object"""
+
+    def __init__(self, profile: Profile, obj: Any) -> None:
+        self._profile = profile
+        self._obj = obj
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._obj, name)
+
+
+class _Stats(_Proxy):
+    """Account NBD read requests"""
+
+    def read(self, length: int, elapsed: Optional[float] = None) -> None:
+        """Pass request to the metrics and account duration"""
+        self._obj.read(length, elapsed)
+        if elapsed is not None:
+            self._profile.add("read", elapsed, length)
+
+
+class _Codec(_Proxy):
+    """Account compression"""
+
+    def compress(self, data: Union[bytes, memoryview]) -> bytes:
+        """Compress data"""
+        started = time.perf_counter()
+        result = self._obj.compress(data)
+        self._profile.add("compress", time.perf_counter() - started, len(data))
+        return result
+
+
+class _Writer(_Proxy):
+    """Account writes, including the time waiting for checksums
+    computed while writing"""
+
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        """Write data"""
+        started = time.perf_counter()
+        written = self._obj.write(data)
+        self._profile.add("write", time.perf_counter() - started, len(data))
+        return written
+
+    def writev(self, buffers: Sequence[Union[bytes, memoryview]]) -> int:
+        """Write buffers"""
+        started = time.perf_counter()
+        written = self._obj.writev(buffers)
+        self._profile.add(
+            "write",
+            time.perf_counter() - started,
+            sum(len(data) for data in buffers),
+        )
+        return written
+
+
+class Dump:
+    """Collect cProfile statistics of all threads.
+
+    Before python 3.12, cProfile only profiles the thread it has
+    been enabled in, while disks are saved, read and compressed
+    by worker threads. A profiler is therefore enabled for each
+    thread started while profiling, the statistics of all threads
+    are merged once profiling is stopped: threads which have been
+    running before profiling started are not covered. Starting with
+    python 3.12, a single profiler covers all threads.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._profilers: List[cProfile.Profile] = [cProfile.Profile()]
+        self._perThread = sys.version_info < (3, 12)
+        if self._perThread:
+            threading.setprofile(self._thread)
+        self._profilers[0].enable()
+
+    def _thread(self, *_: Any) -> None:
+        """Enable profiler on first call within new thread"""
+        profiler = cProfile.Profile()
+        with self._lock:
+            self._profilers.append(profiler)
+        profiler.enable()
+
+    def stop(self) -> Optional[pstats.Stats]:
+        """Stop profiling, returns merged statistics"""
+        if self._perThread:
+            threading.setprofile(None)
+        self._profilers[0].disable()
+        stats: Optional[pstats.Stats] = None
+        with self._lock:
+            for profiler in self._profilers:
+                profiler.create_stats()
+                if not profiler.stats:
+                    continue
+                if stats is None:
+                    stats = pstats.Stats(profiler)
+                else:
+                    stats.add(profiler)
+        return stats
+
+
+def start(args: Namespace) -> Optional[Dump]:
+    """Start cProfile for all threads if dump of the statistics
+    is requested"""
+    if not args.profile_dump:
+        return None
+    return Dump()
+
+
+def stop(args: Namespace, dump: Optional[Dump]) -> None:
+    """Stop cProfile and save statistics"""
+    if dump is None:
+        return
+    stats = dump.stop()
+    if stats is None:
+        return
+    safeInfo("Saving profile statistics to: [%s]", args.profile_dump)
+    stats.dump_stats(args.profile_dump)
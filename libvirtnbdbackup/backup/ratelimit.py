@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import time
+import logging
+import threading
+from argparse import Namespace
+from typing import Dict, Tuple
+from libvirtnbdbackup.common import humanize, parseSize
+
+log = logging.getLogger("ratelimit")
+
+
+def describe(rate: int) -> str:
+    """Human readable rate"""
+    if rate == 0:
+        return "unlimited"
+    return f"{humanize(rate)}/s"
+
+
+class TokenBucket:
+    """Token bucket limiting the amount of bytes per second.
+
+    Requests larger than the bucket may be issued, the bucket
+    is then in debt and following requests wait until it has
+    been refilled.
+    """
+
+    def __init__(self, rate: int = 0) -> None:
+        self._lock = threading.Lock()
+        self._rate: int = rate
+        self._tokens: float = rate
+        self._last: float = time.monotonic()
+
+    @property
+    def rate(self) -> int:
+        """Current rate, 0 if unlimited"""
+        return self._rate
+
+    def setRate(self, rate: int) -> None:
+        """Change rate, takes effect for the next request"""
+        with self._lock:
+            self._rate = rate
+            self._tokens = min(self._tokens, rate)
+
+    def consume(self, length: int) -> None:
+        """Wait until the request of length bytes may be issued"""
+        with self._lock:
+            if self._rate == 0:
+                return
+            now = time.monotonic()
+            self._tokens = min(
+                self._tokens + (now - self._last) * self._rate, self._rate
+            )
+            self._last = now
+            self._tokens -= length
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Throttle:
+    """Limit reads for one disk by both the global and
+    the per disk bucket"""
+
+    def __init__(self, *buckets: TokenBucket) -> None:
+        self._buckets = buckets
+
+    def consume(self, length: int) -> None:
+        """Wait until the request may be issued"""
+        for bucket in self._buckets:
+            bucket.consume(length)
+
+
+class Limiter:
+    """Process wide read rate limit, shared by all backup
+    workers, and per disk limits. Disks are identified by
+    domain and target, as the limiter is shared by all domains
+    of a batch backup. Limits can be changed while the backup
+    is running."""
+
+    def __init__(self, rate: int = 0, diskRate: int = 0) -> None:
+        self._global = TokenBucket(rate)
+        self._diskRate: int = diskRate
+        self._disks: Dict[Tuple[str, str], TokenBucket] = {}
+        self._lock = threading.Lock()
+
+    def disk(self, domain: str, target: str) -> Throttle:
+        """Return throttle for disk of domain"""
+        with self._lock:
+            bucket = self._disks.setdefault(
+                (domain, target), TokenBucket(self._diskRate)
+            )
+        return Throttle(self._global, bucket)
+
+    def setRate(self, rate: int, diskRate: int) -> None:
+        """Change global and per disk limits"""
+        self._global.setRate(rate)
+        with self._lock:
+            self._diskRate = diskRate
+            for bucket in self._disks.values():
+                bucket.setRate(diskRate)
+
+    def load(self, fileName: str) -> None:
+        """Read limits from file. The file contains the options
+        bwlimit and bwlimit-disk, one per line:
+
+            bwlimit=100M
+            bwlimit-disk=50M
+        """
+        rate = self._global.rate
+        diskRate = self._diskRate
+        with open(fileName, "r", encoding="utf-8") as fh:
+            for line in fh:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                key, _, value = line.partition("=")
+                if key.strip() == "bwlimit":
+                    rate = parseSize(value)
+                elif key.strip() == "bwlimit-disk":
+                    diskRate = parseSize(value)
+                else:
+                    log.warning("Ignoring unknown option in [%s]: [%s]", fileName, key)
+        self.setRate(rate, diskRate)
+        log.info(
+            "Bandwidth limit: global [%s], per disk [%s]",
+            describe(rate),
+            describe(diskRate),
+        )
+
+
+def get(args: Namespace) -> Limiter:
+    """Setup limits as passed via options or limit file"""
+    limiter = Limiter(args.bwlimit, args.bwlimit_disk)
+    if args.bwlimit_file is not None:
+        limiter.load(args.bwlimit_file)
+    elif args.bwlimit or args.bwlimit_disk:
+        log.info(
+            "Bandwidth limit: global [%s], per disk [%s]",
+            describe(args.bwlimit),
+            describe(args.bwlimit_disk),
+        )
+
+    return limiter
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+import logging
+from collections import deque
+from concurrent.futures import Executor
+from typing import Tuple, Deque, Any, List, Optional, Generator
+from libvirtnbdbackup.backup import zeroes
+from libvirtnbdbackup.backup import blockhash
+
+log = logging.getLogger("segments")
+
+
+class SegmentReader:
+    # pylint: disable=too-many-instance-attributes
+    """Split data blocks into segments which are saved as separate
+    frames.
+
+    Thick provisioned or preallocated images report zeroed ranges as
+    allocated: if zero detection is enabled, the blocks returned by
+    the reader are scanned and zeroed ranges are returned as zero
+    segments. If block hashes are passed, ranges rewritten with
+    unchanged content since the last backup are left out.
+
+    If a codec is passed, data segments are compressed using the
+    thread pool, up to window segments ahead: the pool is required
+    along with the codec.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        reader,
+        detectZeroes: bool = True,
+        blockHashes: Optional[blockhash.BlockHashes] = None,
+        codec: Any = None,
+        pool: Optional[Executor] = None,
+        window: int = 1,
+    ) -> None:
+        self._reader = reader
+        self._eof: bool = False
+        self._detectZeroes = detectZeroes
+        self._blockHashes = blockHashes
+        self._codec = codec
+        self._pool = pool
+        self._window = max(window, 1)
+        self._pending: Deque[Tuple[bool, int, int, Any, Optional[List[Any]]]] = deque()
+        self._dataPending: int = 0
+        self._segments = self._generate()
+        self._head: Optional[Tuple[bool, int, int, Any]] = None
+        self.zeroSize: int = 0
+
+    def _runs(self, offset: int, data) -> List[Tuple[bool, int, int]]:
+        """Return data and zero runs for block, without unchanged
+        ranges"""
+        if self._detectZeroes:
+            blockRuns = zeroes.runs(data)
+        else:
+            blockRuns = [(True, 0, len(data))]
+        if self._blockHashes is None:
+            return blockRuns
+
+        unchanged = self._blockHashes.update(offset, data)
+        if not unchanged:
+            return blockRuns
+
+        result: List[Tuple[bool, int, int]] = []
+        for isData, start, end in blockRuns:
+            for skipStart, skipEnd in unchanged:
+                if skipEnd <= start or skipStart >= end:
+                    continue
+                if skipStart > start:
+                    result.append((isData, start, skipStart))
+                start = max(start, skipEnd)
+            if start < end:
+                result.append((isData, start, end))
+
+        return result
+
+    def _fill(self) -> None:
+        """Read blocks until enough data segments are pending"""
+        while not self._eof and self._dataPending < self._window:
+            item = self._reader.read()
+            self._eof = item is None
+            if item is None:
+                return
+            _, offset, data = item
+            blockRuns = self._runs(offset, data)
+            ref = [sum(1 for isData, _, _ in blockRuns if isData), data]
+            if ref[0] == 0:
+                self._reader.release(data)
+            for isData, start, end in blockRuns:
+                payload = None
+                if isData:
+                    payload = data[start:end]
+                    if self._codec is not None:
+                        assert self._pool is not None
+                        payload = self._pool.submit(self._codec.compress, payload)
+                    self._dataPending += 1
+                else:
+                    self.zeroSize += end - start
+                self._pending.append(
+                    (isData, offset + start, end - start, payload, ref)
+                )
+
+    def _done(self, ref: List[Any]) -> None:
+        """Return block to reader once all of its data segments
+        have been processed"""
+        ref[0] -= 1
+        if ref[0] == 0:
+            self._reader.release(ref[1])
+
+    def _generate(self) -> Generator[Tuple[bool, int, int, Any], None, None]:
+        """Return all segments in sequence"""
+        prev = None
+        while True:
+            self._fill()
+            if prev is not None:
+                self._done(prev)
+                prev = None
+            if not self._pending:
+                return
+            isData, offset, length, payload, ref = self._pending.popleft()
+            if isData:
+                self._dataPending -= 1
+                if self._codec is not None:
+                    payload = payload.result()
+                prev = ref
+            yield isData, offset, length, payload
+
+    def segments(
+        self, offset: int, length: int
+    ) -> Generator[Tuple[bool, int, int, Any], None, None]:
+        """Return segments for the data extent at the given offset,
+        extents must be requested in the order they were passed.
+        If trailing ranges of the extent are left out, the next
+        segment already belongs to the following extent and is
+        kept for the next call."""
+        end = offset + length
+        while True:
+            if self._head is None:
+                self._head = next(self._segments, None)
+                if self._head is None:
+                    return
+            if self._head[1] >= end:
+                return
+            segment, self._head = self._head, None
+            assert segment[1] >= offset
+            yield segment
+
+    def close(self) -> None:
+        """Cancel pending compression jobs and close reader"""
+        for _, _, _, payload, _ in self._pending:
+            if self._codec is not None and payload is not None:
+                payload.cancel()
+        self._pending.clear()
+        self._reader.close()
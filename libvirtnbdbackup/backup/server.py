@@ -29,6 +29,18 @@ from libvirtnbdbackup.exceptions import DiskBackupFailed
 # pylint: disable=too-many-arguments,too-many-positional-arguments
 
 
+def separateAllocation(args: Namespace) -> bool:
+    """During incremental or differential backup, the dirty bitmap
+    is queried using a connection without base:allocation meta
+    context. The allocation status is then queried for the dirty
+    regions only, using an additional connection."""
+    return (
+        args.level in ("inc", "diff")
+        and args.no_sparse_detection is False
+        and args.qemu is False
+    )
+
+
 def setup(args: Namespace, disk: DomainDisk, remoteHost: str, port: int) -> processInfo:
     """Start background qemu-nbd process used during backup
     if domain is offline, in case of remote backup, initiate
@@ -37,6 +49,11 @@ def setup(args: Namespace, disk: DomainDisk, remoteHost: str, port: int) -> proc
     if args.level in ("inc", "diff"):
         bitMap = args.cpt.name
     socket = f"{args.socketfile}.{disk.target}"
+    connections = args.nbd_connections
+    if args.stream_extents is True:
+        connections += 1
+    if separateAllocation(args):
+        connections += 1
     if remoteHost != "":
         logging.info(
             "Offline backup, starting remote NBD server, address: [%s:%s]",
@@ -44,14 +61,14 @@ def setup(args: Namespace, disk: DomainDisk, remoteHost: str, port: int) -> proc
             port,
         )
         nbdProc = qemu.util(disk.target).startRemoteBackupNbdServer(
-            args, disk, bitMap, port
+            args, disk, bitMap, port, connections
         )
         logging.info("Remote NBD server started, PID: [%s].", nbdProc.pid)
         return nbdProc
 
     logging.info("Offline backup, starting local NBD server, socket: [%s]", socket)
     nbdProc = qemu.util(disk.target).startBackupNbdServer(
-        disk.format, disk.path, socket, bitMap
+        disk.format, disk.path, socket, bitMap, connections + 1
     )
     logging.info("Local NBD Service started, PID: [%s]", nbdProc.pid)
     return nbdProc
@@ -64,8 +81,10 @@ def connect(  # pylint: disable=too-many-arguments
     remoteIP: str,
     port: int,
     virtClient: virt.client,
+    sparseDetection: bool = True,
 ):
-    """Connect to started nbd endpoint"""
+    """Connect to started nbd endpoint, base:allocation meta
+    context is negotiated unless sparse detection is disabled"""
     socket = args.socketfile
     if args.offline is True:
         socket = f"{args.socketfile}.{disk.target}"
@@ -76,7 +95,7 @@ def connect(  # pylint: disable=too-many-arguments
     else:
         cType = nbdcli.Unix(disk.target, metaContext, socket)
 
-    nbdClient = nbdcli.client(cType, args.no_sparse_detection)
+    nbdClient = nbdcli.client(cType, args.no_sparse_detection or not sparseDetection)
 
     try:
         return nbdClient.connect()
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+from typing import Tuple, List
+
+# granularity used to detect zeroed ranges within data blocks
+BLOCK_SIZE = 64 * 1024
+
+ZEROES = memoryview(bytes(BLOCK_SIZE))
+
+
+def _isZero(buf, start: int, length: int) -> bool:
+    """Check if range of buffer contains only zeroes: bytearray
+    startswith() boils down to memcmp, which is considerably
+    faster than comparing memoryview slices."""
+    if buf[start] or buf[start + length - 1]:
+        return False
+    return buf.startswith(ZEROES[:length], start)
+
+
+def runs(data, blockSize: int = BLOCK_SIZE) -> List[Tuple[bool, int, int]]:
+    """Split buffer into consecutive runs of data or zeroes, returns
+    list of (isData, start, end) tuples relative to the buffer."""
+    # buffers from the read pool always start at the beginning of
+    # the underlying bytearray
+    buf = data.obj if isinstance(data, memoryview) else data
+    length = len(data)
+    result: List[Tuple[bool, int, int]] = []
+    for start in range(0, length, blockSize):
+        end = min(start + blockSize, length)
+        isData = not _isZero(buf, start, end - start)
+        if result and result[-1][0] == isData:
+            result[-1] = (isData, result[-1][1], end)
+        else:
+            result.append((isData, start, end))
+
+    return result
@@ -15,9 +15,8 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
-from typing import Generator, IO, Any, Union
+from typing import Generator, IO, Any
 from nbd import Error as nbdError
-from libvirtnbdbackup import lz4
 from libvirtnbdbackup.exceptions import BackupException
 
 
@@ -45,22 +44,39 @@ def step(offset: int, length: int, maxRequestSize: int) -> Generator:
             blockOffset += blocklen
 
 
-def write(
-    writer: IO[Any], block, nbdCon, btype: str, compress: Union[bool, int]
-) -> int:
+def alignedStep(offset: int, length: int, maxRequestSize: int, align: int) -> Generator:
+    """Same as step(), but blocks end at multiples of the alignment,
+    so only the first and last block of an extent can partially
+    cover an aligned range."""
+    size = maxRequestSize - maxRequestSize % align
+    if size == 0:
+        yield from step(offset, length, maxRequestSize)
+        return
+    end = offset + length
+    blockOffset = offset
+    while blockOffset < end:
+        blocklen = min((blockOffset // size + 1) * size, end) - blockOffset
+        yield blocklen, blockOffset
+        blockOffset += blocklen
+
+
+def write(writer: IO[Any], block, reader, btype: str) -> int:
     """Write single block that does not exceed nbd maxRequestSize
-    setting. In case compression is enabled, single blocks are
-    compressed using lz4.
+    setting. In case compression is enabled, the reader returns
+    the block as compressed lz4 frame.
     """
     if btype == "raw":
         writer.seek(block.offset)
 
     try:
-        data = nbdCon.nbd.pread(block.length, block.offset)
+        item = reader.read()
     except nbdError as e:
         raise BackupException(e) from e
+    assert item is not None
+    length, offset, data = item
+    assert (length, offset) == (block.length, block.offset)
 
-    if compress is not False:
-        data = lz4.compressFrame(data, compress)
+    size = writer.write(data)
+    reader.release(data)
 
-    return writer.write(data)
+    return size
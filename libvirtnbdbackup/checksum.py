@@ -0,0 +1,178 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import json
+import time
+import zlib
+import hashlib
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Sequence, Union
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+log = logging.getLogger("checksum")
+
+# stream data covered by one block digest
+BLOCK_SIZE = 16 * 1024 * 1024
+# buffers below this size are hashed by the calling thread
+INLINE_LIMIT = 64 * 1024
+
+
+class Adler32:
+    """Adler32 checksum as used by previous versions, only
+    used to verify existing backups"""
+
+    def __init__(self) -> None:
+        self.value: int = 1
+
+    def update(self, data) -> None:
+        """Update checksum"""
+        self.value = zlib.adler32(data, self.value)
+
+    def hexdigest(self) -> str:
+        """Return checksum as saved by previous versions"""
+        return str(self.value)
+
+
+def available(algorithm: str) -> bool:
+    """Check if the required module for the algorithm is installed"""
+    if algorithm == "xxh3":
+        return xxhash is not None
+    return algorithm in ("blake2b", "adler32")
+
+
+def default() -> str:
+    """Use xxh3 if the python xxhash module is installed,
+    blake2b otherwise"""
+    if available("xxh3"):
+        return "xxh3"
+    return "blake2b"
+
+
+def new(algorithm: str) -> Any:
+    """Return hash object for algorithm"""
+    if algorithm == "xxh3":
+        return xxhash.xxh3_128()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == "adler32":
+        return Adler32()
+    raise ValueError(f"Unsupported checksum algorithm: [{algorithm}]")
+
+
+class Hasher:
+    # pylint: disable=too-many-instance-attributes
+    """Compute digest over all data written to a file, along with
+    digests for each block of BLOCK_SIZE bytes.
+
+    Large buffers are hashed by a separate thread, so hashing runs
+    concurrently with the write: the caller starts hashing via
+    update(), writes the data and waits for the returned future
+    before the buffers are reused. Time spent hashing is summed
+    up for profiling.
+    """
+
+    def __init__(self, algorithm: str = "") -> None:
+        self.algorithm = algorithm or default()
+        self._executor: Union[ThreadPoolExecutor, None] = None
+        self.elapsed: float = 0.0
+        self.length: int = 0
+        self.calls: int = 0
+        self._digest = new(self.algorithm)
+        self._block = new(self.algorithm)
+        self._blockLength: int = 0
+        self.blocks: List[str] = []
+
+    def reset(self) -> None:
+        """Start new digest"""
+        self._digest = new(self.algorithm)
+        self._block = new(self.algorithm)
+        self._blockLength = 0
+        self.blocks = []
+
+    def _update(self, buffers: Sequence[Union[bytes, memoryview]]) -> None:
+        """Update file and block digests"""
+        started = time.perf_counter()
+        for data in buffers:
+            view = memoryview(data).cast("B")
+            self._digest.update(view)
+            while view:
+                length = min(len(view), BLOCK_SIZE - self._blockLength)
+                self._block.update(view[:length])
+                self._blockLength += length
+                view = view[length:]
+                if self._blockLength == BLOCK_SIZE:
+                    self.blocks.append(self._block.hexdigest())
+                    self._block = new(self.algorithm)
+                    self._blockLength = 0
+        self.elapsed += time.perf_counter() - started
+        self.length += sum(len(data) for data in buffers)
+        self.calls += 1
+
+    def update(self, buffers: Sequence[Union[bytes, memoryview]]) -> Future:
+        """Start hashing buffers, returns future which is done
+        once the buffers have been hashed"""
+        if sum(len(data) for data in buffers) < INLINE_LIMIT:
+            future: Future = Future()
+            self._update(buffers)
+            future.set_result(None)
+            return future
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="checksum")
+        return self._executor.submit(self._update, buffers)
+
+    def result(self) -> Dict[str, Any]:
+        """Return digests and start a new one"""
+        if self._blockLength > 0:
+            self.blocks.append(self._block.hexdigest())
+        result = {
+            "algorithm": self.algorithm,
+            "digest": self._digest.hexdigest(),
+            "blockSize": BLOCK_SIZE,
+            "blocks": self.blocks,
+        }
+        self.reset()
+        return result
+
+    def close(self) -> None:
+        """Stop hashing thread"""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+def dumps(result: Dict[str, Any]) -> str:
+    """Return checksum file contents"""
+    return json.dumps(result)
+
+
+def loads(content: str) -> Dict[str, Any]:
+    """Parse checksum file, files written by previous versions
+    contain the adler32 checksum of the complete file only"""
+    content = content.strip()
+    if content.isdigit():
+        return {
+            "algorithm": "adler32",
+            "digest": content,
+            "blockSize": BLOCK_SIZE,
+            "blocks": [],
+        }
+    return json.loads(content)
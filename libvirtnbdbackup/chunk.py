@@ -18,14 +18,13 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 from typing import List, Any, Tuple, IO, Union
 from nbd import Error as nbdError
 from libvirtnbdbackup import block
-from libvirtnbdbackup import lz4
 from libvirtnbdbackup.exceptions import DiskBackupFailed
 
 # pylint: disable=too-many-arguments,too-many-positional-arguments
 
 
 def write(
-    writer: IO[Any], blk, nbdCon, btype: str, compress: Union[bool, int], pbar
+    writer: IO[Any], blk, reader, btype: str, compress: Union[bool, int], pbar
 ) -> Tuple[int, List[int]]:
     """During extent processing, consecutive blocks with
     the same type(data or zeroed) are unified into one big chunk.
@@ -34,31 +33,35 @@ def write(
     But in cases where the block to be saved exceeds the maximum
     recommended request size (nbdClient.maxRequestSize), we
     need to split one big request into multiple not exceeding
-    the limit
+    the limit. The reader delivers the blocks in order, until
+    the complete chunk has been read.
 
-    If compression is enabled, function returns a list of
-    offsets for the compressed frames, which is appended
-    to the end of the stream.
+    If compression is enabled, the reader returns compressed
+    frames and the function returns a list of sizes for the
+    compressed frames, which is appended to the end of the
+    stream.
     """
     wSize = 0
     cSizes = []
-    for blocklen, blockOffset in block.step(
-        blk.offset, blk.length, nbdCon.maxRequestSize
-    ):
-        if btype == "raw":
-            writer.seek(blockOffset)
-
+    chunkOffset = blk.offset
+    while chunkOffset < blk.offset + blk.length:
         try:
-            data = nbdCon.nbd.pread(blocklen, blockOffset)
+            item = reader.read()
         except nbdError as e:
             raise DiskBackupFailed(e) from e
+        assert item is not None
+        blocklen, blockOffset, data = item
+        assert blockOffset == chunkOffset
+        chunkOffset += blocklen
 
+        if btype == "raw":
+            writer.seek(blockOffset)
+
+        size = writer.write(data)
+        reader.release(data)
+        wSize += size
         if compress is not False:
-            compressed = lz4.compressFrame(data, compress)
-            wSize += writer.write(compressed)
-            cSizes.append(len(compressed))
-        else:
-            wSize += writer.write(data)
+            cSizes.append(size)
 
         pbar.update(blocklen)
 
@@ -70,14 +73,14 @@ def read(
     offset: int,
     length: int,
     nbdCon,
-    compression: bool,
+    codec: Any,
     pbar,
 ) -> int:
     """Read data from reader and write to nbd connection
 
     If Compression is enabled function receives length information
     as dict, which contains the stream offsets for the compressed
-    lz4 frames.
+    frames, which are decompressed using the passed codec.
 
     Frames are read from the stream at the compressed size information
     (offset in the stream).
@@ -91,8 +94,8 @@ def read(
     """
     wSize = 0
     for blocklen, blockOffset in block.step(offset, length, nbdCon.maxRequestSize):
-        if compression is True:
-            data = lz4.decompressFrame(reader.read(blocklen))
+        if codec is not None:
+            data = codec.decompress(reader.read(blocklen))
             nbdCon.nbd.pwrite(data, offset)
             offset += len(data)
             wSize += len(data)
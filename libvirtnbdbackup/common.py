@@ -25,7 +25,7 @@ import signal
 import shutil
 import pprint
 from time import time
-from threading import current_thread
+from threading import current_thread, local
 from argparse import Namespace
 from typing import Optional, List, Any, Union, Dict
 from tqdm import tqdm
@@ -49,7 +49,9 @@ logFormatColored = (
 )
 
 logDateFormat = "[%Y-%m-%d %H:%M:%S]"
+_logContext = local()
 defaultCheckpointName = "virtnbdbackup"
+sizeUnits = {"K": 1024, "M": 1024**2, "G": 1024**3}
 
 
 def argparse(parser) -> Namespace:
@@ -71,6 +73,36 @@ def humanize(num, suffix="B"):
     return f"{num:.1f}Yi{suffix}"
 
 
+def parseSize(value: str) -> int:
+    """Parse size in bytes, suffix K, M or G may be used"""
+    value = value.strip().upper().rstrip("B")
+    factor = 1
+    if value and value[-1] in sizeUnits:
+        factor = sizeUnits[value[-1]]
+        value = value[:-1]
+    size = int(float(value) * factor)
+    if size < 0:
+        raise ValueError("Size must not be negative")
+    return size
+
+
+def setLogDomain(name: str) -> None:
+    """Set domain name log messages issued by the current thread
+    are attributed to"""
+    _logContext.domain = name
+
+
+class DomainFilter(logging.Filter):
+    """Pass only log messages issued during backup of domain"""
+
+    def __init__(self, domain: str) -> None:
+        super().__init__()
+        self.domain = domain
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return getattr(_logContext, "domain", "") == self.domain
+
+
 def setThreadName(tn="main") -> None:
     """Set thread name reported by logging function"""
     current_thread().name = tn
@@ -306,17 +338,17 @@ def dumpExtentJson(extents) -> str:
 
 def dumpMetaData(dataFile: str, stream):
     """read metadata header"""
-    with output.openfile(dataFile, "rb") as reader:
+    with output.openstream(dataFile) as reader:
         _, _, length = stream.readFrame(reader)
         return stream.loadMetadata(reader.read(length))
 
 
-def isCompressed(meta: Dict[str, str]) -> bool:
+def isCompressed(meta: Dict[str, Any]) -> bool:
     """Return true if stream is compressed"""
     try:
-        version = meta["stream-version"] == 2
+        version = meta["stream-version"] >= 2
     except KeyError:
-        version = meta["streamVersion"] == 2
+        version = meta["streamVersion"] >= 2
 
     if version:
         if meta["compressed"] is not False:
@@ -18,4 +18,4 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 __title__ = "extenthandler"
 __version__ = "0.1"
 
-from .extenthandler import ExtentHandler
+from .extenthandler import ExtentHandler, ExtentStream, coalesce
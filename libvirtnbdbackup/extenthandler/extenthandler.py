@@ -15,15 +15,40 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import time
 import logging
-from typing import List, Any, Generator, Dict
+import threading
+from array import array
+from itertools import compress
+from collections import deque
+from functools import partial
+from typing import List, Dict, Tuple, Iterator, Generator, Optional, Deque
 from nbd import CONTEXT_BASE_ALLOCATION
-from libvirtnbdbackup.objects import Extent, _ExtentObj
+from libvirtnbdbackup.objects import Extent, ExtentList
 from libvirtnbdbackup.common import humanize, safeInfo
 
+try:
+    import numpy
+
+    HAVE_NUMPY = True
+except ImportError:
+    HAVE_NUMPY = False
+
 log = logging.getLogger("extenthandler")
 
 
+class _Range:
+    """Range of the disk queried by block status requests"""
+
+    __slots__ = ("offset", "length", "covered", "entries")
+
+    def __init__(self, offset: int, length: int, contexts: List[str]) -> None:
+        self.offset = offset
+        self.length = length
+        self.covered: int = 0
+        self.entries: Dict[str, array] = {context: array("Q") for context in contexts}
+
+
 # pylint: disable=too-many-instance-attributes
 class ExtentHandler:
     """Query extent information about allocated and
@@ -31,20 +56,31 @@ class ExtentHandler:
 
     This implementation should return the same
     extent information as nbdinfo or qemu-img map
+
+    The disk is split into ranges, multiple block status requests
+    are kept in flight on the connection. If a separate connection
+    for base:allocation is passed, the allocation status is only
+    queried for the dirty regions.
+
+    The allocated regions found are kept, along with the dirty
+    regions if the allocation status was queried for those only.
     """
 
-    def __init__(self, nbdFh, cType, no_sparse_detection: bool) -> None:
+    def __init__(self, nbdFh, cType, no_sparse_detection: bool, baseFh=None) -> None:
         self.useQemu = False
         self._maxRequestBlock: int = 4294967295
         self._align: int = 512
-        self.lastExtentLen: int = 0
-        self.offset: int = 0
+        self._queueDepth: int = 16
+        self._minRangeSize: int = 64 * 1024 * 1024
+        self.allocation: Optional[ExtentList] = None
+        self.dirty: Optional[ExtentList] = None
 
         if nbdFh.__class__.__name__ == "util":
             self.useQemu = True
         self._nbdFh = nbdFh
+        self._baseFh = baseFh
         self._cType = cType
-        self._extentEntries: Dict = {}
+        self._extentEntries: Dict[str, array] = {}
         self.no_sparse_detection = no_sparse_detection
 
         if cType.metaContext == "":
@@ -59,110 +95,205 @@ class ExtentHandler:
                 ctx = self._nbdFh.nbd.get_meta_context(i)
                 if self.no_sparse_detection is True and ctx == CONTEXT_BASE_ALLOCATION:
                     continue
-                self._extentEntries[ctx] = []
+                self._extentEntries[ctx] = array("Q")
         else:
             if self.no_sparse_detection is False:
-                self._extentEntries[CONTEXT_BASE_ALLOCATION] = []
-            self._extentEntries[self._metaContext] = []
+                self._extentEntries[CONTEXT_BASE_ALLOCATION] = array("Q")
+            self._extentEntries[self._metaContext] = array("Q")
 
         log.debug("Primary meta context for backup: %s", self._metaContext)
 
-    def _getExtentCallback(
-        self, metacontext: str, offset: int, entries: List, status: str
-    ) -> None:
-        """Callback function called by libnbd for each extent
-        that is returned
-        """
-        log.debug("Metacontext is: %s", metacontext)
-        log.debug("Offset is: %s", offset)
-        log.debug("Status is: %s", status)
-        self.lastExtentLen = len(self._extentEntries[self._metaContext])
-        for entry in entries:
-            self._extentEntries[metacontext].append(entry)
-        log.debug("entries: %s", len(self._extentEntries[metacontext]))
-        log.debug("Processed offsets: %s", self.offset)
-        self.offset += sum(
-            self._extentEntries[self._metaContext][self.lastExtentLen :: 2]
-        )
-        self.lastExtentLen = len(self._extentEntries[self._metaContext])
-
-    def _setRequestAligment(self) -> int:
+    def _record(self, base: ExtentList, bitmap: Optional[ExtentList] = None) -> None:
+        """Keep allocated regions, and the dirty regions if the
+        allocation status has been queried for those only"""
+        if self.allocation is None:
+            self.allocation = ExtentList(CONTEXT_BASE_ALLOCATION)
+        _extendData(self.allocation, base)
+        if bitmap is not None:
+            if self.dirty is None:
+                self.dirty = ExtentList(bitmap.context)
+            _extendData(self.dirty, bitmap)
+
+    def _setRequestAligment(self, nbdFh=None) -> int:
         """Align request size to nbd server"""
-        align = self._nbdFh.nbd.get_block_size(0)
+        align = (nbdFh or self._nbdFh).nbd.get_block_size(0)
         if align == 0:
             align = self._align
         return self._maxRequestBlock - align + 1
 
-    def queryExtents(self) -> List[Any]:
+    @staticmethod
+    def _getExtentCallback(
+        entries: Dict[str, array],
+        metacontext: str,
+        offset: int,
+        extents: List,
+        status: str,
+    ) -> None:
+        """Callback function called by libnbd for the extents
+        returned for a single request"""
+        log.debug("Metacontext: %s offset: %s status: %s", metacontext, offset, status)
+        if metacontext in entries:
+            entries[metacontext].extend(extents)
+
+    def _submit(self, handle, extentRange: _Range, inFlight: Dict) -> None:
+        """Request block status for the part of the range not
+        covered yet"""
+        entries = {context: array("Q") for context in extentRange.entries}
+        length = extentRange.length - extentRange.covered
+        log.debug("Block status request length: %s", length)
+        cookie = handle.aio_block_status(
+            length,
+            extentRange.offset + extentRange.covered,
+            partial(self._getExtentCallback, entries),
+        )
+        inFlight[cookie] = (extentRange, entries)
+
+    def _queryRanges(
+        self, nbdFh, ranges: Iterator[Tuple[int, int]], contexts: List[str]
+    ) -> Generator[Tuple[int, int, Dict[str, array]], None, None]:
+        """Query block status for the given ranges, keeping up to
+        queueDepth requests in flight. Ranges are returned in order,
+        along with the extent entries of each meta context. The
+        server may answer a request for each meta context with a
+        different length, extents are cut to the length covered by
+        all meta contexts and the remaining part is requested again.
+        """
+        handle = nbdFh.nbd
+        ranges = iter(ranges)
+        window: Deque[_Range] = deque()
+        inFlight: Dict[int, Tuple[_Range, Dict[str, array]]] = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(window) < self._queueDepth:
+                try:
+                    offset, length = next(ranges)
+                except StopIteration:
+                    exhausted = True
+                    break
+                window.append(_Range(offset, length, contexts))
+                self._submit(handle, window[-1], inFlight)
+            if window and window[0].covered == window[0].length:
+                extentRange = window.popleft()
+                yield extentRange.offset, extentRange.length, extentRange.entries
+                continue
+            if not window:
+                return
+
+            completed = [c for c in inFlight if handle.aio_command_completed(c)]
+            if not completed:
+                handle.poll(-1)
+                continue
+            for cookie in completed:
+                extentRange, entries = inFlight.pop(cookie)
+                covered = min(
+                    extentRange.length - extentRange.covered,
+                    *(sum(e[0::2]) for e in entries.values()),
+                )
+                assert covered > 0
+                for context, e in entries.items():
+                    extentRange.entries[context].extend(self._truncate(e, covered))
+                extentRange.covered += covered
+                if extentRange.covered < extentRange.length:
+                    self._submit(handle, extentRange, inFlight)
+
+    def _diskRanges(self, size: int) -> Generator[Tuple[int, int], None, None]:
+        """Split disk into ranges, so they can be queried
+        concurrently"""
+        maxRequestLen = self._setRequestAligment()
+        rangeSize = max(-(-size // self._queueDepth), self._minRangeSize)
+        rangeSize = min(rangeSize + (-rangeSize % self._minRangeSize), maxRequestLen)
+        for offset in range(0, size, rangeSize):
+            yield offset, min(size - offset, rangeSize)
+
+    def queryBaseAllocation(self, bitmap: ExtentList) -> ExtentList:
+        """Query base:allocation for the dirty regions of the bitmap
+        only, so the amount of requests depends on the amount of
+        changed data instead of the disk size."""
+        maxRequestLen = self._setRequestAligment(self._baseFh)
+
+        def dirtyRanges() -> Generator[Tuple[int, int], None, None]:
+            for offset, length, data in zip(
+                bitmap.offsets, bitmap.lengths, bitmap.data
+            ):
+                if not data:
+                    continue
+                for start in range(offset, offset + length, maxRequestLen):
+                    yield start, min(offset + length - start, maxRequestLen)
+
+        base = ExtentList(CONTEXT_BASE_ALLOCATION)
+        for offset, _, entries in self._queryRanges(
+            self._baseFh, dirtyRanges(), [CONTEXT_BASE_ALLOCATION]
+        ):
+            extents = self._unifyExtents(
+                CONTEXT_BASE_ALLOCATION, entries[CONTEXT_BASE_ALLOCATION], offset
+            )
+            base.offsets.extend(extents.offsets)
+            base.lengths.extend(extents.lengths)
+            base.data.extend(extents.data)
+        log.debug("Queried allocation status of [%s] dirty regions.", sum(bitmap.data))
+
+        return base
+
+    def queryExtents(self) -> Dict[str, array]:
         """Query extents either via qemu or custom extent handler"""
         if self.useQemu:
             return self.queryExtentsQemu()
 
         return self.queryExtentsNbd()
 
-    def queryExtentsQemu(self) -> List[Any]:
+    def queryExtentsQemu(self) -> Dict[str, array]:
         """Use qemu utils to query extents from nbd server"""
-        extents = []
-        for ctx in iter(self._extentEntries):
+        for ctx, entries in self._extentEntries.items():
             for extent in self._nbdFh.map(self._cType, ctx):
-                extentObj = _ExtentObj(ctx, extent["length"], extent["type"])
-                extents.append(extentObj)
-
-        log.debug("Got %s extents from qemu command", len(extents))
+                entries.append(extent["length"])
+                entries.append(extent["type"])
 
-        return extents
+        log.debug(
+            "Got %s extents from qemu command",
+            sum(len(entries) // 2 for entries in self._extentEntries.values()),
+        )
 
-    def _extentsToObj(self) -> List[_ExtentObj]:
-        """Go through extents and create a list of extent objects"""
-        extentList = []
-        for context, values in self._extentEntries.items():
-            extentSizes = values[0::2]
-            extentTypes = values[1::2]
-            assert len(extentSizes) == len(extentTypes)
-            ct = 0
-            while ct < len(extentSizes):
-                extentObj = _ExtentObj(context, extentSizes[ct], extentTypes[ct])
-                extentList.append(extentObj)
-                ct += 1
-
-        return extentList
+        return self._extentEntries
 
-    @staticmethod
-    def _unifyExtents(extentObjects: List[_ExtentObj]) -> Generator:
+    def _unifyExtents(
+        self, context: str, entries: array, offset: int = 0
+    ) -> ExtentList:
         """Unify extents. If a sequence of extents has the
         same type (data or zero) it is better to unify them
         into a bigger block, so during backup, less requests
         to the nbd server have to be sent
         """
-        log.debug("Attempting to unify %s extents", len(extentObjects))
-        cur = None
-        for myExtent in extentObjects:
-            if cur is None:
-                cur = myExtent
-            elif cur.type == myExtent.type and cur.context == myExtent.context:
-                cur.length += myExtent.length
-            else:
-                yield cur
-                cur = myExtent
+        extentSizes = entries[0::2]
+        extentTypes = entries[1::2]
+        assert len(extentSizes) == len(extentTypes)
+        log.debug("Attempting to unify %s extents", len(extentSizes))
+        extents = ExtentList(context)
+        start: int = offset
+        curType = None
+        for length, blockType in zip(extentSizes, extentTypes):
+            if blockType != curType:
+                if curType is not None:
+                    extents.append(
+                        start, offset - start, self.setBlockType(context, curType)
+                    )
+                start = offset
+                curType = blockType
+            offset += length
+        if curType is not None:
+            extents.append(start, offset - start, self.setBlockType(context, curType))
 
-        yield cur
+        return extents
 
-    def queryExtentsNbd(self) -> List[_ExtentObj]:
+    def queryExtentsNbd(self) -> Dict[str, array]:
         """Request used blocks/extents from the nbd service"""
-        maxRequestLen = self._setRequestAligment()
         size = self._nbdFh.nbd.get_size()
-        while self.offset < size:
-            if size < maxRequestLen:
-                request_length = size
-            else:
-                request_length = min(size - self.offset, maxRequestLen)
-            log.debug("Block status request length: %s", request_length)
-            self._nbdFh.nbd.block_status(
-                request_length, self.offset, self._getExtentCallback
-            )
-            log.debug("Extents: %s", self._extentEntries)
+        for _, _, entries in self._queryRanges(
+            self._nbdFh, self._diskRanges(size), list(self._extentEntries)
+        ):
+            for context, extents in entries.items():
+                self._extentEntries[context].extend(extents)
 
-        return self._extentsToObj()
+        return self._extentEntries
 
     def setBlockType(self, context: str, blockType: int) -> bool:
         """Returns block type
@@ -196,58 +327,106 @@ class ExtentHandler:
         assert data is not None
         return data
 
-    def overlap(self, extents: List[Extent]) -> List[Extent]:
-        """Find overlaps between base allocation and incremental bitmap to detect zero regions"""
-        base_extents = [e for e in extents if e.context == CONTEXT_BASE_ALLOCATION]
-        backup_extents = [
-            e for e in extents if e.context == self._metaContext and e.data
-        ]
-
-        totalLength: int = 0
-        result = []
-        i = 0  # index for base_extents
-        j = 0  # index for backup_extents
-        while i < len(base_extents) and j < len(backup_extents):
-            base = base_extents[i]
-            backup = backup_extents[j]
+    @staticmethod
+    def overlapLoop(base: ExtentList, bitmap: ExtentList) -> ExtentList:
+        """Intersect data extents by walking both extent lists"""
+        debug = log.isEnabledFor(logging.DEBUG)
+        baseOffsets, baseLengths, baseData = base.offsets, base.lengths, base.data
+        bitmapOffsets, bitmapLengths, bitmapData = (
+            bitmap.offsets,
+            bitmap.lengths,
+            bitmap.data,
+        )
 
-            log.debug(
-                "base: %d:%d(%s) bitmap: %d:%d(%s)",
-                base.length,
-                base.offset,
-                str(base.data),
-                backup.length,
-                backup.offset,
-                str(backup.data),
-            )
+        result = ExtentList(base.context)
+        i = 0  # index for base extents
+        j = 0  # index for bitmap extents
+        while i < len(baseOffsets) and j < len(bitmapOffsets):
+            baseStart = baseOffsets[i]
+            baseEnd = baseStart + baseLengths[i]
+            backupStart = bitmapOffsets[j]
+            backupEnd = backupStart + bitmapLengths[j]
+
+            if debug:
+                log.debug(
+                    "base: %d:%d(%s) bitmap: %d:%d(%s)",
+                    baseLengths[i],
+                    baseStart,
+                    str(bool(baseData[i])),
+                    bitmapLengths[j],
+                    backupStart,
+                    str(bool(bitmapData[j])),
+                )
 
             # Skip if either extent has data=False or no real intersection
-            if not base.data or base.offset + base.length <= backup.offset:
+            if not baseData[i] or baseEnd <= backupStart:
                 i += 1
                 continue
-            if not backup.data or backup.offset + backup.length <= base.offset:
+            if not bitmapData[j] or backupEnd <= baseStart:
                 j += 1
                 continue
 
-            offset = max(base.offset, backup.offset)
-            end = min(backup.offset + backup.length, base.offset + base.length)
-            log.debug("-->: %d:%d", offset, end - offset)
-            result.append(
-                Extent(
-                    context=base.context,
-                    data=True,
-                    offset=offset,
-                    length=end - offset,
-                )
-            )
-            totalLength += end - offset
+            offset = max(baseStart, backupStart)
+            end = min(backupEnd, baseEnd)
+            if debug:
+                log.debug("-->: %d:%d", offset, end - offset)
+            result.append(offset, end - offset, True)
 
             # advance
-            if end == base.offset + base.length:
+            if end == baseEnd:
                 i += 1
-            if end == backup.offset + backup.length:
+            if end == backupEnd:
                 j += 1
 
+        return result
+
+    @staticmethod
+    def overlapVector(base: ExtentList, bitmap: ExtentList) -> ExtentList:
+        """Intersect data extents using numpy: data extents of both
+        lists are sorted and do not overlap, so the base extents
+        intersecting each bitmap extent are found by binary search"""
+
+        def dataRanges(extents: ExtentList):
+            data = numpy.frombuffer(extents.data, dtype=numpy.uint8) != 0
+            starts = numpy.frombuffer(extents.offsets, dtype=numpy.uint64)[data]
+            lengths = numpy.frombuffer(extents.lengths, dtype=numpy.uint64)[data]
+            return starts, starts + lengths
+
+        baseStarts, baseEnds = dataRanges(base)
+        bitmapStarts, bitmapEnds = dataRanges(bitmap)
+        first = numpy.searchsorted(baseEnds, bitmapStarts, side="right")
+        last = numpy.searchsorted(baseStarts, bitmapEnds, side="left")
+        counts = numpy.maximum(last.astype(numpy.int64) - first, 0)
+        bitmapIndex = numpy.repeat(numpy.arange(len(counts)), counts)
+        baseIndex = (
+            numpy.arange(int(counts.sum()))
+            - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+            + numpy.repeat(first, counts)
+        )
+        starts = numpy.maximum(baseStarts[baseIndex], bitmapStarts[bitmapIndex])
+        ends = numpy.minimum(baseEnds[baseIndex], bitmapEnds[bitmapIndex])
+        keep = ends > starts
+
+        result = ExtentList(base.context)
+        result.offsets.frombytes(starts[keep].tobytes())
+        result.lengths.frombytes((ends - starts)[keep].tobytes())
+        result.data.frombytes(b"\x01" * len(result.offsets))
+        return result
+
+    def _intersect(self, base: ExtentList, bitmap: ExtentList) -> ExtentList:
+        """Intersect data extents, vectorised if numpy is installed"""
+        if len(base) == 0 or len(bitmap) == 0:
+            return ExtentList(base.context)
+        if HAVE_NUMPY and not log.isEnabledFor(logging.DEBUG):
+            return self.overlapVector(base, bitmap)
+        return self.overlapLoop(base, bitmap)
+
+    def overlap(self, base: ExtentList, bitmap: ExtentList) -> ExtentList:
+        """Find overlaps between base allocation and incremental bitmap
+        to detect zero regions"""
+        result = self._intersect(base, bitmap)
+
+        totalLength = result.dataSize
         if totalLength > 0:
             safeInfo(
                 "Detected %d bytes [%s] non-sparse blocks for current bitmap.",
@@ -257,43 +436,276 @@ class ExtentHandler:
 
         return result
 
-    def queryBlockStatus(self) -> List[Extent]:
+    def queryBlockStatus(self) -> ExtentList:
         """Check the status for each extent, whether if it is
-        real data or zeroes, return a list of extent objects
+        real data or zeroes, return extents of the primary
+        meta context
         """
         safeInfo("Start receiving backup extents.")
-        extents = self.queryExtents()
+        entries = self.queryExtents()
         safeInfo("Finished receiving extents.")
-        extentList: List[Extent] = []
-        start: int = 0
-        baseStart: int = 0
-        totalLength: int = 0
-        for extent in self._unifyExtents(extents):
-            extObj = Extent(
-                extent.context,
-                self.setBlockType(extent.context, extent.type),
-                baseStart if extent.context == CONTEXT_BASE_ALLOCATION else start,
-                extent.length,
-            )
-            extentList.append(extObj)
-            if extent.context == CONTEXT_BASE_ALLOCATION:
-                baseStart += extent.length
-            else:
-                start += extent.length
-                if extObj.data:
-                    totalLength += extent.length
-            log.debug(
-                "%s %d %d %d",
-                extObj.context,
-                extObj.data,
-                extObj.offset,
-                extObj.offset + extObj.length,
-            )
+        extents: Dict[str, ExtentList] = {}
+        for context in list(entries):
+            extents[context] = self._unifyExtents(context, entries.pop(context))
+            if log.isEnabledFor(logging.DEBUG):
+                for extObj in extents[context]:
+                    log.debug(
+                        "%s %d %d %d",
+                        extObj.context,
+                        extObj.data,
+                        extObj.offset,
+                        extObj.offset + extObj.length,
+                    )
         if self.no_sparse_detection is True:
             safeInfo("Skipping detection of sparse/fstrimmed blocks.")
-            return extentList
+            return extents[self._metaContext]
 
+        if self._baseFh is not None:
+            bitmap = extents[self._metaContext]
+            base = self.queryBaseAllocation(bitmap)
+            self._record(base, bitmap)
+            return self.overlap(base, bitmap)
+
+        self._record(extents[CONTEXT_BASE_ALLOCATION])
         if self._metaContext != CONTEXT_BASE_ALLOCATION:
-            log.debug("Detected [%d] bytes of changed data regions.", totalLength)
-            extentList = self.overlap(extentList)
-        return extentList
+            log.debug(
+                "Detected [%d] bytes of changed data regions.",
+                extents[self._metaContext].dataSize,
+            )
+            return self.overlap(
+                extents[CONTEXT_BASE_ALLOCATION], extents[self._metaContext]
+            )
+        return extents[self._metaContext]
+
+    @staticmethod
+    def _truncate(entries: array, length: int) -> array:
+        """Return the extent entries covering the first length bytes"""
+        result = array("Q")
+        for i in range(0, len(entries), 2):
+            if length == 0:
+                break
+            extentLength = min(entries[i], length)
+            result.append(extentLength)
+            result.append(entries[i + 1])
+            length -= extentLength
+
+        return result
+
+    def streamBlockStatus(
+        self, size: int
+    ) -> Generator[Tuple[int, ExtentList], None, None]:
+        """Return the extents of the primary meta context for each
+        range of the disk as soon as it has been queried, along with
+        the offset up to which the disk has been queried. Extents of
+        the same type are not unified across ranges."""
+        if self.useQemu:
+            yield size, self.queryBlockStatus()
+            return
+
+        safeInfo("Start receiving backup extents.")
+        for offset, length, entries in self._queryRanges(
+            self._nbdFh, self._diskRanges(size), list(self._extentEntries)
+        ):
+            extents: Dict[str, ExtentList] = {}
+            for context, contextEntries in entries.items():
+                extents[context] = self._unifyExtents(context, contextEntries, offset)
+            offset += length
+            if self.no_sparse_detection is True:
+                yield offset, extents[self._metaContext]
+            elif self._baseFh is not None:
+                bitmap = extents[self._metaContext]
+                base = self.queryBaseAllocation(bitmap)
+                self._record(base, bitmap)
+                yield offset, self._intersect(base, bitmap)
+            elif self._metaContext == CONTEXT_BASE_ALLOCATION:
+                self._record(extents[self._metaContext])
+                yield offset, extents[self._metaContext]
+            else:
+                self._record(extents[CONTEXT_BASE_ALLOCATION])
+                yield offset, self._intersect(
+                    extents[CONTEXT_BASE_ALLOCATION], extents[self._metaContext]
+                )
+
+
+def _extendData(target: ExtentList, extents: ExtentList) -> None:
+    """Append the data extents"""
+    count = len(target)
+    target.offsets.extend(compress(extents.offsets, extents.data))
+    target.lengths.extend(compress(extents.lengths, extents.data))
+    target.data.extend([1] * (len(target.offsets) - count))
+
+
+def _coalesce(extents: ExtentList, maxGap: int) -> Tuple[ExtentList, int]:
+    """Merge data extents separated by gaps of up to maxGap bytes,
+    returns merged extents and the amount of data within the gaps"""
+    result = ExtentList(extents.context)
+    pending: List = []
+    start: int = -1
+    end: int = 0
+    extra: int = 0
+    dataCount: int = 0
+    for offset, length, data in zip(extents.offsets, extents.lengths, extents.data):
+        if not data:
+            pending.append((offset, length))
+            continue
+        dataCount += 1
+        if start >= 0 and offset - end <= maxGap:
+            extra += offset - end
+            end = offset + length
+            pending = []
+            continue
+        if start >= 0:
+            result.append(start, end - start, True)
+        for zeroOffset, zeroLength in pending:
+            result.append(zeroOffset, zeroLength, False)
+        pending = []
+        start = offset
+        end = offset + length
+    if start >= 0:
+        result.append(start, end - start, True)
+    for zeroOffset, zeroLength in pending:
+        result.append(zeroOffset, zeroLength, False)
+
+    return result, extra
+
+
+def coalesce(extents: ExtentList, maxGap: int) -> ExtentList:
+    """Merge data extents separated by gaps of up to maxGap bytes,
+    so fewer but larger read requests are sent. Data within the gaps
+    is read and saved as well."""
+    result, extra = _coalesce(extents, maxGap)
+    safeInfo(
+        "Coalesced [%s] data extents into [%s], reading [%s] of additional data.",
+        sum(extents.data),
+        sum(result.data),
+        humanize(extra),
+    )
+
+    return result
+
+
+class ExtentStream:
+    """Extents of a disk, queried by a background thread while the
+    data is already being saved. The extents can be iterated
+    multiple times, iteration blocks until further extents are
+    received.
+
+    As long as the query is running, the amount of data to save is
+    estimated: either from the size passed, such as the checkpoint
+    size reported by libvirt, or extrapolated from the data found
+    within the range queried so far."""
+
+    def __init__(
+        self,
+        batches: Iterator[Tuple[int, ExtentList]],
+        size: int,
+        estimate: int = 0,
+        maxGap: int = 0,
+    ) -> None:
+        self._cond = threading.Condition()
+        self._batches: List[ExtentList] = []
+        self._error: Optional[Exception] = None
+        self._stop: bool = False
+        self._size = size
+        self._estimate = estimate
+        self._maxGap = maxGap
+        self._extra: int = 0
+        self._dataCount: int = 0
+        self._coalescedCount: int = 0
+        self._started = time.perf_counter()
+        self.finished: bool = False
+        self.elapsed: float = 0.0
+        self.offset: int = 0
+        self.count: int = 0
+        self.size: int = 0
+        self._thread = threading.Thread(
+            target=self._query,
+            args=(batches,),
+            name=f"{threading.current_thread().name}.extents",
+            daemon=True,
+        )
+        self._thread.start()
+        with self._cond:
+            while not self._batches and not self.finished:
+                self._cond.wait()
+
+    def _query(self, batches: Iterator[Tuple[int, ExtentList]]) -> None:
+        """Receive extents until the whole disk has been queried"""
+        try:
+            for offset, extents in batches:
+                dataCount = sum(extents.data)
+                extra = 0
+                if self._maxGap > 0:
+                    extents, extra = _coalesce(extents, self._maxGap)
+                with self._cond:
+                    self._batches.append(extents)
+                    self._dataCount += dataCount
+                    self._coalescedCount += sum(extents.data)
+                    self._extra += extra
+                    self.offset = offset
+                    self.count += len(extents)
+                    self.size += extents.dataSize
+                    self._cond.notify_all()
+                    if self._stop:
+                        return
+        except Exception as e:  # pylint: disable=broad-except
+            self._error = e
+        finally:
+            with self._cond:
+                self.finished = True
+                self.elapsed = time.perf_counter() - self._started
+                self._cond.notify_all()
+
+        if self._error is not None:
+            return
+        safeInfo(
+            "Finished receiving [%s] extents, [%s] of data extents to backup.",
+            self.count,
+            humanize(self.size),
+        )
+        if self._maxGap > 0:
+            safeInfo(
+                "Coalesced [%s] data extents into [%s], "
+                "reading [%s] of additional data.",
+                self._dataCount,
+                self._coalescedCount,
+                humanize(self._extra),
+            )
+
+    def __iter__(self) -> Iterator[Extent]:
+        index: int = 0
+        while True:
+            with self._cond:
+                while index >= len(self._batches) and not self.finished:
+                    self._cond.wait()
+                if index >= len(self._batches):
+                    if self._error is not None:
+                        raise self._error
+                    return
+                extents = self._batches[index]
+            index += 1
+            yield from extents
+
+    def __len__(self) -> int:
+        return self.count
+
+    @property
+    def dataSize(self) -> int:
+        """Sum of all data extents, estimated until all extents
+        have been received"""
+        with self._cond:
+            if self.finished:
+                return self.size
+            if self._estimate > 0:
+                return max(self._estimate, self.size)
+            if self.offset == 0:
+                return self._size
+            return min(
+                self._size, max(self.size, self.size * self._size // self.offset)
+            )
+
+    def close(self) -> None:
+        """Stop receiving extents"""
+        with self._cond:
+            self._stop = True
+        self._thread.join()
@@ -16,6 +16,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import logging
+from typing import Union
 import lz4.frame
 
 log = logging.getLogger()
@@ -28,7 +29,7 @@ def decompressFrame(data: bytes) -> bytes:
     return lz4.frame.decompress(data)
 
 
-def compressFrame(data: bytes, level: int) -> bytes:
+def compressFrame(data: Union[bytes, memoryview], level: int) -> bytes:
     """Compress block with to lz4 frame, checksums
     enabled for safety
     """
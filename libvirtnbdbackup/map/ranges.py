@@ -36,10 +36,13 @@ def _parse(stream, sTypes, reader) -> Tuple[List, Dict]:
         raise RestoreError from errmsg
 
     if lib.isCompressed(meta):
-        logging.error("Mapping compressed images currently not supported.")
+        logging.error(
+            "Mapping compressed images currently not supported, method: [%s].",
+            meta.get("compressionMethod", "lz4"),
+        )
         raise RestoreError
 
-    assert reader.read(len(sTypes.TERM)) == sTypes.TERM
+    stream.readTerm(reader)
 
     dataRanges: List = []
     count: int = 0
@@ -61,9 +64,9 @@ def _parse(stream, sTypes, reader) -> Tuple[List, Dict]:
 
         if kind == sTypes.DATA:
             reader.seek(length, os.SEEK_CUR)
-            assert reader.read(len(sTypes.TERM)) == sTypes.TERM
+            stream.readTerm(reader)
 
-        nextBlockOffset = reader.tell() + sTypes.FRAME_LEN
+        nextBlockOffset = reader.tell() + stream.frameLength
         blockInfo["nextBlockOffset"] = nextBlockOffset
         dataRanges.append(blockInfo)
         count += 1
@@ -75,6 +78,12 @@ def get(args, stream, sTypes, dataFiles: List) -> List:
     """Get data ranges for each file specified"""
     dataRanges = []
     for dFile in dataFiles:
+        if output.repository.isManifest(dFile):
+            logging.error(
+                "[%s]: Mapping backups saved to chunk repository not supported.",
+                dFile,
+            )
+            raise RestoreError("Unsupported backup file")
         try:
             reader = output.openfile(dFile, "rb")
         except OutputException as e:
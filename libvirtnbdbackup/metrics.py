@@ -0,0 +1,303 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import atexit
+import time
+import logging
+import threading
+from argparse import Namespace
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Dict, List, Optional, Tuple
+
+log = logging.getLogger("metrics")
+
+PREFIX = "virtnbdbackup"
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# buckets for NBD request duration in seconds
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Registry:
+    """Collect counters, gauges and histograms, exposed in the
+    Prometheus text format, as expected by both Prometheus and the
+    node exporter textfile collector. Metrics are only collected
+    if an exporter has been started."""
+
+    def __init__(self) -> None:
+        self.enabled: bool = False
+        self._lock = threading.Lock()
+        self._families: Dict[str, Tuple[str, str]] = {}
+        self._samples: Dict[str, Dict[Labels, float]] = {}
+        self._histograms: Dict[str, Dict[Labels, List[float]]] = {}
+
+    def _family(self, name: str, kind: str, text: str) -> None:
+        if name not in self._families:
+            self._families[name] = (kind, text)
+            if kind == "histogram":
+                self._histograms[name] = {}
+            else:
+                self._samples[name] = {}
+
+    def inc(self, name: str, text: str, labels: Labels, value: float = 1) -> None:
+        """Increase counter"""
+        with self._lock:
+            self._family(name, "counter", text)
+            samples = self._samples[name]
+            samples[labels] = samples.get(labels, 0) + value
+
+    def set(self, name: str, text: str, labels: Labels, value: float) -> None:
+        """Set gauge"""
+        with self._lock:
+            self._family(name, "gauge", text)
+            self._samples[name][labels] = value
+
+    def observe(self, name: str, text: str, labels: Labels, value: float) -> None:
+        """Add observation to histogram"""
+        with self._lock:
+            self._family(name, "histogram", text)
+            counts = self._histograms[name].setdefault(
+                labels, [0.0] * (len(BUCKETS) + 2)
+            )
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    @staticmethod
+    def _labels(labels: Labels, extra: str = "") -> str:
+        parts = [f'{key}="{value}"' for key, value in labels]
+        if extra:
+            parts.append(extra)
+        if not parts:
+            return ""
+        return "{" + ",".join(parts) + "}"
+
+    def expose(self) -> str:
+        """Return all metrics in text format"""
+        lines: List[str] = []
+        with self._lock:
+            for name, (kind, text) in sorted(self._families.items()):
+                lines.append(f"# HELP {PREFIX}_{name} {text}")
+                lines.append(f"# TYPE {PREFIX}_{name} {kind}")
+                if kind == "histogram":
+                    for labels, counts in self._histograms[name].items():
+                        for bound, count in zip(BUCKETS, counts):
+                            le = self._labels(labels, f'le="{bound}"')
+                            lines.append(f"{PREFIX}_{name}_bucket{le} {count:g}")
+                        le = self._labels(labels, 'le="+Inf"')
+                        lines.append(f"{PREFIX}_{name}_bucket{le} {counts[-2]:g}")
+                        label = self._labels(labels)
+                        lines.append(f"{PREFIX}_{name}_count{label} {counts[-2]:g}")
+                        lines.append(f"{PREFIX}_{name}_sum{label} {counts[-1]:g}")
+                    continue
+                for labels, value in self._samples[name].items():
+                    lines.append(f"{PREFIX}_{name}{self._labels(labels)} {value:g}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+class NullStats:
+    """Discard metrics if no exporter has been started"""
+
+    def read(self, length: int, elapsed: Optional[float] = None) -> None:
+        """Discard data read"""
+
+    def queueDepth(self, depth: int) -> None:
+        """Discard NBD requests in flight"""
+
+    def written(self, length: int) -> None:
+        """Discard data written"""
+
+    def compressed(self, length: int) -> None:
+        """Discard compressed data"""
+
+    def estimate(self, total: int) -> None:
+        """Discard amount of data to process"""
+
+    def extent(self, length: int = 0) -> None:
+        """Discard processed extent"""
+
+
+class DiskStats(NullStats):
+    """Record metrics for the backup or restore of one disk, the
+    domain label is omitted if the domain is not known"""
+
+    def __init__(self, operation: str, disk: str, total: int, domain: str = "") -> None:
+        self._labels: Labels = (("operation", operation),)
+        if domain:
+            self._labels += (("domain", domain),)
+        self._labels += (("disk", disk),)
+        self._total = total
+        self._processed: int = 0
+        self._started = time.monotonic()
+        self._lock = threading.Lock()
+        registry.set("data_bytes", "Amount of data to process.", self._labels, total)
+        registry.set("eta_seconds", "Estimated time remaining.", self._labels, 0)
+
+    def _worker(self) -> Labels:
+        return self._labels + (("worker", threading.current_thread().name),)
+
+    def read(self, length: int, elapsed: Optional[float] = None) -> None:
+        """Account data read, from NBD server during backup or
+        from backup file during restore"""
+        registry.inc("read_bytes_total", "Bytes read.", self._worker(), length)
+        if elapsed is not None:
+            registry.observe(
+                "nbd_request_duration_seconds",
+                "Duration of NBD read requests.",
+                self._labels,
+                elapsed,
+            )
+
+    def queueDepth(self, depth: int) -> None:
+        """Account NBD requests in flight"""
+        registry.set("queue_depth", "NBD requests in flight.", self._worker(), depth)
+
+    def written(self, length: int) -> None:
+        """Account data written"""
+        registry.inc("written_bytes_total", "Bytes written.", self._labels, length)
+
+    def compressed(self, length: int) -> None:
+        """Account compressed data"""
+        registry.inc(
+            "compressed_bytes_total", "Bytes of compressed data.", self._labels, length
+        )
+
+    def estimate(self, total: int) -> None:
+        """Update amount of data to process, if it is only
+        estimated while the backup is running"""
+        with self._lock:
+            self._total = total
+        registry.set("data_bytes", "Amount of data to process.", self._labels, total)
+
+    def extent(self, length: int = 0) -> None:
+        """Account processed extent and update estimated time
+        remaining based on the average throughput"""
+        registry.inc("extents_total", "Extents processed.", self._labels)
+        with self._lock:
+            self._processed += length
+            processed = self._processed
+        elapsed = time.monotonic() - self._started
+        eta = 0.0
+        if 0 < processed < self._total:
+            eta = elapsed / processed * (self._total - processed)
+        registry.set("eta_seconds", "Estimated time remaining.", self._labels, eta)
+
+
+def diskStats(operation: str, disk: str, total: int, domain: str = "") -> NullStats:
+    """Return metrics for the backup or restore of one disk, which
+    are discarded if no exporter has been started"""
+    if not registry.enabled:
+        return NullStats()
+    return DiskStats(operation, disk, total, domain)
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in its own thread"""
+
+    daemon_threads = True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serve metrics via HTTP"""
+
+    def do_GET(self) -> None:  # pylint: disable=invalid-name
+        """Return metrics"""
+        if self.path not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.expose().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:  # pylint: disable=redefined-builtin
+        log.debug(format, *args)
+
+
+class Exporter:
+    """Expose metrics via HTTP endpoint and/or write them to a file
+    for the node exporter textfile collector in regular intervals."""
+
+    def __init__(self, port: int = 0, fileName: str = "", interval: int = 10) -> None:
+        self._fileName = fileName
+        self._interval = interval
+        self._stop = threading.Event()
+        self._server: Optional[_Server] = None
+        self._threads: List[threading.Thread] = []
+        if port:
+            self._server = _Server(("", port), _Handler)
+            self._start(self._server.serve_forever, "metrics.http")
+            log.info("Serving metrics on port: [%s]", port)
+        if fileName:
+            self._start(self._writer, "metrics.file")
+            log.info("Writing metrics to file: [%s]", fileName)
+
+    def _start(self, target, name: str) -> None:
+        t = threading.Thread(target=target, name=name, daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def _write(self) -> None:
+        """Write metrics to file, replaced atomically"""
+        tmpFile = f"{self._fileName}.{os.getpid()}.tmp"
+        try:
+            with open(tmpFile, "w", encoding="utf-8") as fh:
+                fh.write(registry.expose())
+            os.replace(tmpFile, self._fileName)
+        except OSError as e:
+            log.warning("Unable to write metrics file: [%s]", e)
+
+    def _writer(self) -> None:
+        while not self._stop.wait(self._interval):
+            self._write()
+
+    def stop(self) -> None:
+        """Stop exporting, final metrics are written to file"""
+        self._stop.set()
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+        for t in self._threads:
+            t.join()
+        if self._fileName:
+            self._write()
+
+
+def start(args: Namespace) -> bool:
+    """Start exporter if configured, it is stopped on exit.
+    Returns false if the exporter can't be started"""
+    if not args.metrics_port and not args.metrics_file:
+        return True
+    try:
+        exporter = Exporter(args.metrics_port, args.metrics_file)
+    except OSError as e:
+        log.error("Unable to start metrics exporter: [%s]", e)
+        return False
+    registry.enabled = True
+    atexit.register(exporter.stop)
+
+    return True
@@ -20,4 +20,7 @@ __version__ = "0.1"
 
 from libvirtnbdbackup.objects import Unix, TCP
 from .client import client
+from .reader import Reader, StripedReader, BufferPool
+from .sizer import RequestSizer
+from .scheduler import Scheduler
 from . import context
@@ -0,0 +1,321 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import queue
+import logging
+import threading
+from collections import deque
+from typing import Iterator, Tuple, Deque, Any, List, Dict, Generator, Optional
+import nbd
+
+log = logging.getLogger("reader")
+
+
+class BufferPool:
+    """Bounded pool of reusable read buffers.
+
+    Buffers are handed out as memoryview of the requested length
+    and must be returned via put() once the data has been written.
+    If the pool is exhausted, a new buffer is allocated; at most
+    count buffers are kept for reuse.
+    """
+
+    def __init__(self, count: int) -> None:
+        self._free: queue.LifoQueue = queue.LifoQueue(maxsize=max(count, 1))
+
+    def get(self, length: int) -> memoryview:
+        """Return buffer for the requested length"""
+        try:
+            buf = self._free.get_nowait()
+            if len(buf) < length:
+                buf = bytearray(length)
+        except queue.Empty:
+            buf = bytearray(length)
+
+        return memoryview(buf)[:length]
+
+    def put(self, view: memoryview) -> None:
+        """Return buffer to the pool"""
+        buf = view.obj
+        view.release()
+        try:
+            self._free.put_nowait(buf)
+        except queue.Full:
+            pass
+
+
+class Reader:
+    # pylint: disable=too-many-instance-attributes
+    """Read data blocks from the NBD server using the asynchronous
+    libnbd API.
+
+    The blocks to be read are known before the backup starts, so up
+    to queueDepth read requests are kept in flight on the connection.
+    Completed buffers are handed out in the same order the blocks
+    were requested, so the caller can write the stream sequentially.
+    If a request sizer is passed, it is informed about the duration
+    of each request. If a throttle is passed, requests are delayed
+    to stay within the configured bandwidth limit. If stats are
+    passed, request duration and queue depth are recorded.
+
+    Data is read directly into buffers taken from the pool and
+    returned as memoryview, the caller passes it back via
+    release() once written.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        nbdCon,
+        blocks: Iterator[Tuple[int, int]],
+        queueDepth: int = 1,
+        pool: Optional[BufferPool] = None,
+        sizer=None,
+        throttle=None,
+        stats=None,
+    ) -> None:
+        self._nbd = nbdCon.nbd
+        self._blocks = iter(blocks)
+        self._queueDepth = max(queueDepth, 1)
+        self._pool = pool or BufferPool(self._queueDepth + 1)
+        self._inFlight: Deque[
+            Tuple[Any, memoryview, Optional[nbd.Buffer], int, int, float]
+        ] = deque()
+        self._sizer = sizer
+        self._throttle = throttle
+        self._stats = stats
+        self._copy: bool = False
+        self.maxRequestSize = nbdCon.maxRequestSize
+        log.debug("Read queue depth: [%s]", self._queueDepth)
+
+    def _read(self, view: memoryview, offset: int) -> Tuple[Any, Optional[nbd.Buffer]]:
+        """Issue read request into the given buffer. Older libnbd
+        versions only accept nbd.Buffer objects for asynchronous
+        requests, in which case data has to be copied once the
+        request is finished."""
+        if not self._copy:
+            try:
+                return self._nbd.aio_pread(view, offset), None
+            except (TypeError, AttributeError):
+                log.debug("libnbd requires nbd.Buffer for reads, copying data.")
+                self._copy = True
+
+        buf = nbd.Buffer(len(view))
+        return self._nbd.aio_pread(buf, offset), buf
+
+    def _submit(self) -> None:
+        """Issue read requests until the queue is filled or all
+        blocks have been requested"""
+        while len(self._inFlight) < self._queueDepth:
+            try:
+                length, offset = next(self._blocks)
+            except StopIteration:
+                return
+            if self._throttle is not None:
+                self._throttle.consume(length)
+            view = self._pool.get(length)
+            cookie, buf = self._read(view, offset)
+            self._inFlight.append((cookie, view, buf, length, offset, time.monotonic()))
+
+    def _wait(self, cookie: Any) -> None:
+        """Wait until request has finished"""
+        while not self._nbd.aio_command_completed(cookie):
+            self._nbd.poll(-1)
+
+    def _complete(self) -> Tuple[int, int, memoryview]:
+        """Wait until the oldest request in flight has finished"""
+        cookie, view, buf, length, offset, started = self._inFlight.popleft()
+        try:
+            self._wait(cookie)
+        except Exception:
+            self._pool.put(view)
+            raise
+        elapsed = time.monotonic() - started
+        if self._sizer is not None:
+            self._sizer.record(length, elapsed)
+        if self._stats is not None:
+            self._stats.read(length, elapsed)
+            self._stats.queueDepth(len(self._inFlight))
+        if buf is not None:
+            view[:] = buf.to_bytearray()
+
+        self._submit()
+        return length, offset, view
+
+    def readBlocks(
+        self, blocks: List[Tuple[int, int]]
+    ) -> Generator[Tuple[int, int, memoryview], None, None]:
+        """Read the given blocks instead of the block sequence,
+        keeping up to queueDepth requests in flight"""
+        self._blocks = iter(blocks)
+        yield from self
+
+    def __iter__(self) -> Generator[Tuple[int, int, memoryview], None, None]:
+        """Return all blocks in sequence"""
+        self._submit()
+        while self._inFlight:
+            yield self._complete()
+
+    def read(self) -> Optional[Tuple[int, int, memoryview]]:
+        """Return length, offset and data of the next block in
+        sequence, None if all blocks have been read"""
+        self._submit()
+        if not self._inFlight:
+            return None
+        return self._complete()
+
+    def release(self, data: memoryview) -> None:
+        """Return buffer to the pool"""
+        self._pool.put(data)
+
+    def close(self) -> None:
+        """Wait for the requests still in flight, their buffers
+        may be written by libnbd until they have finished, and
+        return the buffers to the pool"""
+        while self._inFlight:
+            cookie, view, _, _, _, _ = self._inFlight.popleft()
+            try:
+                self._wait(cookie)
+            except nbd.Error as e:
+                log.debug("Discarding failed read request: [%s]", e)
+            self._pool.put(view)
+
+
+class StripedReader:
+    # pylint: disable=too-many-instance-attributes
+    """Stripe the blocks to be read across multiple connections
+    to the same export, if the NBD server supports it.
+
+    Block n of the sequence is read by connection n modulo the
+    amount of connections. Each connection is handled by its own
+    thread running a regular Reader, the completed buffers are
+    reassembled in the original order.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        connections: List[Any],
+        blocks: Iterator[Tuple[int, int]],
+        queueDepth: int = 1,
+        pool: Optional[BufferPool] = None,
+        sizer=None,
+        throttle=None,
+        stats=None,
+    ) -> None:
+        self._blocks = iter(blocks)
+        self._sizer = sizer
+        self._throttle = throttle
+        self._stats = stats
+        self._count = len(connections)
+        self._pool = pool or BufferPool(2 * self._count * max(queueDepth, 1) + 1)
+        self._lock = threading.Lock()
+        self._pending: Dict[int, Deque[Tuple[int, int]]] = {
+            i: deque() for i in range(self._count)
+        }
+        self._results: List[queue.Queue] = [
+            queue.Queue(maxsize=max(queueDepth, 1)) for _ in range(self._count)
+        ]
+        self._stop = threading.Event()
+        self._next: int = 0
+        self._scheduled: int = 0
+        self.maxRequestSize = connections[0].maxRequestSize
+        log.debug("Striping reads across [%s] connections", self._count)
+
+        self._threads = []
+        for i, con in enumerate(connections):
+            t = threading.Thread(
+                target=self._worker,
+                args=(i, con, queueDepth),
+                name=f"{threading.current_thread().name}.{i}",
+                daemon=True,
+            )
+            t.start()
+            self._threads.append(t)
+
+    def _blocksFor(self, index: int) -> Generator[Tuple[int, int], None, None]:
+        """Return the blocks assigned to the connection with the
+        given index, the shared block sequence is consumed only
+        as far as required."""
+        while True:
+            with self._lock:
+                while not self._pending[index]:
+                    try:
+                        blk = next(self._blocks)
+                    except StopIteration:
+                        return
+                    self._pending[self._scheduled % self._count].append(blk)
+                    self._scheduled += 1
+                blk = self._pending[index].popleft()
+            yield blk
+
+    def _put(self, index: int, item: Any) -> bool:
+        """Pass result to the consumer, give up if reader is closed"""
+        while not self._stop.is_set():
+            try:
+                self._results[index].put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, index: int, con, queueDepth: int) -> None:
+        """Read all blocks assigned to one connection"""
+        reader = Reader(
+            con,
+            self._blocksFor(index),
+            queueDepth,
+            self._pool,
+            self._sizer,
+            self._throttle,
+            self._stats,
+        )
+        try:
+            for item in reader:
+                if not self._put(index, item):
+                    self._pool.put(item[2])
+                    return
+            self._put(index, None)
+        except Exception as e:  # pylint: disable=broad-except
+            self._put(index, e)
+        finally:
+            reader.close()
+
+    def read(self) -> Optional[Tuple[int, int, memoryview]]:
+        """Return length, offset and data of the next block in
+        sequence, None if all blocks have been read"""
+        item = self._results[self._next % self._count].get()
+        self._next += 1
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def release(self, data: memoryview) -> None:
+        """Return buffer to the pool"""
+        self._pool.put(data)
+
+    def close(self) -> None:
+        """Stop worker threads and return the buffers of blocks
+        not passed to the consumer"""
+        self._stop.set()
+        for t in self._threads:
+            t.join()
+        for results in self._results:
+            while not results.empty():
+                item = results.get_nowait()
+                if isinstance(item, tuple):
+                    self._pool.put(item[2])
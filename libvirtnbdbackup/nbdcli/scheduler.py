@@ -0,0 +1,300 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from .reader import Reader, BufferPool
+
+log = logging.getLogger("scheduler")
+
+
+class Job:
+    # pylint: disable=too-many-instance-attributes
+    """Blocks to be read for one disk, along with the readers
+    for the connections to its NBD export.
+
+    Workers take batches of up to queueDepth blocks, which are read
+    with as many requests in flight. Only one worker at a time pulls
+    blocks from the sequence, outside of the scheduler lock, so a
+    sequence waiting for extents does not stall the other disks.
+    Blocks are numbered in sequence, completed blocks are kept
+    until the consumer asks for them, so the stream of each disk
+    is written in order regardless of which worker read a block.
+    Errors raised while pulling or reading blocks are passed to the
+    consumer in place of the block. Once closed, blocks still being
+    read are discarded.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self,
+        scheduler: "Scheduler",
+        connection,
+        blocks: Iterator[Tuple[int, int]],
+        size: int,
+        window: int,
+        queueDepth: int,
+        maxConnections: int,
+        connect: Callable[[], Any],
+        pool: BufferPool,
+        sizer=None,
+        throttle=None,
+        stats=None,
+    ) -> None:
+        self._scheduler = scheduler
+        self._blocks = iter(blocks)
+        self._connect = connect
+        self._pool = pool
+        self._sizer = sizer
+        self._throttle = throttle
+        self._stats = stats
+        self._queueDepth = max(queueDepth, 1)
+        self._window = max(window, self._queueDepth)
+        self._maxConnections = max(maxConnections, 1)
+        self._free: List[Reader] = [self._reader(connection)]
+        self._readers: int = 1
+        self._results: Dict[int, Any] = {}
+        self._scheduled: int = 0
+        self._next: int = 0
+        self._pulling: bool = False
+        self._exhausted: bool = False
+        self._closed: bool = False
+        self.connections: List[Any] = []
+        self.remaining: int = size
+
+    def _reader(self, connection) -> Reader:
+        """Setup reader for connection"""
+        return Reader(
+            connection,
+            iter(()),
+            self._queueDepth,
+            self._pool,
+            self._sizer,
+            self._throttle,
+            self._stats,
+        )
+
+    def ready(self) -> bool:
+        """Check if the job has blocks which can be read now"""
+        if self._exhausted or self._pulling or self._closed:
+            return False
+        if self._scheduled - self._next >= self._window:
+            return False
+        return bool(self._free) or self._readers < self._maxConnections
+
+    def take(self) -> Tuple[int, Optional[Reader]]:
+        """Reserve batch of blocks for a worker, returns amount of
+        blocks to pull and a free reader. If no reader is free, a
+        new connection has to be established by the worker."""
+        self._pulling = True
+        count = min(self._queueDepth, self._window - (self._scheduled - self._next))
+        if self._free:
+            return count, self._free.pop()
+        self._readers += 1
+        return count, None
+
+    def pull(self, count: int) -> Tuple[int, List[Tuple[int, int]]]:
+        """Pull next blocks from the sequence, called without holding
+        the scheduler lock. Returns the sequence number of the first
+        block and the blocks to read."""
+        blocks: List[Tuple[int, int]] = []
+        error: Optional[Exception] = None
+        exhausted = False
+        try:
+            while len(blocks) < count:
+                blocks.append(next(self._blocks))
+        except StopIteration:
+            exhausted = True
+        except Exception as e:  # pylint: disable=broad-except
+            error = e
+        with self._scheduler.cond:
+            seq = self._scheduled
+            self._scheduled += len(blocks)
+            self.remaining -= sum(length for length, _ in blocks)
+            if error is not None:
+                self._results[self._scheduled] = error
+                self._scheduled += 1
+                exhausted = True
+            self._exhausted = self._exhausted or exhausted
+            self._pulling = False
+            self._scheduler.cond.notify_all()
+
+        return seq, blocks
+
+    def newReader(self) -> Reader:
+        """Open additional connection to the NBD export"""
+        connection = self._connect()
+        self.connections.append(connection)
+        return self._reader(connection)
+
+    def done(self, seq: int, result: Any) -> None:
+        """Store result for block, no further blocks are read
+        once an error occurred"""
+        if isinstance(result, Exception):
+            self._exhausted = True
+        if self._closed:
+            self._discard(result)
+            return
+        self._results[seq] = result
+
+    def _discard(self, result: Any) -> None:
+        """Return buffer of block not passed to the consumer"""
+        if isinstance(result, tuple):
+            self._pool.put(result[2])
+
+    def free(self, reader: Optional[Reader]) -> None:
+        """Return reader to the job, reader is None if the connection
+        could not be established or a read has failed"""
+        if reader is not None:
+            self._free.append(reader)
+        else:
+            self._readers -= 1
+
+    def read(self) -> Optional[Tuple[int, int, memoryview]]:
+        """Return length, offset and data of the next block in
+        sequence, None if all blocks have been read"""
+        with self._scheduler.cond:
+            while self._next not in self._results:
+                if self._exhausted and self._next >= self._scheduled:
+                    return None
+                self._scheduler.cond.wait()
+            item = self._results.pop(self._next)
+            self._next += 1
+            self._scheduler.cond.notify_all()
+        if isinstance(item, Exception):
+            raise item
+
+        return item
+
+    def release(self, data: memoryview) -> None:
+        """Return buffer to the pool"""
+        self._pool.put(data)
+
+    def close(self) -> None:
+        """Wait for workers still reading blocks of the job, return
+        buffers not passed to the consumer, remove job from scheduler
+        and close additional connections"""
+        with self._scheduler.cond:
+            self._closed = True
+            while self._pulling or self._readers > len(self._free):
+                self._scheduler.cond.wait()
+            for result in self._results.values():
+                self._discard(result)
+            self._results.clear()
+            for reader in self._free:
+                reader.close()
+        self._scheduler.remove(self)
+        for connection in self.connections:
+            connection.disconnect()
+
+
+class Scheduler:
+    """Read the blocks of all disks using a shared set of worker
+    threads.
+
+    Each worker picks the next batch of blocks from the disk with
+    the most data remaining, as long as the disk has less than
+    window blocks waiting to be written. If the NBD server supports
+    multiple connections, workers open their own connection to
+    the export, so once small disks are finished all workers
+    continue reading the remaining disks.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.cond = threading.Condition()
+        self._jobs: List[Job] = []
+        self._stop: bool = False
+        self._threads = []
+        for i in range(max(workers, 1)):
+            t = threading.Thread(target=self._worker, name=f"read.{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+        log.debug("Started [%s] read workers", len(self._threads))
+
+    def add(self, *args, **kwargs) -> Job:
+        """Add the blocks of a disk, returns reader for the disk"""
+        job = Job(self, *args, **kwargs)
+        with self.cond:
+            self._jobs.append(job)
+            self.cond.notify_all()
+        return job
+
+    def remove(self, job: Job) -> None:
+        """Remove finished job"""
+        with self.cond:
+            if job in self._jobs:
+                self._jobs.remove(job)
+            self.cond.notify_all()
+
+    def _pick(self) -> Optional[Tuple[Job, int, Optional[Reader]]]:
+        """Reserve batch of the job with the most remaining data"""
+        for job in sorted(self._jobs, key=lambda j: j.remaining, reverse=True):
+            if job.ready():
+                return (job, *job.take())
+        return None
+
+    def _read(
+        self,
+        job: Job,
+        seq: int,
+        blocks: List[Tuple[int, int]],
+        reader: Optional[Reader],
+    ) -> Optional[Reader]:
+        """Read blocks and pass them to the job, returns the reader
+        or None if it can not be used anymore"""
+        try:
+            if reader is None:
+                reader = job.newReader()
+            for item in reader.readBlocks(blocks):
+                with self.cond:
+                    job.done(seq, item)
+                    self.cond.notify_all()
+                seq += 1
+        except Exception as e:  # pylint: disable=broad-except
+            if reader is not None:
+                reader.close()
+            with self.cond:
+                job.done(seq, e)
+                self.cond.notify_all()
+            return None
+        return reader
+
+    def _worker(self) -> None:
+        """Read blocks until scheduler is stopped"""
+        while True:
+            with self.cond:
+                picked = self._pick()
+                while picked is None:
+                    if self._stop:
+                        return
+                    self.cond.wait()
+                    picked = self._pick()
+            job, count, reader = picked
+            seq, blocks = job.pull(count)
+            if blocks:
+                reader = self._read(job, seq, blocks, reader)
+            with self.cond:
+                job.free(reader)
+                self.cond.notify_all()
+
+    def shutdown(self) -> None:
+        """Stop worker threads"""
+        with self.cond:
+            self._stop = True
+            self.cond.notify_all()
+        for t in self._threads:
+            t.join()
@@ -0,0 +1,115 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import time
+import logging
+import threading
+from typing import Generator, Tuple
+
+log = logging.getLogger("sizer")
+
+# lower limit for request sizes
+MIN_REQUEST_SIZE = 1024 * 1024
+
+
+class RequestSizer:
+    # pylint: disable=too-many-instance-attributes
+    """Tune the size of read requests during backup.
+
+    Starting with the maximum request size, the throughput is
+    measured for a window of completed requests. The size is
+    doubled or halved as long as throughput improves, if it gets
+    worse, the direction is reversed. Sizes are multiples of the
+    alignment (usually the qcow cluster size) and stay within the
+    limits announced by the NBD server.
+    """
+
+    def __init__(self, minSize: int, maxSize: int, align: int) -> None:
+        self.align = max(align, 1)
+        self.maxSize = max(maxSize - maxSize % self.align, self.align)
+        self.minSize = min(max(minSize, MIN_REQUEST_SIZE, self.align), self.maxSize)
+        self.minSize -= self.minSize % self.align
+        self.size = self.maxSize
+        self._lock = threading.Lock()
+        self._direction: int = -1
+        self._lastThroughput: float = 0
+        self._windowStart: float = 0
+        self._windowBytes: int = 0
+        self._requests: int = 0
+        self._latency: float = 0
+        log.debug(
+            "Request size between [%s] and [%s], alignment: [%s]",
+            self.minSize,
+            self.maxSize,
+            self.align,
+        )
+
+    def _windowSize(self) -> int:
+        """Amount of data to measure before changing size"""
+        return max(8 * self.size, 64 * 1024 * 1024)
+
+    def _adjust(self, throughput: float) -> None:
+        """Move request size in the direction of better throughput"""
+        if throughput < self._lastThroughput * 0.95:
+            self._direction = -self._direction
+        elif throughput < self._lastThroughput * 1.05:
+            self._lastThroughput = max(throughput, self._lastThroughput)
+            return
+        self._lastThroughput = throughput
+
+        size = self.size * 2 if self._direction > 0 else self.size // 2
+        size = min(max(size, self.minSize), self.maxSize)
+        size -= size % self.align
+        if size == self.size:
+            self._direction = -self._direction
+            return
+        log.debug(
+            "Throughput [%.1f] MiB/s, average latency [%.3f]s: request size [%s]",
+            throughput / 1024 / 1024,
+            self._latency / max(self._requests, 1),
+            size,
+        )
+        self.size = size
+
+    def record(self, length: int, elapsed: float) -> None:
+        """Account completed request"""
+        with self._lock:
+            now = time.monotonic()
+            if self._windowBytes == 0:
+                self._windowStart = now - elapsed
+            self._windowBytes += length
+            self._requests += 1
+            self._latency += elapsed
+            if self._windowBytes < self._windowSize():
+                return
+            duration = max(now - self._windowStart, 1e-6)
+            self._adjust(self._windowBytes / duration)
+            self._windowBytes = 0
+            self._requests = 0
+            self._latency = 0
+
+    def step(self, offset: int, length: int) -> Generator[Tuple[int, int], None, None]:
+        """Split extent into blocks of the current request size,
+        blocks end at aligned offsets, except for the last one.
+        Extents not exceeding the minimum size are never split."""
+        end = offset + length
+        while offset < end:
+            blockEnd = min(offset + self.size, end)
+            if blockEnd < end:
+                blockEnd -= blockEnd % self.align
+            yield blockEnd - offset, offset
+            offset = blockEnd
@@ -16,6 +16,9 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 import ipaddress
+from array import array
+from itertools import compress
+from typing import Iterator
 from dataclasses import dataclass
 
 
@@ -93,16 +96,50 @@ class Extent:
     """Extent description containing information if block contains
     data, offset and length of data to be read/written"""
 
+    __slots__ = ("context", "data", "offset", "length")
+
     context: str
     data: bool
     offset: int
     length: int
 
 
-@dataclass
-class _ExtentObj:
-    """Single Extent object as returned from the NBD server"""
-
-    context: str
-    length: int
-    type: int
+class ExtentList:
+    """Extents of a single meta context, stored in parallel arrays
+    instead of one object per extent, as disks may have millions of
+    extents. Extent objects are only created while iterating."""
+
+    __slots__ = ("context", "offsets", "lengths", "data")
+
+    def __init__(self, context: str) -> None:
+        self.context = context
+        self.offsets = array("Q")
+        self.lengths = array("Q")
+        self.data = array("B")
+
+    def append(self, offset: int, length: int, data: bool) -> None:
+        """Add extent"""
+        self.offsets.append(offset)
+        self.lengths.append(length)
+        self.data.append(data)
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, index: int) -> Extent:
+        return Extent(
+            self.context,
+            bool(self.data[index]),
+            self.offsets[index],
+            self.lengths[index],
+        )
+
+    def __iter__(self) -> Iterator[Extent]:
+        context = self.context
+        for offset, length, data in zip(self.offsets, self.lengths, self.data):
+            yield Extent(context, bool(data), offset, length)
+
+    @property
+    def dataSize(self) -> int:
+        """Sum of all data extents"""
+        return sum(compress(self.lengths, self.data))
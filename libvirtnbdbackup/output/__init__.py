@@ -16,5 +16,14 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
 from .target.directory import Directory
+from .target import repository
 
 openfile = Directory().open
+
+
+def openstream(fileName: str):
+    """Open backup stream for reading, manifests referencing
+    a chunk repository are resolved transparently"""
+    if repository.isManifest(fileName):
+        return repository.ManifestReader(fileName)
+    return openfile(fileName, "rb")
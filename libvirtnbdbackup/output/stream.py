@@ -19,6 +19,7 @@ from argparse import Namespace
 from typing import Union
 from libvirtnbdbackup.output.target.directory import Directory
 from libvirtnbdbackup.output.target.zip import Zip
+from libvirtnbdbackup.output.target.repository import Repository
 
 
 def get(
@@ -27,7 +28,9 @@ def get(
     """Get filehandle for output files based on output
     mode"""
     fileStream: Union[Directory, Zip]
-    if args.stdout is False:
+    if args.stdout is False and args.repository is not None:
+        fileStream = Repository(args.repository)
+    elif args.stdout is False:
         fileStream = Directory()
     else:
         fileStream = Zip()
@@ -17,11 +17,11 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import os
 import sys
-import zlib
 import logging
 import builtins
-from typing import IO, Union, Any
+from typing import IO, Union, Any, Sequence, Dict
 from libvirtnbdbackup.output import exceptions
+from libvirtnbdbackup import checksum
 
 if sys.version_info >= (3, 8):
     from typing import Literal
@@ -30,13 +30,16 @@ else:
 
 log = logging.getLogger("directory")
 
+# maximum amount of buffers passed to a single writev call
+IOV_MAX = os.sysconf("SC_IOV_MAX") if hasattr(os, "sysconf") else 1024
+
 
 class Directory:
     """Backup to target directory"""
 
     def __init__(self) -> None:
         self.fileHandle: IO[Any]
-        self.chksum: int = 1
+        self.hasher = checksum.Hasher()
 
     def create(self, targetDir) -> None:
         """Create wrapper"""
@@ -69,13 +72,32 @@ class Directory:
                 f"Opening target file [{targetFile}] failed: {e}"
             ) from e
 
-    def write(self, data: bytes) -> int:
-        """Write wrapper"""
-        self.chksum = zlib.adler32(data, self.chksum)
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        """Write wrapper, data is hashed while being written"""
+        pending = self.hasher.update([data])
         written = self.fileHandle.write(data)
+        pending.result()
         assert written == len(data)
         return written
 
+    def writev(self, buffers: Sequence[Union[bytes, memoryview]]) -> int:
+        """Write multiple buffers with as few system calls as
+        possible, checksum is updated over the same buffers
+        while they are written."""
+        pending = self.hasher.update(buffers)
+        self.fileHandle.flush()
+        fd = self.fileHandle.fileno()
+        views = [memoryview(data).cast("B") for data in buffers]
+        total = sum(len(view) for view in views)
+        while views:
+            written = os.writev(fd, views[:IOV_MAX])
+            while views and written >= len(views[0]):
+                written -= len(views.pop(0))
+            if written:
+                views[0] = views[0][written:]
+        pending.result()
+        return total
+
     def read(self, size=-1) -> int:
         """Read wrapper"""
         return self.fileHandle.read(size)
@@ -98,13 +120,12 @@ class Directory:
         """Close wrapper"""
         log.debug("Close file")
         self.fileHandle.close()
+        self.hasher.close()
 
     def seek(self, tgt: int, whence: int = 0) -> int:
         """Seek wrapper"""
         return self.fileHandle.seek(tgt, whence)
 
-    def checksum(self) -> int:
-        """Return computed checksum"""
-        cur = self.chksum
-        self.chksum = 1
-        return cur
+    def checksum(self) -> Dict[str, Any]:
+        """Return computed file and block digests"""
+        return self.hasher.result()
@@ -0,0 +1,267 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import os
+import json
+import struct
+import hashlib
+import logging
+import builtins
+import threading
+from typing import IO, Any, List, Tuple, Union, Sequence
+from libvirtnbdbackup.output import exceptions
+from libvirtnbdbackup.output.target.directory import Directory
+
+log = logging.getLogger("repository")
+
+MAGIC = b"virtnbdbackup-manifest-1\n"
+# writes smaller than this are stored inline in the manifest
+INLINE_LIMIT = 4096
+CHUNK_SIZE = 1024 * 1024
+DIGEST_SIZE = 32
+RECORD = struct.Struct(">cQ")
+INLINE = b"I"
+CHUNK = b"C"
+
+
+def isManifest(fileName: str) -> bool:
+    """Check if file is a manifest referencing a chunk repository"""
+    try:
+        with builtins.open(fileName, "rb") as fh:
+            return fh.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def chunkPath(repository: str, digest: str) -> str:
+    """Return path of chunk within the repository"""
+    return os.path.join(repository, "chunks", digest[:2], digest)
+
+
+class Repository(Directory):
+    """Backup to content addressed chunk repository.
+
+    The data written is split into chunks which are saved once
+    within the repository, identified by their blake2b hash. The
+    target file is a manifest which references the chunks, small
+    writes such as frame headers and metadata are saved inline.
+    """
+
+    def __init__(self, repository: str) -> None:
+        super().__init__()
+        self.repository = os.path.abspath(repository)
+        self.inline = bytearray()
+        self.chunks: int = 0
+        self.stored: int = 0
+
+    def create(self, targetDir) -> None:
+        """Create target directory and repository"""
+        super().create(targetDir)
+        super().create(os.path.join(self.repository, "chunks"))
+
+    def open(self, targetFile: str, mode: Any = "wb") -> IO[Any]:
+        """Open manifest and write header"""
+        super().open(targetFile, mode)
+        header = {
+            "repository": self.repository,
+            "hash": f"blake2b-{DIGEST_SIZE * 8}",
+            "chunkSize": CHUNK_SIZE,
+        }
+        self.fileHandle.write(MAGIC)
+        self.fileHandle.write(json.dumps(header).encode() + b"\n")
+        return self.fileHandle
+
+    def _flushInline(self) -> None:
+        """Write pending inline data to manifest"""
+        if not self.inline:
+            return
+        self.fileHandle.write(RECORD.pack(INLINE, len(self.inline)))
+        self.fileHandle.write(self.inline)
+        self.inline = bytearray()
+
+    def _store(self, data: Union[bytes, memoryview]) -> None:
+        """Save chunk to repository if not existent"""
+        digest = hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest()
+        self.chunks += 1
+        path = chunkPath(self.repository, digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmpFile = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                with builtins.open(tmpFile, "wb") as fh:
+                    fh.write(data)
+                os.rename(tmpFile, path)
+            except OSError as e:
+                raise exceptions.OutputException(
+                    f"Failed to save chunk [{path}]: {e}"
+                ) from e
+            self.stored += 1
+        self.fileHandle.write(RECORD.pack(CHUNK, len(data)))
+        self.fileHandle.write(bytes.fromhex(digest))
+
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        """Write data as inline record or chunks"""
+        pending = self.hasher.update([data])
+        if len(data) < INLINE_LIMIT:
+            self.inline += data
+            pending.result()
+            return len(data)
+
+        self._flushInline()
+        view = memoryview(data)
+        for start in range(0, len(view), CHUNK_SIZE):
+            self._store(view[start : start + CHUNK_SIZE])
+        pending.result()
+
+        return len(data)
+
+    def writev(self, buffers: Sequence[Union[bytes, memoryview]]) -> int:
+        """Write buffers one by one, so chunk boundaries do not
+        depend on how writes are batched"""
+        return sum(self.write(data) for data in buffers)
+
+    def seek(self, tgt: int, whence: int = 0) -> int:
+        """Seek is not supported, only stream format can be
+        written to the repository"""
+        raise exceptions.OutputException("Seek not supported for repository target")
+
+    def close(self) -> None:
+        """Flush inline data and close manifest"""
+        self._flushInline()
+        log.info(
+            "Saved [%s] new chunks to repository, [%s] chunks deduplicated.",
+            self.stored,
+            self.chunks - self.stored,
+        )
+        self.chunks = 0
+        self.stored = 0
+        super().close()
+
+
+class ManifestReader:
+    """Read backup stream from manifest and chunk repository.
+
+    Provides the file object functions used to read stream
+    data, so restore and verify work the same way as with
+    regular data files.
+    """
+
+    def __init__(self, fileName: str) -> None:
+        self.fileName = fileName
+        # (stream offset, length, inline data or chunk digest)
+        self.records: List[Tuple[int, int, Union[bytes, str]]] = []
+        self.size: int = 0
+        self.pos: int = 0
+        self._cache: Tuple[str, bytes] = ("", b"")
+        try:
+            with builtins.open(fileName, "rb") as fh:
+                self._parse(fh)
+        except (OSError, ValueError, struct.error) as e:
+            raise exceptions.OutputOpenException(
+                f"Reading manifest [{fileName}] failed: {e}"
+            ) from e
+
+    def _parse(self, fh) -> None:
+        """Parse manifest header and records"""
+        if fh.read(len(MAGIC)) != MAGIC:
+            raise ValueError("Invalid manifest header")
+        header = json.loads(fh.readline().decode())
+        self.repository: str = header["repository"]
+        while True:
+            record = fh.read(RECORD.size)
+            if not record:
+                break
+            kind, length = RECORD.unpack(record)
+            if kind == INLINE:
+                payload: Union[bytes, str] = fh.read(length)
+            elif kind == CHUNK:
+                payload = fh.read(DIGEST_SIZE).hex()
+            else:
+                raise ValueError(f"Invalid record type: {kind!r}")
+            self.records.append((self.size, length, payload))
+            self.size += length
+
+    def _chunk(self, digest: str) -> bytes:
+        """Read chunk from repository, last chunk is cached"""
+        if self._cache[0] == digest:
+            return self._cache[1]
+        path = chunkPath(self.repository, digest)
+        try:
+            with builtins.open(path, "rb") as fh:
+                data = fh.read()
+        except OSError as e:
+            raise exceptions.OutputException(
+                f"Failed to read chunk [{path}]: {e}"
+            ) from e
+        if hashlib.blake2b(data, digest_size=DIGEST_SIZE).hexdigest() != digest:
+            raise exceptions.OutputException(f"Chunk [{path}] is corrupted.")
+        self._cache = (digest, data)
+        return data
+
+    def _record(self, pos: int) -> int:
+        """Return index of record containing stream position"""
+        low, high = 0, len(self.records) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.records[mid][0] <= pos:
+                low = mid
+            else:
+                high = mid - 1
+        return low
+
+    def read(self, size: int = -1) -> bytes:
+        """Read data from current position"""
+        if size < 0 or self.pos + size > self.size:
+            size = max(self.size - self.pos, 0)
+        parts = []
+        remaining = size
+        index = self._record(self.pos)
+        while remaining > 0:
+            offset, length, payload = self.records[index]
+            start = self.pos - offset
+            if isinstance(payload, str):
+                payload = self._chunk(payload)
+            part = payload[start : start + min(remaining, length - start)]
+            parts.append(part)
+            self.pos += len(part)
+            remaining -= len(part)
+            index += 1
+
+        return b"".join(parts)
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Seek within stream"""
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.pos = offset
+        return self.pos
+
+    def tell(self) -> int:
+        """Return current stream position"""
+        return self.pos
+
+    def close(self) -> None:
+        """Drop cached chunk"""
+        self._cache = ("", b"")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
@@ -20,7 +20,7 @@ import sys
 import zipfile
 import logging
 import time
-from typing import IO, Tuple
+from typing import IO, Tuple, Sequence, Union
 from libvirtnbdbackup.output import exceptions
 from libvirtnbdbackup.output.target.directory import Directory
 
@@ -87,6 +87,10 @@ class Zip:
         """Write wrapper"""
         return self.zipFileStream.write(data)
 
+    def writev(self, buffers: Sequence[Union[bytes, memoryview]]) -> int:
+        """Write buffers to zip stream in sequence"""
+        return sum(self.zipFileStream.write(data) for data in buffers)
+
     def close(self) -> None:
         """Close wrapper"""
         log.debug("Close file")
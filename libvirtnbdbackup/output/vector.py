@@ -0,0 +1,91 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+from typing import List, Union, Any
+
+log = logging.getLogger("vector")
+
+# buffers below this size are copied and batched with
+# the following writes
+COPY_LIMIT = 64 * 1024
+# pending data is written once this size is reached
+BATCH_SIZE = 1024 * 1024
+# maximum amount of pending buffers
+BATCH_COUNT = 512
+
+
+class Writer:
+    """Collect writes to the target and pass them on as one
+    vectored write.
+
+    Frame headers, terminators and small payloads are queued,
+    so the header, payload and terminator of a frame and runs
+    of small frames are written using a single call to the
+    targets writev() function. Small buffers are copied, so
+    the caller may reuse them once write() returns; larger
+    buffers are written immediately along with the pending
+    data, without copying.
+    """
+
+    def __init__(self, target: Any) -> None:
+        self._target = target
+        self._pending: List[Union[bytes, memoryview]] = []
+        self._size: int = 0
+        self.writes: int = 0
+
+    def write(self, data: Union[bytes, memoryview]) -> int:
+        """Queue data for writing"""
+        length = len(data)
+        if length >= COPY_LIMIT:
+            self._pending.append(data)
+            self.flush()
+            return length
+
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self._pending.append(data)
+        self._size += length
+        if self._size >= BATCH_SIZE or len(self._pending) >= BATCH_COUNT:
+            self.flush()
+
+        return length
+
+    def flush(self) -> None:
+        """Write pending buffers to target"""
+        if not self._pending:
+            return
+        self._target.writev(self._pending)
+        self.writes += 1
+        self._pending = []
+        self._size = 0
+
+    def seek(self, tgt: int, whence: int = 0) -> int:
+        """Write pending data and seek target"""
+        self.flush()
+        return self._target.seek(tgt, whence)
+
+    def truncate(self, size: int) -> None:
+        """Write pending data and truncate target"""
+        self.flush()
+        self._target.truncate(size)
+
+    def close(self) -> None:
+        """Write pending data and close target"""
+        self.flush()
+        log.debug("Data written using [%s] write calls", self.writes)
+        self._target.close()
@@ -223,7 +223,12 @@ class util:
         return command.run(cmd, pidFile=pidFile)
 
     def startBackupNbdServer(
-        self, diskFormat: str, diskFile: str, socketFile: str, bitMap: str
+        self,
+        diskFormat: str,
+        diskFile: str,
+        socketFile: str,
+        bitMap: str,
+        shared: int = 2,
     ) -> processInfo:
         """Start nbd server process for offline backup operation"""
         bitmapOpt = "--"
@@ -241,7 +246,7 @@ class util:
             "-k",
             f"{socketFile}",
             "-t",
-            "-e 2",
+            f"-e {shared}",
             "--fork",
             "--detect-zeroes=on",
             f"--pid-file={pidFile}",
@@ -250,7 +255,12 @@ class util:
         return command.run(cmd, pidFile=pidFile)
 
     def startRemoteBackupNbdServer(
-        self, args: Namespace, disk: DomainDisk, bitMap: str, port: int
+        self,
+        args: Namespace,
+        disk: DomainDisk,
+        bitMap: str,
+        port: int,
+        shared: int = 1,
     ) -> processInfo:
         """Start nbd server process remotely over ssh for restore operation"""
         pidFile = self._gt("qemu-nbd-backup", ".pid")
@@ -267,6 +277,7 @@ class util:
             "--pid-file",
             f"{pidFile}",
             "--fork",
+            f"--shared={shared}",
         ]
         if args.nbd_ip != "":
             cmd.append("-b")
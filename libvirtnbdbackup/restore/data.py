@@ -19,10 +19,13 @@ import logging
 import pprint
 from argparse import Namespace
 from libvirtnbdbackup import chunk
-from libvirtnbdbackup import lz4
+from libvirtnbdbackup import output
+from libvirtnbdbackup import metrics
+from libvirtnbdbackup.output.exceptions import OutputException
 from libvirtnbdbackup import common as lib
 from libvirtnbdbackup.sparsestream import types
 from libvirtnbdbackup.sparsestream import streamer
+from libvirtnbdbackup.sparsestream import codec
 from libvirtnbdbackup.sparsestream.exceptions import StreamFormatException
 from libvirtnbdbackup.exceptions import RestoreError
 from libvirtnbdbackup.exceptions import UntilCheckpointReached
@@ -56,9 +59,8 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
     sTypes = types.SparseStreamTypes()
 
     try:
-        # pylint: disable=consider-using-with
-        reader = open(dataFile, "rb")
-    except OSError as errmsg:
+        reader = stream.reader(output.openstream(dataFile))
+    except OutputException as errmsg:
         logging.error("Failed to open backup file for reading: [%s].", errmsg)
         raise RestoreError from errmsg
 
@@ -70,9 +72,15 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
         raise RestoreError from errmsg
 
     trailer = None
+    streamCodec = None
     if lib.isCompressed(meta) is True:
+        try:
+            streamCodec = codec.fromMeta(meta)
+        except StreamFormatException as errmsg:
+            logging.fatal(errmsg)
+            raise RestoreError from errmsg
         trailer = stream.readCompressionTrailer(reader)
-        logging.info("Found compression trailer.")
+        logging.info("Found compression trailer, method: [%s].", streamCodec.name)
         logging.debug("%s", trailer)
 
     if meta["dataSize"] == 0:
@@ -86,11 +94,16 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
         "Applying data from backup file [%s] to target file [%s].", dataFile, targetFile
     )
     pprint.pprint(meta)
-    assert reader.read(len(sTypes.TERM)) == sTypes.TERM
+    try:
+        stream.readTerm(reader)
+    except StreamFormatException as errmsg:
+        logging.fatal(errmsg)
+        raise RestoreError from errmsg
 
     progressBar = lib.progressBar(
         meta["dataSize"], f"restoring disk [{meta['diskName']}]", args
     )
+    stats = metrics.diskStats("restore", meta["diskName"], meta["dataSize"])
     dataSize: int = 0
     dataBlockCnt: int = 0
     while True:
@@ -101,6 +114,7 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
             raise RestoreError from err
         if kind == sTypes.ZERO:
             logging.debug("Zero segment from [%s] length: [%s]", start, length)
+            stats.extent()
         elif kind == sTypes.DATA:
             logging.debug(
                 "Processing data segment from [%s] length: [%s]", start, length
@@ -113,7 +127,14 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
                 length = trailer[dataBlockCnt]
                 logging.debug("Compressed block size: [%s]", length)
 
-            if originalSize >= connection.maxRequestSize:
+            # compressed data saved in multiple frames is recorded
+            # as dict in the trailer, independent of the frame size
+            if trailer:
+                chunked = isinstance(length, dict)
+            else:
+                chunked = originalSize >= connection.maxRequestSize
+
+            if chunked:
                 logging.debug(
                     "Chunked read/write, start: [%s], len: [%s]", start, length
                 )
@@ -123,7 +144,7 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
                         start,
                         length,
                         connection,
-                        lib.isCompressed(meta),
+                        streamCodec,
                         progressBar,
                     )
                 except Exception as e:
@@ -133,8 +154,8 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
             else:
                 try:
                     data = reader.read(length)
-                    if lib.isCompressed(meta):
-                        data = lz4.decompressFrame(data)
+                    if streamCodec is not None:
+                        data = streamCodec.decompress(data)
                     connection.nbd.pwrite(data, start)
                     written = len(data)
                 except Exception as e:
@@ -142,12 +163,39 @@ def _write(  # pylint: disable=too-many-branches,too-many-locals,too-many-statem
                     raise RestoreError from e
                 progressBar.update(written)
 
-            assert reader.read(len(sTypes.TERM)) == sTypes.TERM
+            try:
+                stream.readTerm(reader)
+            except StreamFormatException as err:
+                logging.error(
+                    "Invalid data frame at original offset [%s]: [%s]", start, err
+                )
+                raise RestoreError from err
+            # chunked trailer entries are keyed by the overall
+            # compressed size of the block
+            readSize = originalSize
+            if trailer:
+                entry = trailer[dataBlockCnt]
+                readSize = int(next(iter(entry))) if isinstance(entry, dict) else entry
+            stats.read(readSize)
+            if trailer:
+                stats.compressed(readSize)
+            stats.written(written)
+            stats.extent(originalSize)
             dataSize += originalSize
             dataBlockCnt += 1
         elif kind == sTypes.STOP:
             progressBar.close()
-            if dataSize != meta["dataSize"]:
+            # with zero detection or skipped unchanged blocks, not
+            # all data extents are saved as data. If extents were
+            # streamed, only the upper limit is known.
+            partialData = (
+                meta.get("zeroDetection", False)
+                or meta.get("skipUnchanged", False)
+                or meta.get("streamedExtents", False)
+            )
+            if dataSize != meta["dataSize"] and not (
+                partialData and dataSize < meta["dataSize"]
+            ):
                 logging.error(
                     "Restored data size does not match [%s] != [%s]",
                     dataSize,
@@ -16,20 +16,29 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 import os
-import zlib
 import json
 import logging
-from typing import List
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List, Dict, Any, Deque, Tuple
 from argparse import Namespace
 from libvirtnbdbackup import virt
 from libvirtnbdbackup import output
+from libvirtnbdbackup import checksum
 from libvirtnbdbackup.restore import vmconfig
 from libvirtnbdbackup.restore import header
 from libvirtnbdbackup import common as lib
 from libvirtnbdbackup.objects import DomainDisk
+from libvirtnbdbackup.sparsestream import types
 from libvirtnbdbackup.sparsestream import streamer
+from libvirtnbdbackup.sparsestream.exceptions import StreamFormatException
 from libvirtnbdbackup.exceptions import RestoreError
 
+# frame payloads are checksummed by multiple threads during verify
+VERIFY_THREADS = 4
+# maximum amount of frames pending verification
+VERIFY_PENDING = 32
+
 
 def restore(args: Namespace, vmConfig: str, virtClient: virt.client) -> None:
     """Notice user if backed up vm had loader / nvram"""
@@ -61,38 +70,155 @@ def restore(args: Namespace, vmConfig: str, virtClient: virt.client) -> None:
         lib.copy(args, f[0], val)
 
 
+def _compareBlocks(stored: Dict[str, Any], computed: Dict[str, Any]) -> bool:
+    """Compare block digests, report the ranges of the data file
+    which do not match"""
+    if len(stored["blocks"]) != len(computed["blocks"]):
+        logging.error(
+            "Amount of blocks does not match: [%s]!=[%s]",
+            len(stored["blocks"]),
+            len(computed["blocks"]),
+        )
+        return False
+    ok = True
+    for num, (storedSum, blockSum) in enumerate(
+        zip(stored["blocks"], computed["blocks"])
+    ):
+        if storedSum != blockSum:
+            logging.error(
+                "Block at offset [%s] does not match: [%s]!=[%s]",
+                num * stored["blockSize"],
+                storedSum,
+                blockSum,
+            )
+            ok = False
+    return ok
+
+
+def _compareFrame(entry: Tuple[int, int, Future, int]) -> bool:
+    """Compare computed payload checksum of frame"""
+    position, start, computed, expected = entry
+    if computed.result() == expected:
+        return True
+    logging.error(
+        "Frame at stream offset [%s] (disk offset [%s]) does not match: [%08x]!=[%08x]",
+        position,
+        start,
+        computed.result(),
+        expected,
+    )
+    return False
+
+
+def _verifyFrames(sourceFile: str) -> bool:
+    """Compare the payload checksum of each frame of version 3
+    streams, payloads are checksummed concurrently while the
+    stream is read."""
+    stream = streamer.SparseStream(types)
+    sTypes = stream.types
+    pending: Deque[Tuple[int, int, Future, int]] = deque()
+    ok = True
+    trailer: Dict[int, Any] = {}
+    dataBlockCnt: int = 0
+    with output.openstream(sourceFile) as reader, ThreadPoolExecutor(
+        VERIFY_THREADS
+    ) as executor:
+        try:
+            kind, start, length = stream.readFrame(reader)
+            if stream.frameVersion < 3:
+                return True
+            logging.info("Verifying frame checksums for: %s", sourceFile)
+            while kind != sTypes.STOP:
+                if kind in (sTypes.META, sTypes.DATA):
+                    if kind == sTypes.DATA and trailer:
+                        length = trailer[dataBlockCnt]
+                        if isinstance(length, dict):
+                            length = int(next(iter(length)))
+                        dataBlockCnt += 1
+                    if not stream.verifiable(stream.frameFlags):
+                        logging.error(
+                            "Checksum algorithm [crc32c] not available, "
+                            "install required module."
+                        )
+                        return False
+                    position = reader.tell()
+                    payload = reader.read(length)
+                    expected = stream.readChecksum(reader)
+                    computed = executor.submit(
+                        stream.checksum, stream.frameFlags, payload
+                    )
+                    pending.append((position, start, computed, expected))
+                    if kind == sTypes.META and lib.isCompressed(
+                        stream.loadMetadata(payload)
+                    ):
+                        trailer = stream.readCompressionTrailer(reader)
+                while len(pending) > VERIFY_PENDING:
+                    ok = _compareFrame(pending.popleft()) and ok
+                kind, start, length = stream.readFrame(reader)
+        except StreamFormatException as e:
+            logging.error("Invalid frame at stream offset [%s]: %s", reader.tell(), e)
+            return False
+        while pending:
+            ok = _compareFrame(pending.popleft()) and ok
+
+    return ok
+
+
 def verify(args: Namespace, dataFiles: List[str]) -> bool:
-    """Compute adler32 checksum for exiting data files and
-    compare with checksums computed during backup."""
+    """Compute checksum for exiting data files and compare with
+    checksums computed during backup. Files with block digests are
+    compared block by block, otherwise the file digest (or adler32
+    checksum of previous versions) is compared. For version 3
+    streams, the checksum of each frame is verified as well."""
     for dataFile in dataFiles:
         if args.disk is not None and not os.path.basename(dataFile).startswith(
             args.disk
         ):
             continue
         logging.debug("Using buffer size: %s", args.buffsize)
-        logging.info("Computing checksum for: %s", dataFile)
 
         sourceFile = dataFile
         if args.sequence:
             sourceFile = os.path.join(args.input, dataFile)
 
-        with output.openfile(sourceFile, "rb") as vfh:
-            adler = 1
-            data = vfh.read(args.buffsize)
-            while data:
-                adler = zlib.adler32(data, adler)
-                data = vfh.read(args.buffsize)
+        if not _verifyFrames(sourceFile):
+            return False
 
         chksumFile = f"{sourceFile}.chksum"
-        logging.info("Checksum result: %s", adler)
         if not os.path.exists(chksumFile):
             logging.info("No checksum found, skipping: [%s]", sourceFile)
             continue
-        logging.info("Comparing checksum with stored information")
         with output.openfile(chksumFile, "r") as s:
-            storedSum = int(s.read())
-        if storedSum != adler:
-            logging.error("Stored sums do not match: [%s]!=[%s]", storedSum, adler)
+            stored = checksum.loads(s.read())
+        if not checksum.available(stored["algorithm"]):
+            logging.error(
+                "Checksum algorithm [%s] not available, install required module.",
+                stored["algorithm"],
+            )
+            return False
+
+        logging.info("Computing [%s] checksum for: %s", stored["algorithm"], dataFile)
+        hasher = checksum.Hasher(stored["algorithm"])
+        with output.openstream(sourceFile) as vfh:
+            data = vfh.read(args.buffsize)
+            while data:
+                pending = hasher.update([data])
+                data = vfh.read(args.buffsize)
+                pending.result()
+        hasher.close()
+        computed = hasher.result()
+
+        logging.info("Checksum result: %s", computed["digest"])
+        logging.info("Comparing checksum with stored information")
+        if stored["blocks"]:
+            if not _compareBlocks(stored, computed):
+                return False
+        elif stored["digest"] != computed["digest"]:
+            logging.error(
+                "Stored sums do not match: [%s]!=[%s]",
+                stored["digest"],
+                computed["digest"],
+            )
             return False
 
         logging.info("OK")
@@ -60,6 +60,32 @@ class Backup:
         virtClient.close()
         sys.exit(1)
 
+    @staticmethod
+    def reload(args: Namespace, log: Any, signum: int, _) -> None:
+        """Read bandwidth limits from file again"""
+        log.info("Signal caught: %s, reloading bandwidth limits.", signum)
+        if args.bwlimit_file is None:
+            log.warning("No bandwidth limit file specified, ignoring.")
+            return
+        try:
+            args.rateLimiter.load(args.bwlimit_file)
+        except (OSError, ValueError) as e:
+            log.error("Unable to read bandwidth limits, keeping current: [%s]", e)
+
+
+class Batch:
+    """Handle signal during batch backup operation"""
+
+    @staticmethod
+    def catch(shared: Namespace, log: Any, signum: int, _) -> None:
+        """Catch signal, attempt to stop all running backup jobs."""
+        log.error("Signal caught: %s", signum)
+        for name, domObj in list(shared.running.items()):
+            log.info("Cleanup: Stopping backup job of domain [%s].", name)
+            shared.virtClient.stopBackup(domObj)
+        shared.virtClient.close()
+        sys.exit(1)
+
 
 class Map:
     """Handle signal during map operation"""
@@ -0,0 +1,103 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+from typing import Dict, List, Any, Union
+from libvirtnbdbackup import lz4
+from libvirtnbdbackup import zstd
+from libvirtnbdbackup.sparsestream import exceptions
+
+
+class Lz4:
+    """lz4 frame compression"""
+
+    name = "lz4"
+
+    def __init__(self, level: int = 2, threads: int = 0) -> None:
+        # pylint: disable=unused-argument
+        self.level = level
+
+    @staticmethod
+    def available() -> bool:
+        """lz4 is always installed"""
+        return True
+
+    def compress(self, data: Union[bytes, memoryview]) -> bytes:
+        """Compress block"""
+        return lz4.compressFrame(data, self.level)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        """Decompress block"""
+        return lz4.decompressFrame(data)
+
+
+class Zstd:
+    """zstd frame compression, optionally multithreaded"""
+
+    name = "zstd"
+
+    def __init__(self, level: int = 2, threads: int = 0) -> None:
+        self.level = level
+        self.threads = threads
+
+    @staticmethod
+    def available() -> bool:
+        """zstd requires the zstandard module"""
+        return zstd.available()
+
+    def compress(self, data: Union[bytes, memoryview]) -> bytes:
+        """Compress block"""
+        return zstd.compressFrame(data, self.level, self.threads)
+
+    @staticmethod
+    def decompress(data: bytes) -> bytes:
+        """Decompress block"""
+        return zstd.decompressFrame(data)
+
+
+codecs: Dict[str, Any] = {
+    Lz4.name: Lz4,
+    Zstd.name: Zstd,
+}
+
+
+def available() -> List[str]:
+    """Return names of usable compression methods"""
+    return [name for name, cls in codecs.items() if cls.available()]
+
+
+def get(name: str, level: int = 2, threads: int = 0) -> Any:
+    """Return codec for the given compression method"""
+    try:
+        cls = codecs[name]
+    except KeyError as e:
+        raise exceptions.CompressionMethodException(
+            f"Unknown compression method: [{name}]"
+        ) from e
+    if not cls.available():
+        raise exceptions.CompressionMethodException(
+            f"Compression method [{name}] not available, missing python module."
+        )
+
+    return cls(level, threads)
+
+
+def fromMeta(meta: Dict[str, Any]) -> Any:
+    """Return codec for the compression method recorded in the
+    stream metadata, streams written before the method was
+    recorded are always lz4 compressed."""
+    return get(meta.get("compressionMethod", Lz4.name))
@@ -17,3 +17,11 @@ class BlockFormatException(StreamFormatException):
 
 class FrameformatException(StreamFormatException):
     """Frame Format is wrong"""
+
+
+class CompressionMethodException(StreamFormatException):
+    """Unsupported compression method"""
+
+
+class FrameChecksumException(StreamFormatException):
+    """Checksum of frame does not match"""
@@ -18,38 +18,116 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import json
 import os
+import zlib
+import struct
+import logging
 import datetime
-from typing import List, Any, Tuple, Dict
+from typing import List, Any, Tuple, Dict, Optional
 from argparse import Namespace
 from libvirtnbdbackup.objects import DomainDisk
 from libvirtnbdbackup.sparsestream import exceptions
 
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+log = logging.getLogger("stream")
+
+
+class ChecksumWriter:
+    """Pass writes on to the target and update the checksum of
+    the current frame payload, required for stream version 3"""
+
+    def __init__(self, writer, stream) -> None:
+        self._writer = writer
+        self._stream = stream
+
+    def write(self, data) -> int:
+        """Update checksum and write data"""
+        self._stream.update(data)
+        return self._writer.write(data)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._writer, name)
+
+
+class ChecksumReader:
+    """Update the checksum of the current frame payload with the
+    data read, seeking within the stream skips the verification
+    of the current frame"""
+
+    def __init__(self, reader, stream) -> None:
+        self._reader = reader
+        self._stream = stream
+
+    def read(self, size: int = -1) -> bytes:
+        """Read data and update checksum"""
+        data = self._reader.read(size)
+        self._stream.update(data)
+        return data
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        """Seek stream, current frame is not verified"""
+        self._stream.skip()
+        return self._reader.seek(offset, whence)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._reader, name)
+
 
 class SparseStream:
+    # pylint: disable=too-many-instance-attributes
     """Sparse Stream writer/reader class"""
 
-    def __init__(self, types, version: int = 2) -> None:
+    def __init__(self, types, version: int = 2, compressionMethod: str = "") -> None:
         """Stream version:
 
         1: base version
         2: stream version with compression support
+        3: binary frame headers with payload checksums
+
+        Frames of all versions are read, the version of the last
+        frame read is set as frameVersion.
         """
         self.version = version
-        self.compressionMethod: str = "lz4"
         self.types = types.SparseStreamTypes()
+        self._header = struct.Struct(self.types.HEADER)
+        self._footer = struct.Struct(self.types.FOOTER)
+        self._codec = 0
+        if compressionMethod:
+            self._codec = self.types.CODECS.index(compressionMethod)
+        self._writeFlags = self.types.FLAG_CRC32C if crc32c is not None else 0
+        self.frameVersion = version
+        self.frameLength = self.types.FRAME_LEN
+        if version >= 3:
+            self.frameLength = self.types.HEADER_LEN
+        self.frameFlags = 0
+        # checksum of the current frame payload, None if the
+        # payload is not verified
+        self._value: Optional[int] = None
+        self._warned = False
 
-    def dumpMetadata(
+    def dumpMetadata(  # pylint: disable=too-many-arguments,too-many-positional-arguments
         self,
         args: Namespace,
         virtualSize: int,
         dataSize: int,
         disk: DomainDisk,
+        zeroDetection: bool = False,
+        skipUnchanged: bool = False,
+        streamedExtents: bool = False,
     ) -> bytes:
         """First block in backup stream is Meta data information
         about virtual size of the disk being backed up, as well
         as various information regarding backup.
         Dumps Metadata frame to be written at start of stream in
         json format.
+        If zero detection is enabled, zeroed ranges within data
+        extents are saved as zero frames, dataSize is then the
+        upper limit of data saved in the stream. The same applies
+        if unchanged blocks are skipped, or if data is saved while
+        the extents are still being queried.
         """
         meta = {
             "virtualSize": virtualSize,
@@ -59,22 +137,54 @@ class SparseStream:
             "diskFormat": disk.format,
             "checkpointName": args.cpt.name,
             "compressed": args.compress,
-            "compressionMethod": self.compressionMethod,
+            "compressionMethod": args.compression_method,
             "parentCheckpoint": args.cpt.parent,
             "incremental": (args.level in ("inc", "diff")),
             "streamVersion": self.version,
+            "zeroDetection": zeroDetection,
+            "skipUnchanged": skipUnchanged,
+            "streamedExtents": streamedExtents,
         }
         return json.dumps(meta, indent=4).encode("utf-8")
 
+    def writer(self, writer) -> Any:
+        """Return writer to be used for writing the stream"""
+        if self.version < 3:
+            return writer
+        return ChecksumWriter(writer, self)
+
+    def reader(self, reader) -> Any:
+        """Return reader which verifies the payload checksums of
+        version 3 frames"""
+        return ChecksumReader(reader, self)
+
+    def verifiable(self, flags: int) -> bool:
+        """Check if the payload checksum can be computed"""
+        return not flags & self.types.FLAG_CRC32C or crc32c is not None
+
+    def checksum(self, flags: int, data, value: int = 0) -> int:
+        """Compute payload checksum as indicated by the frame flags"""
+        if flags & self.types.FLAG_CRC32C:
+            return crc32c.crc32c(data, value)
+        return zlib.crc32(data, value)
+
+    def update(self, data) -> None:
+        """Update checksum of the current frame payload"""
+        if self._value is not None:
+            self._value = self.checksum(self.frameFlags, data, self._value)
+
+    def skip(self) -> None:
+        """Do not verify the current frame payload"""
+        self._value = None
+
     def writeCompressionTrailer(self, writer, trailer: List[Any]) -> None:
         """Dump compression trailer to end of stream"""
         size = writer.write(json.dumps(trailer).encode())
-        writer.write(self.types.TERM)
+        self.writeTerm(writer)
         self.writeFrame(writer, self.types.COMP, 0, size)
 
-    def _readHeader(self, reader) -> Tuple[str, str, str]:
-        """Attempt to read header"""
-        header = reader.read(self.types.FRAME_LEN)
+    def _splitHeader(self, header: bytes) -> Tuple[bytes, bytes, bytes]:
+        """Split ascii header"""
         try:
             kind, start, length = header.split(b" ", 2)
         except ValueError as err:
@@ -84,8 +194,14 @@ class SparseStream:
 
         return kind, start, length
 
+    def _readHeader(self, reader) -> Tuple[bytes, bytes, bytes]:
+        """Attempt to read header"""
+        return self._splitHeader(reader.read(self.types.FRAME_LEN))
+
     @staticmethod
-    def _parseHeader(kind, start: str, length: str) -> Tuple[str, int, int]:
+    def _parseHeader(
+        kind: bytes, start: bytes, length: bytes
+    ) -> Tuple[bytes, int, int]:
         """Return parsed header information"""
         try:
             return kind, int(start, 16), int(length, 16)
@@ -94,6 +210,34 @@ class SparseStream:
                 f"Invalid frame format: [{err}]"
             ) from err
 
+    def _pack(  # pylint: disable=too-many-arguments,too-many-positional-arguments
+        self, kind: bytes, flags: int, codec: int, start: int, length: int
+    ) -> bytes:
+        """Return binary header with header checksum"""
+        # header checksum is the last field
+        header = self._header.pack(kind, 3, flags, codec, start, length, 0)[:-4]
+        return header + struct.pack(">I", zlib.crc32(header))
+
+    def _unpack(self, header: bytes) -> Tuple[bytes, int, int, int, int]:
+        """Return kind, flags, codec, start and length of binary
+        header"""
+        try:
+            kind, version, flags, codec, start, length, value = self._header.unpack(
+                header
+            )
+        except struct.error as err:
+            raise exceptions.BlockFormatException(
+                f"Invalid block format: [{err}]"
+            ) from err
+        if version != 3:
+            raise exceptions.FrameformatException(
+                f"Unsupported frame version: [{version}]"
+            )
+        if zlib.crc32(header[:-4]) != value:
+            raise exceptions.FrameChecksumException("Frame header checksum mismatch")
+
+        return kind, flags, codec, start, length
+
     def readCompressionTrailer(self, reader) -> Dict[int, Any]:
         """If compressed stream is found, information about compressed
         block sizes is appended as last json payload.
@@ -101,12 +245,29 @@ class SparseStream:
         Function seeks to end of file and reads trailer information.
         """
         pos = reader.tell()
-        reader.seek(0, os.SEEK_END)
-        reader.seek(-(self.types.FRAME_LEN + len(self.types.TERM)), os.SEEK_CUR)
-        _, _, length = self._readHeader(reader)
-        reader.seek(-(self.types.FRAME_LEN + int(length, 16)), os.SEEK_CUR)
-        trailer = self.loadMetadata(reader.read(int(length, 16)))
+        value = self._value
+        reader.seek(-self.types.HEADER_LEN, os.SEEK_END)
+        header = reader.read(self.types.HEADER_LEN)
+        if header[:4] == self.types.COMP:
+            _, flags, _, _, length = self._unpack(header)
+            reader.seek(
+                -(self.types.HEADER_LEN + self.types.FOOTER_LEN + length), os.SEEK_END
+            )
+            payload = reader.read(length)
+            expected = self.readChecksum(reader)
+            if self.verifiable(flags) and self.checksum(flags, payload) != expected:
+                raise exceptions.FrameChecksumException(
+                    "Compression trailer checksum mismatch"
+                )
+        else:
+            reader.seek(0, os.SEEK_END)
+            reader.seek(-(self.types.FRAME_LEN + len(self.types.TERM)), os.SEEK_CUR)
+            _, _, length = self._parseHeader(*self._readHeader(reader))
+            reader.seek(-(self.types.FRAME_LEN + length), os.SEEK_CUR)
+            payload = reader.read(length)
+        trailer = self.loadMetadata(payload)
         reader.seek(pos)
+        self._value = value
         return trailer
 
     @staticmethod
@@ -129,12 +290,70 @@ class SparseStream:
         Parameters:
             writer: (fh)    Writer object that implements .write()
         """
-        writer.write(self.types.FRAME % (kind, start, length))
+        if self.version < 3:
+            writer.write(self.types.FRAME % (kind, start, length))
+            return
+        codec = self._codec if kind == self.types.DATA else 0
+        writer.write(self._pack(kind, self._writeFlags, codec, start, length))
+        self.frameFlags = self._writeFlags
+        self._value = 0
+
+    def writeTerm(self, writer) -> None:
+        """Write frame terminator after payload, for version 3
+        the checksum of the payload written via writer()"""
+        if self.version < 3:
+            writer.write(self.types.TERM)
+            return
+        writer.write(self._footer.pack(self._value))
 
-    def readFrame(self, reader) -> Tuple[str, int, int]:
+    def readFrame(self, reader) -> Tuple[bytes, int, int]:
         """Read backup frame
         Parameters:
             reader: (fh)    Reader object which implements .read()
         """
-        kind, start, length = self._readHeader(reader)
-        return self._parseHeader(kind, start, length)
+        header = reader.read(self.types.HEADER_LEN)
+        if header[4:5] == b" ":
+            header += reader.read(self.types.FRAME_LEN - self.types.HEADER_LEN)
+            self.frameVersion = 2
+            self.frameLength = self.types.FRAME_LEN
+            self._value = None
+            return self._parseHeader(*self._splitHeader(header))
+
+        kind, flags, _, start, length = self._unpack(header)
+        self.frameVersion = 3
+        self.frameLength = self.types.HEADER_LEN
+        self.frameFlags = flags
+        self._value = None
+        if not self.verifiable(flags):
+            if not self._warned:
+                log.warning(
+                    "Python crc32c module not installed, unable to verify checksums."
+                )
+                self._warned = True
+        elif isinstance(reader, ChecksumReader):
+            self._value = 0
+        return kind, start, length
+
+    def readChecksum(self, reader) -> int:
+        """Read payload checksum of version 3 frame"""
+        try:
+            return self._footer.unpack(reader.read(self.types.FOOTER_LEN))[0]
+        except struct.error as err:
+            raise exceptions.FrameformatException(
+                f"Invalid frame format: [{err}]"
+            ) from err
+
+    def readTerm(self, reader) -> None:
+        """Read frame terminator after payload. For version 3
+        frames the payload checksum is compared if the payload
+        has been read via reader()"""
+        if self.frameVersion < 3:
+            if reader.read(len(self.types.TERM)) != self.types.TERM:
+                raise exceptions.FrameformatException("Frame terminator not found")
+            return
+        value = self._value
+        expected = self.readChecksum(reader)
+        if value is not None and value != expected:
+            raise exceptions.FrameChecksumException(
+                f"Payload checksum mismatch: [{value:08x}]!=[{expected:08x}]"
+            )
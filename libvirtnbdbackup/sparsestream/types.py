@@ -16,7 +16,9 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <https://www.gnu.org/licenses/>.
 """
 
+import struct
 from dataclasses import dataclass
+from typing import Tuple
 
 
 @dataclass(frozen=True)
@@ -36,6 +38,10 @@ class SparseStreamTypes:
     TERM:   termination identifier
     FRAME:  assembled frame
     FRAME_LEN: length of frame
+    HEADER: binary frame header (stream version 3)
+    HEADER_LEN: length of binary frame header
+    FOOTER: payload checksum following the payload (stream version 3)
+    FOOTER_LEN: length of payload checksum
 
     Stream format
     =============
@@ -89,6 +95,22 @@ class SparseStreamTypes:
     stop 0000000000000000 00000000000000000\r\n
     <json payload with compressed block sizes>\r\n
     comp 0000000000000000 00000000000000010\r\n
+
+    Stream version 3
+    ================
+
+    Same sequence of frames, but each frame starts with a fixed
+    size binary header (big endian):
+
+    kind (4 bytes) version (1) flags (1) codec (1) reserved (1)
+    start (8) length (8) reserved (4) header checksum (4)
+
+    The header checksum is the crc32 of the first 28 bytes. Frames
+    with payload (meta, data, comp) are followed by the checksum of
+    the payload (4 bytes) instead of the termination identifier. The
+    payload checksum is crc32c if the FLAG_CRC32C flag is set, crc32
+    otherwise. Codec is the index of the compression method within
+    CODECS for data frames, 0 otherwise.
     """
 
     META: bytes = b"meta"
@@ -99,3 +121,9 @@ class SparseStreamTypes:
     TERM: bytes = b"\r\n"
     FRAME: bytes = b"%s %016x %016x" + TERM
     FRAME_LEN: int = len(FRAME % (STOP, 0, 0))
+    HEADER: str = ">4sBBBxQQ4xI"
+    HEADER_LEN: int = struct.calcsize(HEADER)
+    FOOTER: str = ">I"
+    FOOTER_LEN: int = struct.calcsize(FOOTER)
+    FLAG_CRC32C: int = 1
+    CODECS: Tuple[str, ...] = ("", "lz4", "zstd")
@@ -62,12 +62,16 @@ def getXml(cptObj: libvirt.virDomainCheckpoint) -> str:
         return cptObj.getXMLDesc()
 
 
-def getSize(domObj: libvirt.virDomain, checkpointName: str) -> int:
-    """Return current size of checkpoint for all disks"""
+def getSize(domObj: libvirt.virDomain, checkpointName: str, diskName: str = "") -> int:
+    """Return current size of checkpoint for all disks, or
+    the disk with the given name"""
     size: int = 0
     cpt = exists(domObj, checkpointName)
     cptTree = xml.asTree(getXml(cpt))
-    for s in cptTree.xpath("disks/disk/@size"):
+    query = "disks/disk/@size"
+    if diskName != "":
+        query = f"disks/disk[@name='{diskName}']/@size"
+    for s in cptTree.xpath(query):
         size += int(s)
 
     return size
@@ -18,6 +18,7 @@ along with this program.  If not, see <https://www.gnu.org/licenses/>.
 import os
 import string
 import random
+import fnmatch
 import logging
 from argparse import Namespace
 from typing import Any, Dict, List, Tuple, Union
@@ -144,6 +145,18 @@ class client:
         except libvirt.libvirtError as e:
             raise domainNotFound(e) from e
 
+    def getDomainNames(self, patterns: List[str]) -> List[str]:
+        """Return names of all domains matching the patterns"""
+        names = sorted(dom.name() for dom in self._conn.listAllDomains())
+        found: List[str] = []
+        for pattern in patterns:
+            matches = fnmatch.filter(names, pattern)
+            if not matches:
+                log.warning("No domain matching [%s] found.", pattern)
+            found += [name for name in matches if name not in found]
+
+        return found
+
     def refreshPool(self, path: str) -> None:
         """Check if specified path matches an existing
         storage pool and refresh its contents"""
@@ -0,0 +1,62 @@
+"""
+Copyright (C) 2023  Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""
+
+import logging
+import threading
+from typing import Union
+
+try:
+    import zstandard
+
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+log = logging.getLogger()
+
+_local = threading.local()
+
+
+def available() -> bool:
+    """Check if zstandard module is installed"""
+    return HAVE_ZSTD
+
+
+def decompressFrame(data: bytes) -> bytes:
+    """Decompress zstd frame, print frame information"""
+    frameInfo = zstandard.get_frame_parameters(data)
+    log.debug("Compressed Frame: size: %s", frameInfo.content_size)
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def compressFrame(
+    data: Union[bytes, memoryview], level: int, threads: int = 0
+) -> bytes:
+    """Compress block to zstd frame, content checksum enabled
+    for safety. If threads is set, the frame is compressed by
+    multiple threads. Compressor objects must not be shared
+    across threads, so one is kept per thread.
+    """
+    key = (level, threads)
+    compressors = getattr(_local, "compressors", None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+    if key not in compressors:
+        compressors[key] = zstandard.ZstdCompressor(
+            level=level, threads=threads, write_checksum=True
+        )
+    return compressors[key].compress(data)
@@ -0,0 +1,494 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+Benchmark backup and restore engine against local NBD exports
+served by qemu-nbd or nbdkit, without libvirt. Each case runs in
+its own process, so CPU time and peak RSS are accounted per case.
+"""
+import os
+import sys
+import json
+import glob
+import time
+import shutil
+import random
+import socket
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+from argparse import Namespace
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from libvirtnbdbackup import __version__
+from libvirtnbdbackup import nbdcli
+from libvirtnbdbackup.objects import DomainDisk
+from libvirtnbdbackup.backup import disk
+from libvirtnbdbackup.backup import ratelimit
+from libvirtnbdbackup.restore import data
+from libvirtnbdbackup.output import stream
+from libvirtnbdbackup.sparsestream import streamer
+from libvirtnbdbackup.sparsestream import types
+
+KiB = 1024
+MiB = 1024 * KiB
+EXPORT = "sda"
+LAYOUTS = ("contiguous", "fragmented", "mostly-zero", "incompressible")
+
+
+def _random(rng: random.Random, length: int) -> bytes:
+    """Return reproducible random data"""
+    return rng.getrandbits(length * 8).to_bytes(length, "little")
+
+
+def _compressible(rng: random.Random, length: int) -> bytes:
+    """Return data which compresses roughly by half"""
+    text = b"virtnbdbackup benchmark data "
+    pattern = (text * (length // len(text) + 1))[: length // 2]
+    return pattern + _random(rng, length - len(pattern))
+
+
+def createImage(fileName: str, layout: str, size: int, seed: int) -> None:
+    """Create sparse raw image with the given extent layout,
+    unallocated ranges are reported as holes by the NBD server"""
+    rng = random.Random(seed)
+    with open(fileName, "wb") as fh:
+        fh.truncate(size)
+        if layout == "contiguous":
+            for offset in range(0, size, 4 * MiB):
+                fh.seek(offset)
+                fh.write(_compressible(rng, min(4 * MiB, size - offset)))
+        elif layout == "incompressible":
+            for offset in range(0, size, 4 * MiB):
+                fh.seek(offset)
+                fh.write(_random(rng, min(4 * MiB, size - offset)))
+        elif layout == "fragmented":
+            # 64 KiB of data followed by a 128 KiB hole
+            for offset in range(64 * KiB, size - 64 * KiB, 192 * KiB):
+                fh.seek(offset)
+                fh.write(_compressible(rng, 64 * KiB))
+        elif layout == "mostly-zero":
+            # 4 MiB of data every 64 MiB
+            for offset in range(0, size, 64 * MiB):
+                fh.seek(offset)
+                fh.write(_compressible(rng, min(4 * MiB, size - offset)))
+        else:
+            raise ValueError(f"Unknown layout: [{layout}]")
+
+
+class Server:
+    """Serve export via qemu-nbd or nbdkit on a unix socket"""
+
+    def __init__(self, command: List[str], socketFile: str) -> None:
+        self.socketFile = socketFile
+        # pylint: disable=consider-using-with
+        self._proc = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        self._wait()
+
+    def _wait(self) -> None:
+        """Wait until server accepts connections"""
+        for _ in range(100):
+            if self._proc.poll() is not None:
+                raise RuntimeError(f"NBD server exited: [{self._proc.returncode}]")
+            try:
+                with socket.socket(socket.AF_UNIX) as sock:
+                    sock.connect(self.socketFile)
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise RuntimeError("NBD server did not start")
+
+    def stop(self) -> None:
+        """Stop server"""
+        self._proc.terminate()
+        self._proc.wait()
+
+
+def serve(
+    server: str, socketFile: str, fileName: str = "", size: int = 0, **kwargs
+) -> Server:
+    """Start server for file, without file name an empty export
+    of the given size is created. Keyword arguments are passed as
+    parameters to the nbdkit plugin."""
+    readOnly = fileName != "" or bool(kwargs)
+    if server == "qemu-nbd":
+        command = [
+            "qemu-nbd",
+            "--persistent",
+            "--shared=0",
+            "--format=raw",
+            f"--export-name={EXPORT}",
+            f"--socket={socketFile}",
+        ]
+        if readOnly:
+            command.append("--read-only")
+        return Server(command + [fileName], socketFile)
+
+    command = ["nbdkit", "--foreground", "--unix", socketFile]
+    if readOnly:
+        command.append("--readonly")
+    if kwargs:
+        plugin = ["sparse-random", f"size={size}"]
+        plugin += [f"{key}={value}" for key, value in kwargs.items()]
+    elif fileName:
+        plugin = ["file", f"file={fileName}"]
+    else:
+        plugin = ["memory", f"size={size}"]
+    return Server(command + plugin, socketFile)
+
+
+def engineArgs(case: Dict[str, Any], output: str, socketFile: str) -> Namespace:
+    """Options as set by virtnbdbackup for a local copy backup"""
+    return Namespace(
+        domain="benchmark",
+        level="copy",
+        level_filename="copy",
+        type="stream",
+        output=output,
+        stdout=False,
+        repository=None,
+        compress=case["compress"],
+        compression_method=case["compression_method"],
+        compress_threads=case["compress_threads"],
+        compressPool=ThreadPoolExecutor(case["compress_threads"]),
+        zstd_threads=0,
+        stream_version=case["stream_version"],
+        queue_depth=case["queue_depth"],
+        nbd_connections=case["nbd_connections"],
+        read_workers=0,
+        scheduler=None,
+        adaptive_request_size=False,
+        no_sparse_detection=False,
+        no_zero_detection=False,
+        skip_unchanged=False,
+        coalesce_gap=0,
+        stream_extents=False,
+        estimatedSizes={},
+        rateLimiter=ratelimit.Limiter(),
+        profile=False,
+        offline=False,
+        qemu=False,
+        nbd_ip="",
+        nbd_port=10809,
+        tls=False,
+        socketfile=socketFile,
+        sshClient=None,
+        noprogress=True,
+        verbose=False,
+        worker=1,
+        until=None,
+        cpt=Namespace(name="benchmark", parent="", file=""),
+    )
+
+
+def _usage() -> Dict[str, float]:
+    """Return CPU time consumed by the process and peak RSS"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"cpu": usage.ru_utime + usage.ru_stime, "rss": usage.ru_maxrss}
+
+
+def _dataSize(dataFile: str) -> int:
+    """Return amount of data saved in stream"""
+    sStream = streamer.SparseStream(types)
+    with open(dataFile, "rb") as reader:
+        _, _, length = sStream.readFrame(reader)
+        meta = sStream.loadMetadata(reader.read(length))
+    return meta["dataSize"]
+
+
+def runCase(case: Dict[str, Any]) -> Dict[str, Any]:
+    """Run single backup or restore and return measurements,
+    executed within its own process"""
+    args = engineArgs(case, case["output"], case["socket"])
+    before = _usage()
+    started = time.monotonic()
+    if case["mode"] == "backup":
+        os.makedirs(case["output"], exist_ok=True)
+        target = DomainDisk(EXPORT, "qcow2", "", "", [], None)
+        size, ok = disk.backup(
+            args, target, 0, stream.get(args), Namespace(remoteHost="")
+        )
+        if not ok:
+            raise RuntimeError("Backup failed")
+        dataFile = glob.glob(os.path.join(case["output"], "*.data"))[0]
+        processed = os.path.getsize(dataFile)
+    else:
+        dataFile = glob.glob(os.path.join(case["output"], "*.data"))[0]
+        connection = nbdcli.client(
+            nbdcli.Unix(EXPORT, "", case["socket"]), False
+        ).connect()
+        data.restore(
+            args, streamer.SparseStream(types), dataFile, "benchmark", connection
+        )
+        connection.disconnect()
+        size = _dataSize(dataFile)
+        processed = os.path.getsize(dataFile)
+    elapsed = time.monotonic() - started
+    after = _usage()
+    args.compressPool.shutdown()
+
+    cpu = after["cpu"] - before["cpu"]
+    return {
+        "seconds": round(elapsed, 3),
+        "dataBytes": size,
+        "fileBytes": processed,
+        "MBps": round(size / elapsed / 1000 / 1000, 2),
+        "cpuSeconds": round(cpu, 3),
+        "cpuPercent": round(cpu / elapsed * 100, 1),
+        "maxRssKiB": after["rss"],
+    }
+
+
+def _child(case: Dict[str, Any]) -> Dict[str, Any]:
+    """Run case in separate process"""
+    proc = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), "--run-case", json.dumps(case)],
+        stdout=subprocess.PIPE,
+        check=True,
+    )
+    return json.loads(proc.stdout.decode().splitlines()[-1])
+
+
+def _summary(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Return median of all runs"""
+    return {
+        key: statistics.median(run[key] for run in runs)
+        for key in ("seconds", "MBps", "cpuSeconds", "cpuPercent", "maxRssKiB")
+    }
+
+
+def benchmark(args: Namespace) -> Dict[str, Any]:
+    """Backup and restore each layout"""
+    workDir = tempfile.mkdtemp(prefix="virtnbdbackup.bench.", dir=args.workdir)
+    layouts = args.layouts.split(",")
+    results: List[Dict[str, Any]] = []
+    try:
+        for layout in layouts:
+            socketFile = os.path.join(workDir, "nbd.sock")
+            if layout == "sparse-random":
+                if args.server != "nbdkit":
+                    raise ValueError("Layout sparse-random requires nbdkit")
+                source = serve(
+                    args.server, socketFile, size=args.size, seed=args.seed, percent=10
+                )
+            else:
+                image = os.path.join(workDir, f"{layout}.raw")
+                createImage(image, layout, args.size, args.seed)
+                source = serve(args.server, socketFile, image)
+            case: Dict[str, Any] = {
+                "layout": layout,
+                "socket": socketFile,
+                "compress": args.compress,
+                "compression_method": args.compression_method,
+                "compress_threads": args.compress_threads,
+                "stream_version": args.stream_version,
+                "queue_depth": args.queue_depth,
+                "nbd_connections": args.nbd_connections,
+            }
+            backups: List[Dict[str, Any]] = []
+            restores: List[Dict[str, Any]] = []
+            try:
+                for i in range(args.repeat):
+                    case["output"] = os.path.join(workDir, f"{layout}.{i}")
+                    case["mode"] = "backup"
+                    backups.append(_child(case))
+            finally:
+                source.stop()
+
+            restoreFile = os.path.join(workDir, "restore.raw")
+            for i in range(args.repeat):
+                case["output"] = os.path.join(workDir, f"{layout}.{i}")
+                case["mode"] = "restore"
+                if args.server == "qemu-nbd":
+                    with open(restoreFile, "wb") as fh:
+                        fh.truncate(args.size)
+                    target = serve(args.server, socketFile, restoreFile)
+                else:
+                    target = serve(args.server, socketFile, size=args.size)
+                try:
+                    restores.append(_child(case))
+                finally:
+                    target.stop()
+                shutil.rmtree(case["output"])
+            for mode, runs in (("backup", backups), ("restore", restores)):
+                result = {"layout": layout, "mode": mode, "runs": runs}
+                result.update(_summary(runs))
+                results.append(result)
+                print(
+                    f"{layout:15} {mode:8} {result['MBps']:10.2f} MB/s "
+                    f"{result['cpuPercent']:6.1f}% CPU "
+                    f"{result['maxRssKiB'] / 1024:8.1f} MiB RSS",
+                    file=sys.stderr,
+                )
+    finally:
+        shutil.rmtree(workDir)
+
+    return {
+        "version": __version__,
+        "date": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "host": platform.node(),
+        "server": args.server,
+        "size": args.size,
+        "seed": args.seed,
+        "options": {
+            "compress": args.compress,
+            "compressionMethod": args.compression_method,
+            "compressThreads": args.compress_threads,
+            "streamVersion": args.stream_version,
+            "queueDepth": args.queue_depth,
+            "nbdConnections": args.nbd_connections,
+        },
+        "results": results,
+    }
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any]) -> None:
+    """Print throughput change against previous results"""
+    old = {(r["layout"], r["mode"]): r for r in previous["results"]}
+    print(f"Comparing {previous['version']} -> {current['version']}", file=sys.stderr)
+    for result in current["results"]:
+        base: Optional[Dict[str, Any]] = old.get((result["layout"], result["mode"]))
+        if base is None or not base["MBps"]:
+            continue
+        change = (result["MBps"] - base["MBps"]) / base["MBps"] * 100
+        print(
+            f"{result['layout']:15} {result['mode']:8} "
+            f"{base['MBps']:10.2f} -> {result['MBps']:10.2f} MB/s ({change:+.1f}%)",
+            file=sys.stderr,
+        )
+
+
+def main() -> None:
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark backup and restore against local NBD exports"
+    )
+    parser.add_argument(
+        "--server",
+        default="qemu-nbd",
+        choices=["qemu-nbd", "nbdkit"],
+        help="NBD server used for the exports. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--layouts",
+        default=",".join(LAYOUTS),
+        type=str,
+        help=(
+            "Comma separated list of extent layouts, sparse-random is "
+            "available with nbdkit. (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--size",
+        default=1024 * MiB,
+        type=int,
+        help="Virtual size of the exports in bytes. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed", default=1, type=int, help="Random seed. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--repeat",
+        default=3,
+        type=int,
+        help="Run each case multiple times, the median is reported. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compress",
+        default=False,
+        nargs="?",
+        type=int,
+        const=2,
+        help="Compress backup data. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compression-method",
+        default="lz4",
+        type=str,
+        help="Compression method. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compress-threads",
+        default=4,
+        type=int,
+        help="Compression threads. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--stream-version",
+        default=2,
+        type=int,
+        choices=[2, 3],
+        help="Stream format version. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--queue-depth",
+        default=4,
+        type=int,
+        help="NBD read requests in flight. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--nbd-connections",
+        default=1,
+        type=int,
+        help="Connections to the NBD server. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--workdir",
+        default=None,
+        type=str,
+        help="Directory for images and backups. (default: system temp directory)",
+    )
+    parser.add_argument(
+        "--output",
+        default="-",
+        type=str,
+        help="Write results as JSON to file. (default: stdout)",
+    )
+    parser.add_argument(
+        "--compare",
+        default=None,
+        type=str,
+        help="Compare throughput with results of a previous run.",
+    )
+    parser.add_argument("--run-case", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case is not None:
+        print(json.dumps(runCase(json.loads(args.run_case))))
+        return
+
+    results = benchmark(args)
+    if args.output == "-":
+        print(json.dumps(results, indent=1))
+    else:
+        with open(args.output, "w", encoding="utf-8") as fh:
+            json.dump(results, fh, indent=1)
+    if args.compare is not None:
+        with open(args.compare, "r", encoding="utf-8") as fh:
+            compare(json.load(fh), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+Benchmark sparse detection during incremental backup: intersect
+synthetic base allocation and dirty bitmap extents using the loop
+and, if numpy is installed, the vectorised implementation.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from typing import Any, Callable, Dict
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# pylint: disable=wrong-import-position
+from libvirtnbdbackup.objects import ExtentList
+from libvirtnbdbackup.extenthandler import extenthandler
+from libvirtnbdbackup.extenthandler.extenthandler import ExtentHandler
+
+
+def extents(context: str, count: int, rng: random.Random) -> ExtentList:
+    """Return alternating data and zero extents of random size"""
+    result = ExtentList(context)
+    offset = 0
+    for i in range(count):
+        length = rng.choice((4096, 65536, 196608, 1048576))
+        result.append(offset, length, i % 2 == 0)
+        offset += length
+    return result
+
+
+def measure(func: Callable, base: ExtentList, bitmap: ExtentList, repeat: int):
+    """Return best time of all runs and the result"""
+    best = float("inf")
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func(base, bitmap)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def main() -> None:
+    """Run benchmark"""
+    parser = argparse.ArgumentParser(
+        description="Benchmark intersection of base allocation and bitmap extents"
+    )
+    parser.add_argument(
+        "--extents",
+        default="10000,100000,1000000",
+        type=str,
+        help="Comma separated list of extent counts. (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", default=3, type=int, help="Runs per case. (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--seed", default=1, type=int, help="Random seed. (default: %(default)s)"
+    )
+    args = parser.parse_args()
+
+    results = []
+    for count in (int(c) for c in args.extents.split(",")):
+        rng = random.Random(args.seed)
+        base = extents("base:allocation", count, rng)
+        bitmap = extents("qemu:dirty-bitmap:backup-sda", count, rng)
+        case: Dict[str, Any] = {"extents": count}
+        loop, expected = measure(ExtentHandler.overlapLoop, base, bitmap, args.repeat)
+        case["loopSeconds"] = round(loop, 6)
+        case["overlaps"] = len(expected)
+        if extenthandler.HAVE_NUMPY:
+            vector, result = measure(
+                ExtentHandler.overlapVector, base, bitmap, args.repeat
+            )
+            assert list(result) == list(expected), "results differ"
+            case["vectorSeconds"] = round(vector, 6)
+            case["speedup"] = round(loop / vector, 1)
+        print(
+            " ".join(f"{key}={value}" for key, value in case.items()), file=sys.stderr
+        )
+        results.append(case)
+
+    print(json.dumps(results, indent=1))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+Unit tests for extent handling: intersection of base allocation
+and bitmap extents, coalescing of data extents and streamed extents.
+"""
+
+import random
+import unittest
+from typing import List, Tuple
+from libvirtnbdbackup.objects import ExtentList
+from libvirtnbdbackup.extenthandler import extenthandler
+from libvirtnbdbackup.extenthandler.extenthandler import ExtentHandler
+
+
+def extentList(entries: List[Tuple[int, bool]], context: str = "test") -> ExtentList:
+    """Return consecutive extents of the given length and type"""
+    result = ExtentList(context)
+    offset = 0
+    for length, data in entries:
+        result.append(offset, length, data)
+        offset += length
+    return result
+
+
+def randomExtents(rng: random.Random, size: int) -> ExtentList:
+    """Return random extents covering size bytes, adjacent
+    extents may have the same type"""
+    entries = []
+    remaining = size
+    while remaining > 0:
+        length = min(remaining, rng.choice((512, 4096, 65536, 196608)))
+        entries.append((length, rng.random() < 0.5))
+        remaining -= length
+    return extentList(entries)
+
+
+def asTuples(extents: ExtentList) -> List[Tuple[int, int, bool]]:
+    """Return offset, length and type of all extents"""
+    return [(e.offset, e.length, e.data) for e in extents]
+
+
+class OverlapTest(unittest.TestCase):
+    """Intersect base allocation and bitmap extents"""
+
+    def testOverlapLoop(self) -> None:
+        """Only ranges with data in both lists are returned"""
+        base = extentList([(100, True), (50, False), (100, True)])
+        bitmap = extentList([(50, False), (150, True), (50, False)])
+        self.assertEqual(
+            asTuples(ExtentHandler.overlapLoop(base, bitmap)),
+            [(50, 50, True), (150, 50, True)],
+        )
+
+    @unittest.skipUnless(extenthandler.HAVE_NUMPY, "numpy not installed")
+    def testOverlapVector(self) -> None:
+        """Vectorised intersection matches the loop"""
+        rng = random.Random(1)
+        for _ in range(50):
+            size = rng.randint(1, 64) * 65536
+            base = randomExtents(rng, size)
+            bitmap = randomExtents(rng, size)
+            self.assertEqual(
+                asTuples(ExtentHandler.overlapVector(base, bitmap)),
+                asTuples(ExtentHandler.overlapLoop(base, bitmap)),
+            )
+
+
+class CoalesceTest(unittest.TestCase):
+    """Merge data extents separated by small gaps"""
+
+    extents = extentList(
+        [(10, True), (5, False), (10, True), (100, False), (10, True), (20, False)]
+    )
+
+    def testSmallGap(self) -> None:
+        """Gaps up to the limit are merged, others are kept"""
+        # pylint: disable=protected-access
+        result, extra = extenthandler._coalesce(self.extents, 5)
+        self.assertEqual(
+            asTuples(result),
+            [(0, 25, True), (25, 100, False), (125, 10, True), (135, 20, False)],
+        )
+        self.assertEqual(extra, 5)
+
+    def testLargeGap(self) -> None:
+        """All data extents are merged into one"""
+        # pylint: disable=protected-access
+        result, extra = extenthandler._coalesce(self.extents, 100)
+        self.assertEqual(asTuples(result), [(0, 135, True), (135, 20, False)])
+        self.assertEqual(extra, 105)
+
+    def testNoGap(self) -> None:
+        """Extents are unchanged if no gap is small enough"""
+        # pylint: disable=protected-access
+        result, extra = extenthandler._coalesce(self.extents, 4)
+        self.assertEqual(asTuples(result), asTuples(self.extents))
+        self.assertEqual(extra, 0)
+
+    def testDataSize(self) -> None:
+        """Coalesced extents cover all data extents"""
+        rng = random.Random(2)
+        for maxGap in (0, 512, 65536):
+            extents = randomExtents(rng, 64 * 65536)
+            # pylint: disable=protected-access
+            result, extra = extenthandler._coalesce(extents, maxGap)
+            self.assertEqual(result.dataSize, extents.dataSize + extra)
+            self.assertEqual(sum(result.lengths), sum(extents.lengths))
+
+
+class ExtentStreamTest(unittest.TestCase):
+    """Extents received by a background thread"""
+
+    def testStream(self) -> None:
+        """All extents are returned, the data size is known once
+        all extents have been received"""
+        batches = [
+            (100, extentList([(50, True), (50, False)])),
+            (200, extentList([(100, True)])),
+        ]
+        stream = extenthandler.ExtentStream(iter(batches), 200)
+        self.assertEqual(
+            [(e.length, e.data) for e in stream], [(50, True), (50, False), (100, True)]
+        )
+        stream.close()
+        self.assertEqual(stream.dataSize, 150)
+        self.assertEqual(len(stream), 3)
+
+    def testError(self) -> None:
+        """Error of the extent query is raised while iterating"""
+
+        def batches():
+            yield 100, extentList([(100, True)])
+            raise RuntimeError("query failed")
+
+        stream = extenthandler.ExtentStream(batches(), 200)
+        with self.assertRaises(RuntimeError):
+            list(stream)
+        stream.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,124 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+Unit tests for bandwidth limits: token bucket, per disk limits
+and parsing of sizes.
+"""
+
+import unittest
+from typing import List
+from unittest import mock
+from libvirtnbdbackup.common import parseSize
+from libvirtnbdbackup.backup import ratelimit
+
+
+class Clock:
+    """Time advanced by sleep only"""
+
+    def __init__(self) -> None:
+        self.now: float = 100.0
+        self.sleeps: List[float] = []
+
+    def monotonic(self) -> float:
+        """Return current time"""
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        """Advance time"""
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+class RateLimitTest(unittest.TestCase):
+    """Limit bytes per second"""
+
+    def setUp(self) -> None:
+        self.clock = Clock()
+        patcher = mock.patch.object(ratelimit, "time", self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testUnlimited(self) -> None:
+        """Rate 0 does not limit requests"""
+        bucket = ratelimit.TokenBucket(0)
+        for _ in range(10):
+            bucket.consume(1 << 30)
+        self.assertEqual(self.clock.sleeps, [])
+
+    def testBucket(self) -> None:
+        """Requests wait once the bucket is empty, the bucket is
+        refilled up to the rate"""
+        bucket = ratelimit.TokenBucket(1000)
+        bucket.consume(1000)
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.consume(500)
+        self.assertEqual(self.clock.sleeps, [0.5])
+        self.clock.now += 10
+        bucket.consume(1000)
+        bucket.consume(2000)
+        self.assertEqual(self.clock.sleeps, [0.5, 2.0])
+
+    def testSetRate(self) -> None:
+        """Lowered rate applies to the next request"""
+        bucket = ratelimit.TokenBucket(1000)
+        bucket.setRate(100)
+        bucket.consume(200)
+        self.assertEqual(self.clock.sleeps, [1.0])
+        bucket.setRate(0)
+        bucket.consume(1 << 30)
+        self.assertEqual(self.clock.sleeps, [1.0])
+
+    def testDiskLimit(self) -> None:
+        """Disks of different domains have their own bucket"""
+        limiter = ratelimit.Limiter(0, 1000)
+        limiter.disk("vm1", "vda").consume(1000)
+        limiter.disk("vm2", "vda").consume(1000)
+        self.assertEqual(self.clock.sleeps, [])
+        limiter.disk("vm1", "vda").consume(500)
+        self.assertEqual(self.clock.sleeps, [0.5])
+
+    def testGlobalLimit(self) -> None:
+        """All disks share the global bucket"""
+        limiter = ratelimit.Limiter(1000, 0)
+        limiter.disk("vm1", "vda").consume(1000)
+        limiter.disk("vm2", "vdb").consume(1000)
+        self.assertEqual(self.clock.sleeps, [1.0])
+
+
+class ParseSizeTest(unittest.TestCase):
+    """Parse sizes with unit suffix"""
+
+    def testParse(self) -> None:
+        """Suffix K, M and G are accepted"""
+        for value, expected in (
+            ("0", 0),
+            ("4096", 4096),
+            ("64K", 65536),
+            ("1.5M", 1572864),
+            ("10mb", 10485760),
+            ("2G", 2147483648),
+        ):
+            self.assertEqual(parseSize(value), expected)
+
+    def testInvalid(self) -> None:
+        """Negative and invalid sizes are rejected"""
+        for value in ("-1", "K", "ten"):
+            with self.assertRaises(ValueError):
+                parseSize(value)
+
+
+if __name__ == "__main__":
+    unittest.main()
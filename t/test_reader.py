@@ -0,0 +1,244 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+Unit tests for reading data blocks: order of blocks read with
+requests in flight, striped across connections or by shared
+read workers, and return of buffers once reading failed.
+"""
+
+import os
+import errno
+import random
+import threading
+import unittest
+from typing import Dict, List, Optional, Tuple
+import nbd
+from libvirtnbdbackup import nbdcli
+
+BLOCK_SIZE = 4096
+
+
+class FakeHandle:
+    # pylint: disable=too-many-instance-attributes
+    """Asynchronous read requests of a NBD handle, finished in random
+    order. Requests with cookie fail are finished with an error."""
+
+    def __init__(self, data: bytes, fail: int = 0) -> None:
+        self._data = data
+        self._fail = fail
+        self._rng = random.Random(len(data))
+        self._cookie: int = 0
+        self._pending: Dict[int, Tuple[memoryview, int]] = {}
+        self._done: Dict[int, bool] = {}
+        self.inFlight: int = 0
+        self.maxInFlight: int = 0
+
+    def aio_pread(self, buf: memoryview, offset: int) -> int:
+        """Issue read request"""
+        self._cookie += 1
+        self._pending[self._cookie] = (buf, offset)
+        self.inFlight += 1
+        self.maxInFlight = max(self.maxInFlight, self.inFlight)
+        return self._cookie
+
+    def poll(self, _: int) -> None:
+        """Finish one of the requests in flight"""
+        cookie = self._rng.choice(list(self._pending))
+        buf, offset = self._pending.pop(cookie)
+        buf[:] = self._data[offset : offset + len(buf)]
+        self._done[cookie] = cookie != self._fail
+        self.inFlight -= 1
+
+    def aio_command_completed(self, cookie: int) -> bool:
+        """Check if request has finished"""
+        if cookie not in self._done:
+            return False
+        if not self._done.pop(cookie):
+            raise nbd.Error("read failed", errno.EIO)
+        return True
+
+
+class FakeConnection:
+    """Connection to the NBD server"""
+
+    maxRequestSize = BLOCK_SIZE
+
+    def __init__(self, data: bytes, fail: int = 0) -> None:
+        self.nbd = FakeHandle(data, fail)
+
+    def disconnect(self) -> None:
+        """Nothing to disconnect"""
+
+
+class CountingPool(nbdcli.BufferPool):
+    """Count buffers not returned to the pool"""
+
+    def __init__(self, count: int) -> None:
+        super().__init__(count)
+        self._lock = threading.Lock()
+        self.used: int = 0
+
+    def get(self, length: int) -> memoryview:
+        """Return buffer"""
+        with self._lock:
+            self.used += 1
+        return super().get(length)
+
+    def put(self, view: memoryview) -> None:
+        """Return buffer to the pool"""
+        with self._lock:
+            self.used -= 1
+        super().put(view)
+
+
+def blocks(data: bytes) -> List[Tuple[int, int]]:
+    """Return length and offset of all blocks"""
+    return [(BLOCK_SIZE, offset) for offset in range(0, len(data), BLOCK_SIZE)]
+
+
+def readAll(reader) -> bytes:
+    """Read all blocks in sequence and check their offsets"""
+    result = bytearray()
+    while True:
+        item = reader.read()
+        if item is None:
+            return bytes(result)
+        length, offset, view = item
+        assert offset == len(result) and length == len(view)
+        result += view
+        reader.release(view)
+
+
+class ReaderTest(unittest.TestCase):
+    """Read blocks using a single connection"""
+
+    data = os.urandom(64 * BLOCK_SIZE)
+
+    def testOrder(self) -> None:
+        """Blocks are returned in order while requests are in flight"""
+        for queueDepth in (1, 4, 16):
+            with self.subTest(queueDepth=queueDepth):
+                connection = FakeConnection(self.data)
+                reader = nbdcli.Reader(connection, iter(blocks(self.data)), queueDepth)
+                self.assertEqual(readAll(reader), self.data)
+                self.assertEqual(connection.nbd.maxInFlight, queueDepth)
+
+    def testFailedRead(self) -> None:
+        """Buffers of all requests are returned after a read failed"""
+        pool = CountingPool(8)
+        reader = nbdcli.Reader(
+            FakeConnection(self.data, fail=5), iter(blocks(self.data)), 4, pool
+        )
+        with self.assertRaises(nbd.Error):
+            readAll(reader)
+        reader.close()
+        self.assertEqual(pool.used, 0)
+
+
+class StripedReaderTest(unittest.TestCase):
+    """Read blocks striped across multiple connections"""
+
+    data = os.urandom(256 * BLOCK_SIZE)
+
+    def testOrder(self) -> None:
+        """Blocks are reassembled in the original order"""
+        for count in (2, 3, 5):
+            with self.subTest(connections=count):
+                reader = nbdcli.StripedReader(
+                    [FakeConnection(self.data) for _ in range(count)],
+                    iter(blocks(self.data)),
+                    4,
+                )
+                self.assertEqual(readAll(reader), self.data)
+                reader.close()
+
+    def testClose(self) -> None:
+        """Buffers not passed to the consumer are returned on close"""
+        pool = CountingPool(32)
+        reader = nbdcli.StripedReader(
+            [FakeConnection(self.data) for _ in range(3)],
+            iter(blocks(self.data)),
+            4,
+            pool,
+        )
+        item = reader.read()
+        assert item is not None
+        reader.release(item[2])
+        reader.close()
+        self.assertEqual(pool.used, 0)
+
+
+class SchedulerTest(unittest.TestCase):
+    """Read blocks of multiple disks using shared workers"""
+
+    def setUp(self) -> None:
+        self.scheduler = nbdcli.Scheduler(3)
+
+    def tearDown(self) -> None:
+        self.scheduler.shutdown()
+
+    def add(self, data: bytes, sequence, pool: Optional[nbdcli.BufferPool] = None):
+        """Add disk to the scheduler"""
+        return self.scheduler.add(
+            FakeConnection(data),
+            sequence,
+            len(data),
+            8,
+            4,
+            2,
+            lambda: FakeConnection(data),
+            pool or nbdcli.BufferPool(9),
+        )
+
+    def testOrder(self) -> None:
+        """Blocks of each disk are returned in order"""
+        disks = [os.urandom(n * BLOCK_SIZE) for n in (128, 16, 48)]
+        jobs = [self.add(data, iter(blocks(data))) for data in disks]
+        results: List[bytes] = [b""] * len(disks)
+
+        def consume(index: int) -> None:
+            results[index] = readAll(jobs[index])
+
+        threads = [threading.Thread(target=consume, args=(i,)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for job in jobs:
+            job.close()
+        self.assertEqual(results, disks)
+
+    def testError(self) -> None:
+        """Error of the block sequence is passed to the consumer"""
+        data = os.urandom(16 * BLOCK_SIZE)
+        pool = CountingPool(9)
+
+        def sequence():
+            yield from blocks(data)[:4]
+            raise RuntimeError("extent query failed")
+
+        job = self.add(data, sequence(), pool)
+        with self.assertRaises(RuntimeError):
+            readAll(job)
+        job.close()
+        self.assertEqual(pool.used, 0)
+        job = self.add(data, iter(blocks(data)))
+        self.assertEqual(readAll(job), data)
+        job.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
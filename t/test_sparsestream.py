@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+"""
+Copyright (C) 2023 Michael Ablassmeier <abi@grinser.de>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <https://www.gnu.org/licenses/>.
+Unit tests for the sparse stream format: round trip of stream
+version 2 and 3, detection of corrupt version 3 frames.
+"""
+
+import io
+import json
+import unittest
+from typing import Any, List, Tuple
+from libvirtnbdbackup.sparsestream import streamer, types
+from libvirtnbdbackup.sparsestream.exceptions import FrameChecksumException
+
+META = json.dumps({"virtualSize": 1048576}).encode()
+FRAMES: List[Tuple[bytes, int, Any]] = [
+    (b"data", 0, b"a" * 4096),
+    (b"zero", 4096, 65536),
+    (b"data", 69632, bytes(range(256)) * 16),
+]
+
+
+def write(version: int, trailer: bool = False) -> bytes:
+    """Write stream with meta, data and zero frames"""
+    fh = io.BytesIO()
+    stream = streamer.SparseStream(types, version)
+    writer = stream.writer(fh)
+    sTypes = stream.types
+    stream.writeFrame(writer, sTypes.META, 0, len(META))
+    writer.write(META)
+    stream.writeTerm(writer)
+    for kind, start, payload in FRAMES:
+        if kind == sTypes.ZERO:
+            stream.writeFrame(writer, kind, start, payload)
+            continue
+        stream.writeFrame(writer, kind, start, len(payload))
+        writer.write(payload)
+        stream.writeTerm(writer)
+    stream.writeFrame(writer, sTypes.STOP, 0, 0)
+    if trailer:
+        stream.writeCompressionTrailer(writer, [4096, {"4096": [2048, 2048]}])
+    return fh.getvalue()
+
+
+def read(data: bytes) -> Tuple[int, List[Tuple[bytes, int, Any]]]:
+    """Read all frames, the payload of data frames is returned
+    along with the frame, the length for zero frames"""
+    stream = streamer.SparseStream(types)
+    sTypes = stream.types
+    reader = stream.reader(io.BytesIO(data))
+    frames: List[Tuple[bytes, int, Any]] = []
+    kind, start, length = stream.readFrame(reader)
+    assert kind == sTypes.META
+    assert reader.read(length) == META
+    stream.readTerm(reader)
+    version = stream.frameVersion
+    while True:
+        kind, start, length = stream.readFrame(reader)
+        if kind == sTypes.STOP:
+            return version, frames
+        if kind == sTypes.ZERO:
+            frames.append((kind, start, length))
+            continue
+        frames.append((kind, start, reader.read(length)))
+        stream.readTerm(reader)
+
+
+class SparseStreamTest(unittest.TestCase):
+    """Write and read sparse streams"""
+
+    def testRoundTrip(self) -> None:
+        """Frames read match the frames written"""
+        for version in (2, 3):
+            with self.subTest(version=version):
+                self.assertEqual(read(write(version)), (version, FRAMES))
+
+    def testCompressionTrailer(self) -> None:
+        """Compression trailer is found at the end of the stream"""
+        for version in (2, 3):
+            with self.subTest(version=version):
+                stream = streamer.SparseStream(types)
+                fh = io.BytesIO(write(version, trailer=True))
+                self.assertEqual(
+                    stream.readCompressionTrailer(fh),
+                    [4096, {"4096": [2048, 2048]}],
+                )
+                self.assertEqual(fh.tell(), 0)
+
+    def testCorruptPayload(self) -> None:
+        """Changed payload of version 3 frame is detected"""
+        data = bytearray(write(3))
+        data[data.index(b"a" * 4096) + 100] ^= 0xFF
+        with self.assertRaises(FrameChecksumException):
+            read(bytes(data))
+
+    def testCorruptHeader(self) -> None:
+        """Changed header of version 3 frame is detected"""
+        data = bytearray(write(3))
+        # start offset of the last data frame
+        data[data.rindex(b"data") + 15] ^= 0x01
+        with self.assertRaises(FrameChecksumException):
+            read(bytes(data))
+
+    def testCorruptPayloadVersion2(self) -> None:
+        """Version 2 frames have no checksum"""
+        data = bytearray(write(2))
+        data[data.index(b"a" * 4096) + 100] ^= 0xFF
+        _, frames = read(bytes(data))
+        self.assertNotEqual(frames, FRAMES)
+
+
+if __name__ == "__main__":
+    unittest.main()